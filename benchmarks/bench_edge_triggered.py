@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+''' compares level and edge triggered EpollLoop on a localhost stream
+
+a server pushes TOTAL bytes to a client in CHUNK sized writes, refilling on
+'drain', and we count the epoll syscalls it took. socket buffers are kept
+small so writes block often, like they do on a busy proxy '''
+
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ssloop
+from ssloop.impl.epoll_loop import EpollLoop
+
+TOTAL = 64 * 1024 * 1024
+CHUNK = 16 * 1024
+SOCKET_BUFSIZE = 64 * 1024
+
+
+class CountingEpollLoop(EpollLoop):
+
+    def __init__(self, edge_triggered=False):
+        super(CountingEpollLoop, self).__init__(edge_triggered)
+        self.epoll_ctl = 0
+        self.epoll_wait = 0
+
+    def _poll(self, timeout):
+        self.epoll_wait += 1
+        return super(CountingEpollLoop, self)._poll(timeout)
+
+    def _add_fd(self, fd, mode):
+        self.epoll_ctl += 1
+        super(CountingEpollLoop, self)._add_fd(fd, mode)
+
+    def _remove_fd(self, fd):
+        self.epoll_ctl += 1
+        super(CountingEpollLoop, self)._remove_fd(fd)
+
+    def _modify_fd(self, fd, mode):
+        self.epoll_ctl += 1
+        super(CountingEpollLoop, self)._modify_fd(fd, mode)
+
+
+def run(edge_triggered):
+    loop = CountingEpollLoop(edge_triggered)
+    state = {'sent': 0, 'received': 0}
+    chunk = 'x' * CHUNK
+
+    def push(conn):
+        while state['sent'] < TOTAL:
+            state['sent'] += CHUNK
+            if not conn.write(chunk):
+                return
+        conn.end()
+
+    def on_connection(server, conn):
+        conn._socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFSIZE)
+        conn.on('drain', push)
+        push(conn)
+
+    def on_data(s, data):
+        state['received'] += len(data)
+
+    def on_close(s):
+        server.close()
+        loop.stop()
+
+    server = ssloop.Server(('127.0.0.1', 0), loop=loop)
+    server.on('connection', on_connection)
+    server.listen()
+    client = ssloop.Socket(loop=loop)
+    client.on('data', on_data)
+    client.on('close', on_close)
+    client.connect(server._socket.getsockname())
+
+    start = time.time()
+    loop.start()
+    elapsed = time.time() - start
+    assert state['received'] == TOTAL
+    syscalls = loop.epoll_ctl + loop.epoll_wait
+    return {
+        'mode': 'edge' if edge_triggered else 'level',
+        'epoll_ctl': loop.epoll_ctl,
+        'epoll_wait': loop.epoll_wait,
+        'syscalls_per_mb': syscalls * 1024.0 * 1024 / TOTAL,
+        'mb_per_sec': TOTAL / elapsed / 1024 / 1024,
+    }
+
+
+def main():
+    for edge_triggered in (False, True):
+        r = run(edge_triggered)
+        print '%(mode)-5s epoll_ctl: %(epoll_ctl)6d  epoll_wait: %(epoll_wait)6d  ' \
+            'epoll syscalls/MB: %(syscalls_per_mb)8.2f  %(mb_per_sec)8.1f MB/s' % r
+
+
+if __name__ == '__main__':
+    main()
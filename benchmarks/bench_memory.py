@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+''' memory of idle connections on the server side
+
+a forked child opens CONNECTIONS connections to a Server and keeps them
+open, so only the accepted Sockets are counted here. uses tracemalloc
+where available, else the growth of the resident set size, which is less
+precise '''
+
+import gc
+import json
+import os
+import resource
+import signal
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ssloop
+
+CONNECTIONS = 10000
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def _rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def _measure():
+    gc.collect()
+    if tracemalloc is not None:
+        return tracemalloc.get_traced_memory()[0]
+    return _rss()
+
+
+def _open_connections(address, n):
+    # runs in the child, until killed
+    clients = []
+    for i in xrange(n):
+        s = socket.socket()
+        s.connect(address)
+        clients.append(s)
+    os.write(1, b'')
+    while True:
+        time.sleep(60)
+
+
+def run(n):
+    limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    n = min(n, limit - 64)
+    loop = ssloop.instance()
+    server = ssloop.Server(('127.0.0.1', 0))
+    server.listen(backlog=n)
+    address = server._socket.getsockname()
+    accepted = []
+    server.on('connection', lambda server, conn: accepted.append(conn))
+
+    def wait_until_accepted():
+        if len(accepted) >= n:
+            loop.stop()
+        else:
+            loop.add_timeout(0.05, wait_until_accepted)
+
+    # let the loop allocate what it needs before measuring
+    loop.add_timeout(0, loop.stop)
+    loop.start()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    before = _measure()
+    pid = os.fork()
+    if pid == 0:
+        server._socket.close()
+        _open_connections(address, n)
+    try:
+        wait_until_accepted()
+        loop.start()
+        after = _measure()
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    return {
+        'connections': n,
+        'bytes_per_connection': (after - before) / float(n),
+        'method': 'tracemalloc' if tracemalloc is not None else 'rss',
+    }
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else CONNECTIONS
+    print json.dumps(run(n), sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
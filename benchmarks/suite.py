@@ -0,0 +1,399 @@
+#!/usr/bin/python
+
+''' localhost benchmarks of ssloop, for catching performance regressions
+
+runs every benchmark on every available backend and prints the results as
+JSON on stdout, with a summary on stderr. each benchmark is run --repeat
+times and the run with the median score is kept. --scale shrinks or grows
+the amount of work, results of different scales don't compare
+
+    python benchmarks/suite.py --backend epoll --benchmark rps -o out.json '''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ssloop
+from ssloop import loop as loop_
+from ssloop.dgram import DatagramSocket
+from ssloop.event import EventEmitter
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+ECHO_TOTAL = 32 * 1024 * 1024
+ECHO_CHUNK = 16 * 1024
+
+MESSAGE_SIZE = 64
+CONCURRENCY = 16
+RPS_REQUESTS = 50000
+CPS_CONNECTIONS = 2000
+
+UDP_PACKETS = 100000
+UDP_WINDOW = 64  # datagrams in flight, so the receive buffers don't overflow
+
+TIMERS = 100000
+EMITS = 1000000
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def _listen(loop):
+    server = ssloop.Server(('127.0.0.1', 0), loop=loop)
+    server.listen()
+    return server, server._socket.getsockname()
+
+
+def bench_echo(loop, scale):
+    '''a client streams to an echo server and reads it all back'''
+    total = int(ECHO_TOTAL * scale)
+    chunk = b'x' * ECHO_CHUNK
+    state = {'sent': 0, 'received': 0}
+
+    def on_connection(server, conn):
+        def on_data(s, data):
+            if not s.write(data):
+                s.pause()
+        conn.on('data', on_data)
+        conn.on('drain', lambda s: s.resume())
+
+    def push(s):
+        while state['sent'] < total:
+            state['sent'] += len(chunk)
+            if not s.write(chunk):
+                return
+
+    def on_data(s, data):
+        state['received'] += len(data)
+        if state['received'] >= state['sent'] >= total:
+            s.close()
+            server.close()
+            loop.stop()
+
+    server, address = _listen(loop)
+    server.on('connection', on_connection)
+    client = ssloop.Socket(loop=loop)
+    client.on('connect', push)
+    client.on('drain', push)
+    client.on('data', on_data)
+    start = _timer()
+    client.connect(address)
+    loop.start()
+    elapsed = _timer() - start
+    return {
+        'mb_per_sec': state['received'] / elapsed / 1024 / 1024,
+        'seconds': elapsed,
+    }
+bench_echo.score = 'mb_per_sec'
+
+
+def _reply_server(loop):
+    '''answers each MESSAGE_SIZE bytes received with MESSAGE_SIZE bytes'''
+    response = b'r' * MESSAGE_SIZE
+
+    def on_connection(server, conn):
+        pending = [0]
+
+        def on_data(s, data):
+            pending[0] += len(data)
+            n, pending[0] = divmod(pending[0], MESSAGE_SIZE)
+            if n:
+                s.write(response * n)
+        conn.on('data', on_data)
+
+    server, address = _listen(loop)
+    server.on('connection', on_connection)
+    return server, address
+
+
+def bench_rps(loop, scale):
+    '''CONCURRENCY keep-alive connections doing request/response'''
+    total = int(RPS_REQUESTS * scale)
+    request = b'q' * MESSAGE_SIZE
+    state = {'sent': 0, 'done': 0, 'open': CONCURRENCY}
+    latencies = []
+    server, address = _reply_server(loop)
+
+    request_start = {}  # {client: time}
+    received = {}  # {client: bytes}
+
+    def send(s):
+        if state['sent'] >= total:
+            s.close()
+            return
+        state['sent'] += 1
+        request_start[s] = _timer()
+        s.write(request)
+
+    def on_data(s, data):
+        received[s] += len(data)
+        while received[s] >= MESSAGE_SIZE:
+            received[s] -= MESSAGE_SIZE
+            latencies.append(_timer() - request_start[s])
+            state['done'] += 1
+            send(s)
+
+    def on_close(s):
+        state['open'] -= 1
+        if not state['open']:
+            server.close()
+            loop.stop()
+
+    start = _timer()
+    for i in xrange(CONCURRENCY):
+        client = ssloop.Socket(loop=loop)
+        received[client] = 0
+        client.on('connect', send)
+        client.on('data', on_data)
+        client.on('close', on_close)
+        client.connect(address)
+    loop.start()
+    elapsed = _timer() - start
+    return {
+        'requests_per_sec': state['done'] / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+bench_rps.score = 'requests_per_sec'
+
+
+def bench_cps(loop, scale):
+    '''CONCURRENCY clients, each connecting, doing one request/response and
+    closing, over and over'''
+    total = int(CPS_CONNECTIONS * scale)
+    request = b'q' * MESSAGE_SIZE
+    state = {'started': 0, 'done': 0}
+    latencies = []
+    server, address = _reply_server(loop)
+    connect_start = {}  # {client: time}
+    received = {}  # {client: bytes}
+
+    def connect():
+        if state['started'] >= total:
+            return
+        state['started'] += 1
+        client = ssloop.Socket(loop=loop)
+        connect_start[client] = _timer()
+        received[client] = 0
+        client.on('connect', lambda s: s.write(request))
+        client.on('data', on_data)
+        client.on('error', lambda s, e: sys.stderr.write('cps: %s\n' % e))
+        client.on('close', on_close)
+        client.connect(address)
+
+    def on_data(s, data):
+        received[s] += len(data)
+        if received[s] >= MESSAGE_SIZE:
+            latencies.append(_timer() - connect_start.pop(s))
+            del received[s]
+            state['done'] += 1
+            s.close()
+
+    def on_close(s):
+        if state['done'] >= total:
+            server.close()
+            loop.stop()
+        else:
+            connect()
+
+    start = _timer()
+    for i in xrange(CONCURRENCY):
+        connect()
+    loop.start()
+    elapsed = _timer() - start
+    return {
+        'connections_per_sec': state['done'] / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+bench_cps.score = 'connections_per_sec'
+
+
+def bench_udp(loop, scale):
+    '''a client keeps UDP_WINDOW datagrams in flight to an echo server.
+    packets_per_sec counts the datagrams received by both'''
+    total = int(UDP_PACKETS * scale)
+    message = b'u' * MESSAGE_SIZE
+    state = {'sent': 0, 'received': 0}
+    server = DatagramSocket(loop=loop)
+    server.bind(('127.0.0.1', 0))
+    server.on('message', lambda s, data, address: s.send(data, address))
+    address = server.getsockname()
+    client = DatagramSocket(loop=loop)
+
+    def send():
+        if state['sent'] < total:
+            state['sent'] += 1
+            client.send(message, address)
+
+    def on_message(s, data, address):
+        state['received'] += 1
+        if state['received'] >= total:
+            loop.stop()
+        send()
+
+    def lost():
+        # a datagram got dropped, keep the window full
+        if state['received'] == received[0]:
+            send()
+        received[0] = state['received']
+        loop.add_timeout(0.1, lost)
+    received = [0]
+    client.on('message', on_message)
+    loop.add_timeout(0.1, lost)
+    start = _timer()
+    for i in xrange(UDP_WINDOW):
+        send()
+    loop.start()
+    elapsed = _timer() - start
+    client.close()
+    server.close()
+    return {
+        'packets_per_sec': state['received'] * 2 / elapsed,
+        'lost': state['sent'] - state['received'],
+    }
+bench_udp.score = 'packets_per_sec'
+
+
+def bench_timers(loop, scale):
+    '''cost of add_timeout, remove_handler and of firing, for precise
+    timeouts and coarse ones'''
+    n = int(TIMERS * scale)
+    noop = lambda: None
+    result = {}
+    for kind, coarse in (('', False), ('coarse_', True)):
+        start = _timer()
+        handlers = [loop.add_timeout(1 + i % 1000, noop, coarse)
+                    for i in xrange(n)]
+        result[kind + 'schedule_ns'] = (_timer() - start) / n * 1e9
+        start = _timer()
+        for handler in handlers:
+            loop.remove_handler(handler)
+        result[kind + 'cancel_ns'] = (_timer() - start) / n * 1e9
+    # expired timeouts run in the first iteration, before the loop polls
+    for i in xrange(n - 1):
+        loop.add_timeout(0, noop)
+    loop.add_timeout(0, loop.stop)
+    start = _timer()
+    loop.start()
+    result['fire_ns'] = (_timer() - start) / n * 1e9
+    return result
+bench_timers.score = 'fire_ns'
+
+
+class _FastEmitter(EventEmitter):
+    __slots__ = ()
+    catch_errors = False
+
+
+def bench_emitter(loop, scale):
+    '''EventEmitter.emit with one listener, three, none, without catching
+    errors, and once() followed by its emit'''
+    n = int(EMITS * scale)
+    listener = lambda s, data: None
+    result = {}
+    for key, cls, listeners, name in (
+            ('emit_ns', EventEmitter, 1, 'data'),
+            ('emit_3_ns', EventEmitter, 3, 'data'),
+            ('emit_unknown_ns', EventEmitter, 1, 'unknown'),
+            ('emit_uncaught_ns', _FastEmitter, 1, 'data')):
+        emitter = cls()
+        for i in xrange(listeners):
+            emitter.on('data', listener)
+        emit = emitter.emit
+        start = _timer()
+        for i in xrange(n):
+            emit(name, emitter, None)
+        result[key] = (_timer() - start) / n * 1e9
+    emitter = EventEmitter()
+    once, emit = emitter.once, emitter.emit
+    start = _timer()
+    for i in xrange(n):
+        once('data', listener)
+        emit('data', emitter, None)
+    result['once_emit_ns'] = (_timer() - start) / n * 1e9
+    assert not emitter.listener_count('data')
+    return result
+bench_emitter.score = 'emit_ns'
+bench_emitter.loop_independent = True
+
+
+BENCHMARKS = [
+    ('echo', bench_echo),
+    ('rps', bench_rps),
+    ('cps', bench_cps),
+    ('udp', bench_udp),
+    ('timers', bench_timers),
+    ('emitter', bench_emitter),
+]
+
+
+def run(name, bench, backend, loop_cls, scale, repeat):
+    runs = []
+    for i in xrange(repeat):
+        runs.append(bench(loop_cls(), scale))
+    runs.sort(key=lambda r: r[bench.score])
+    result = {'benchmark': name, 'backend': backend, 'scale': scale,
+              'repeat': repeat}
+    result.update(runs[len(runs) // 2])
+    return result
+
+
+def main():
+    backends = [(name, loop_.backend_class(name))
+                for name in loop_.available_backends()]
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--backend', action='append',
+                        choices=[name for name, cls in backends])
+    parser.add_argument('--benchmark', action='append',
+                        choices=[name for name, bench in BENCHMARKS])
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help='write JSON here')
+    args = parser.parse_args()
+
+    results = []
+    for name, bench in BENCHMARKS:
+        if args.benchmark and name not in args.benchmark:
+            continue
+        for backend, loop_cls in backends:
+            if args.backend and backend not in args.backend:
+                continue
+            result = run(name, bench, backend, loop_cls, args.scale,
+                         args.repeat)
+            if getattr(bench, 'loop_independent', False):
+                result['backend'] = None
+            results.append(result)
+            sys.stderr.write('%-8s %-7s %s\n' % (
+                name, result['backend'] or '-',
+                ' '.join('%s=%.4g' % (k, v) for k, v in sorted(result.items())
+                         if isinstance(v, float) and k != 'scale')))
+            if getattr(bench, 'loop_independent', False):
+                break
+
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
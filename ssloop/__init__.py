@@ -1,3 +1,8 @@
 from loop import instance
 from event import EventEmitter
 from net import Socket, Server
+from dgram import DatagramSocket
+from tls import TLSSocket, TLSServer
+from pool import ConnectionPool
+from framing import DelimiterDecoder, LengthPrefixDecoder, VarintDecoder, FixedSizeDecoder
+from multiloop import MultiLoopServer
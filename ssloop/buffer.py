@@ -0,0 +1,24 @@
+#!/usr/bin/python
+
+BUFFER_SIZE = 64 * 1024
+MAX_BUFFERS = 16
+
+
+class BufferPool(object):
+    ''' reusable bytearrays, shared by all sockets of a loop
+
+    at most max_buffers idle buffers are kept, others are left to the GC '''
+
+    def __init__(self, bufsize=BUFFER_SIZE, max_buffers=MAX_BUFFERS):
+        self.bufsize = bufsize
+        self.max_buffers = max_buffers
+        self._free = []
+
+    def acquire(self):
+        if self._free:
+            return self._free.pop()
+        return bytearray(self.bufsize)
+
+    def release(self, buf):
+        if len(self._free) < self.max_buffers and len(buf) == self.bufsize:
+            self._free.append(buf)
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+
+''' UDP sockets for SSLoop '''
+
+import collections
+import errno
+import logging
+import socket
+
+import event
+import loop as loop_
+from loop import instance
+import net
+
+# max datagrams received per readiness event before yielding to other fds
+RECV_BATCH = 64
+
+# errors about one datagram, or an ICMP error of an earlier one. they are
+# emitted but don't close the socket
+_DATAGRAM_ERRORS = (errno.EMSGSIZE, errno.ECONNREFUSED, errno.EHOSTUNREACH,
+                    errno.ENETUNREACH, errno.EPERM, errno.EACCES)
+
+
+class DatagramSocket(event.EventEmitter):
+    ''' emits 'message' (sock, data, address) for each datagram received,
+    'drain' once the send queue got down to the low water mark after send()
+    returned False, 'error' (sock, error) and 'close'
+
+    addresses must be IP addresses, resolve names with loop.resolver '''
+
+    __slots__ = ('_socket', '_loop', '_queue', '_queued_size',
+                 '_high_water_mark', '_low_water_mark', '_need_drain',
+                 '_read_handler', '_write_handler', '_paused', '_zero_copy',
+                 '_closed')
+
+    def __init__(self, loop=None, family=socket.AF_INET, sock=None):
+        super(DatagramSocket, self).__init__()
+        self._loop = loop if loop is not None else instance()
+        if sock is None:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        self._socket = sock
+        self._queue = None
+        # deque of (data, address) waiting to be sent, None when empty
+        self._queued_size = 0
+        self._high_water_mark = net.HIGH_WATER_MARK
+        self._low_water_mark = net.LOW_WATER_MARK
+        self._need_drain = False
+        self._write_handler = None
+        self._paused = False
+        self._zero_copy = False
+        self._closed = False
+        self._read_handler = self._loop.add_fd(sock, loop_.MODE_IN, self._read_cb,
+                                               self._poll_failed)
+
+    def __del__(self):
+        if not self._closed:
+            self.close()
+
+    def bind(self, address):
+        self._socket.bind(address)
+
+    def getsockname(self):
+        return self._socket.getsockname()
+
+    def set_zero_copy(self, enabled=True):
+        '''deliver 'message' data as a memoryview of a pooled buffer instead
+        of a string. the view is only valid until the callback returns'''
+        self._zero_copy = enabled
+
+    def set_water_marks(self, high, low):
+        assert 0 <= low <= high
+        self._high_water_mark = high
+        self._low_water_mark = low
+
+    @property
+    def queued_size(self):
+        '''bytes of datagrams sent but not passed to the kernel yet'''
+        return self._queued_size
+
+    def pause(self):
+        if not self._paused and not self._closed:
+            self._paused = True
+            self._loop.remove_handler(self._read_handler)
+            self._read_handler = None
+
+    def resume(self):
+        if self._paused and not self._closed:
+            self._paused = False
+            self._read_handler = self._loop.add_fd(self._socket, loop_.MODE_IN, self._read_cb,
+                                                   self._poll_failed)
+
+    def close(self):
+        if self._closed:
+            logging.warn('closing a closed socket')
+            return
+        self._closed = True
+        if self._read_handler:
+            self._loop.remove_handler(self._read_handler)
+            self._read_handler = None
+        if self._write_handler:
+            self._loop.remove_handler(self._write_handler)
+            self._write_handler = None
+        self._queue = None
+        self._socket.close()
+        self.emit('close', self)
+
+    def _poll_failed(self, handler):
+        # the loop can't watch the socket, select above FD_SETSIZE
+        if not self._closed:
+            self.emit('error', self, handler.error)
+            self.close()
+
+    def _read_cb(self):
+        pool = self._loop.buffer_pool
+        buf = pool.acquire()
+        try:
+            view = memoryview(buf)
+            recvfrom_into = self._socket.recvfrom_into
+            for i in xrange(RECV_BATCH):
+                try:
+                    n, address = recvfrom_into(buf)
+                except socket.error as e:
+                    if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                        return
+                    if e.args[0] in _DATAGRAM_ERRORS or e.args[0] == errno.EINTR:
+                        self.emit('error', self, e)
+                        if self._closed:
+                            return
+                        continue
+                    self.emit('error', self, e)
+                    self.close()
+                    return
+                if self._zero_copy:
+                    self.emit('message', self, view[:n], address)
+                else:
+                    self.emit('message', self, view[:n].tobytes(), address)
+                if self._closed or self._paused:
+                    return
+        finally:
+            pool.release(buf)
+
+    def send(self, data, address):
+        '''queues the datagram if the kernel can't take it now. returns
+        False when the queue is above the high water mark, wait for 'drain'
+        before sending more'''
+        assert not self._closed
+        if not self._queue:
+            if self._sendto(data, address):
+                return True
+            if self._closed:
+                return False
+        if self._queue is None:
+            self._queue = collections.deque()
+        self._queue.append((data, address))
+        self._queued_size += len(data)
+        if not self._write_handler:
+            self._write_handler = self._loop.add_fd(self._socket, loop_.MODE_OUT, self._write_cb,
+                                                    self._poll_failed)
+        if self._queued_size > self._high_water_mark:
+            self._need_drain = True
+            return False
+        return True
+
+    def _sendto(self, data, address):
+        '''returns False if the socket is full. errors about this datagram
+        are emitted and the datagram dropped'''
+        try:
+            self._socket.sendto(data, address)
+            return True
+        except socket.error as e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN, errno.ENOBUFS):
+                return False
+            self.emit('error', self, e)
+            if e.args[0] not in _DATAGRAM_ERRORS:
+                self.close()
+                return False
+            return True
+
+    def _write_cb(self):
+        queue = self._queue
+        while queue:
+            data, address = queue[0]
+            sent = self._sendto(data, address)
+            if self._closed:
+                return
+            if not sent:
+                break
+            queue.popleft()
+            self._queued_size -= len(data)
+        if not queue:
+            self._queue = None
+            self._loop.remove_handler(self._write_handler)
+            self._write_handler = None
+        self._check_drain()
+
+    def _check_drain(self):
+        if self._need_drain and self._queued_size <= self._low_water_mark:
+            self._need_drain = False
+            self.emit('drain', self)
@@ -0,0 +1,386 @@
+#!/usr/bin/python
+
+''' asynchronous name resolution for SSLoop
+
+Resolver runs getaddrinfo in worker threads, or queries the nameservers of
+/etc/resolv.conf itself over UDP with udp=True. either way results are
+cached, failures too, and concurrent lookups of one name share a query '''
+
+import errno
+import socket
+import struct
+import random
+import logging
+import collections
+
+import loop as loop_
+import executor
+
+DEFAULT_TTL = 60  # getaddrinfo doesn't tell the TTL of records
+NEGATIVE_TTL = 10
+MAX_TTL = 3600
+MAX_CACHE_SIZE = 4096
+
+RESOLVER_THREADS = 4
+
+DNS_PORT = 53
+QUERY_TIMEOUT = 2
+QUERY_RETRIES = 2  # each retry goes to the next nameserver
+
+QTYPE_A = 1
+QTYPE_CNAME = 5
+QTYPE_AAAA = 28
+QCLASS_IN = 1
+
+RESOLV_CONF = '/etc/resolv.conf'
+HOSTS = '/etc/hosts'
+
+# query ids must not be predictable
+_random = random.SystemRandom()
+
+
+def _is_ip(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError, TypeError):
+            pass
+    return False
+
+
+class Resolver(object):
+    ''' resolve() calls back with the results of getaddrinfo '''
+
+    def __init__(self, loop, threads=RESOLVER_THREADS, udp=False):
+        self._loop = loop
+        self._cache = collections.OrderedDict()
+        # {key: (expires, error, addrs)}
+        self._pending = {}
+        # {key: [callback, ...]}
+        if udp:
+            self._lookup = UDPLookup(loop, self._done)
+        else:
+            self._lookup = ThreadedLookup(loop, self._done, threads)
+
+    def resolve(self, host, port, callback, family=0,
+                type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP):
+        ''' callback(error, addrs) is called from the loop, addrs is a
+        list of (family, type, proto, canonname, sockaddr) '''
+        key = (host, port, family, type, proto)
+        if _is_ip(host):
+            # no lookup needed
+            try:
+                addrs = socket.getaddrinfo(host, port, family, type, proto,
+                                           socket.AI_NUMERICHOST)
+                self._call(callback, None, addrs)
+            except socket.error as e:
+                self._call(callback, e, None)
+            return
+        entry = self._cache.get(key)
+        if entry is not None:
+            if entry[0] > self._loop.time():
+                self._call(callback, entry[1], entry[2])
+                return
+            del self._cache[key]
+        callbacks = self._pending.get(key)
+        if callbacks is not None:
+            callbacks.append(callback)
+            return
+        self._pending[key] = [callback]
+        self._lookup.lookup(key)
+
+    def _call(self, callback, error, addrs):
+        # always call back from the loop, even when the result is known
+        self._loop.add_callback(lambda: callback(error, addrs))
+
+    def _done(self, key, error, addrs, ttl=None):
+        if ttl is None:
+            ttl = NEGATIVE_TTL if error is not None else DEFAULT_TTL
+        if ttl > 0:
+            cache = self._cache
+            cache[key] = (self._loop.time() + min(ttl, MAX_TTL), error, addrs)
+            while len(cache) > MAX_CACHE_SIZE:
+                cache.popitem(last=False)
+        for callback in self._pending.pop(key, ()):
+            try:
+                callback(error, addrs)
+            except:
+                logging.exception('error when calling callback')
+
+    def clear_cache(self):
+        self._cache.clear()
+
+
+class ThreadedLookup(object):
+    ''' runs getaddrinfo in a thread pool of its own, so slow lookups don't
+    hold up loop.run_in_executor '''
+
+    def __init__(self, loop, done, threads):
+        self._done = done
+        self._pool = executor.ThreadPool(loop, threads)
+
+    def lookup(self, key):
+        self._pool.submit(socket.getaddrinfo, key,
+                          lambda error, addrs: self._done(key, error, addrs))
+
+
+def _read_nameservers():
+    servers = []
+    try:
+        with open(RESOLV_CONF) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == 'nameserver' and \
+                        _is_ip(parts[1]):
+                    servers.append(parts[1])
+    except IOError:
+        pass
+    return servers or ['127.0.0.1']
+
+
+def _read_hosts():
+    hosts = {}
+    try:
+        with open(HOSTS) as f:
+            for line in f:
+                parts = line.split('#', 1)[0].split()
+                if len(parts) >= 2 and _is_ip(parts[0]):
+                    for name in parts[1:]:
+                        hosts.setdefault(name.lower(), []).append(parts[0])
+    except IOError:
+        pass
+    return hosts
+
+
+def build_query(qid, name, qtype):
+    header = struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0)  # RD
+    labels = [b''.join([struct.pack('!B', len(label)), label])
+              for label in name.encode('idna').split(b'.') if label]
+    return b''.join([header] + labels + [b'\0', struct.pack('!HH', qtype,
+                                                            QCLASS_IN)])
+
+
+def _same_ip(a, b):
+    family = socket.AF_INET6 if ':' in a else socket.AF_INET
+    try:
+        return socket.inet_pton(family, a) == socket.inet_pton(family, b)
+    except (socket.error, ValueError):
+        return False
+
+
+def _read_name(data, offset):
+    '''returns the uncompressed name at offset, in lower case, and the
+    offset after it'''
+    labels = []
+    while True:
+        length = ord(data[offset:offset + 1])
+        if length == 0:
+            return b'.'.join(labels).lower(), offset + 1
+        if length & 0xc0:
+            raise ValueError('compressed name')
+        labels.append(data[offset + 1:offset + 1 + length])
+        offset += length + 1
+
+
+def _skip_name(data, offset):
+    while True:
+        length = ord(data[offset:offset + 1])
+        if length == 0:
+            return offset + 1
+        if length & 0xc0 == 0xc0:
+            # compression pointer
+            return offset + 2
+        offset += length + 1
+
+
+def parse_response(data):
+    ''' returns (qid, rcode, [(qname, qtype), ...], [(qtype, ttl, ip), ...])
+    '''
+    qid, flags, qdcount, ancount = struct.unpack('!HHHH', data[:8])
+    offset = 12
+    questions = []
+    for i in xrange(qdcount):
+        qname, offset = _read_name(data, offset)
+        qtype, qclass = struct.unpack('!HH', data[offset:offset + 4])
+        offset += 4
+        questions.append((qname, qtype))
+    answers = []
+    for i in xrange(ancount):
+        offset = _skip_name(data, offset)
+        rtype, rclass, ttl, rdlength = struct.unpack(
+            '!HHIH', data[offset:offset + 10])
+        offset += 10
+        rdata = data[offset:offset + rdlength]
+        offset += rdlength
+        if rclass != QCLASS_IN:
+            continue
+        if rtype == QTYPE_A and rdlength == 4:
+            answers.append((rtype, ttl, socket.inet_ntop(socket.AF_INET,
+                                                         rdata)))
+        elif rtype == QTYPE_AAAA and rdlength == 16:
+            answers.append((rtype, ttl, socket.inet_ntop(socket.AF_INET6,
+                                                         rdata)))
+    return qid, flags & 0xf, questions, answers
+
+
+class _Query(object):
+
+    def __init__(self, key, qtypes):
+        self.key = key
+        self.waiting = set(qtypes)
+        self.answers = []
+        self.errors = []
+        self.tries = 0
+        self.server = None  # nameserver of the current try
+        self.ids = {}  # {qid: qtype} of the current try
+        self.sock = None
+        self.read_handler = None
+        self.timeout_handler = None
+
+
+class UDPLookup(object):
+    ''' a small non-blocking DNS client, asking A and AAAA records of a name
+    to the nameservers of resolv.conf. /etc/hosts is honored, search
+    domains are not
+
+    each try of a query has a socket of its own, so an answer has to come
+    from the port the kernel picked at random, as well as from the
+    nameserver and with the random id and the question asked '''
+
+    def __init__(self, loop, done, nameservers=None, port=DNS_PORT):
+        self._loop = loop
+        self._done = done
+        self._nameservers = nameservers or _read_nameservers()
+        self._port = port
+        self._hosts = _read_hosts()
+
+    def lookup(self, key):
+        host, port, family, type, proto = key
+        ips = self._hosts.get(host.lower())
+        if ips:
+            self._finish_hosts(key, ips)
+            return
+        qtypes = []
+        if family in (0, socket.AF_INET):
+            qtypes.append(QTYPE_A)
+        if family in (0, socket.AF_INET6):
+            qtypes.append(QTYPE_AAAA)
+        query = _Query(key, qtypes)
+        self._send(query)
+
+    def _finish_hosts(self, key, ips):
+        host, port, family, type, proto = key
+        addrs = []
+        for ip in ips:
+            addr = self._sockaddr(ip, port, family, type, proto)
+            if addr is not None:
+                addrs.append(addr)
+        if addrs:
+            self._done(key, None, addrs)
+        else:
+            self._done(key, socket.gaierror(socket.EAI_NONAME,
+                                            'no address for %s' % host), None)
+
+    def _sockaddr(self, ip, port, family, type, proto):
+        if ':' in ip:
+            if family not in (0, socket.AF_INET6):
+                return None
+            return (socket.AF_INET6, type, proto, '', (ip, port, 0, 0))
+        if family not in (0, socket.AF_INET):
+            return None
+        return (socket.AF_INET, type, proto, '', (ip, port))
+
+    def _send(self, query):
+        self._close_socket(query)
+        server = self._nameservers[query.tries % len(self._nameservers)]
+        query.tries += 1
+        query.server = server
+        query.ids = {}
+        family = socket.AF_INET6 if ':' in server else socket.AF_INET
+        host = query.key[0]
+        try:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            query.sock = sock
+            sock.setblocking(False)
+            # the kernel drops datagrams from other addresses
+            sock.connect((server, self._port))
+            query.read_handler = self._loop.add_fd(
+                sock, loop_.MODE_IN, lambda: self._read_cb(query))
+            for qtype in query.waiting:
+                qid = _random.randint(0, 0xffff)
+                while qid in query.ids:
+                    qid = _random.randint(0, 0xffff)
+                query.ids[qid] = qtype
+                sock.send(build_query(qid, host, qtype))
+        except socket.error as e:
+            logging.warn('dns query to %s failed: %s', server, e)
+        query.timeout_handler = self._loop.add_timeout(
+            QUERY_TIMEOUT, lambda: self._timeout_cb(query))
+
+    def _close_socket(self, query):
+        if query.read_handler is not None:
+            self._loop.remove_handler(query.read_handler)
+            query.read_handler = None
+        if query.sock is not None:
+            query.sock.close()
+            query.sock = None
+
+    def _timeout_cb(self, query):
+        query.timeout_handler = None
+        if query.tries <= QUERY_RETRIES:
+            self._send(query)
+        else:
+            self._finish(query, socket.gaierror(socket.EAI_AGAIN,
+                                                'dns query timed out'))
+
+    def _read_cb(self, query):
+        sock = query.sock
+        qname = query.key[0].encode('idna').lower().strip(b'.')
+        while query.sock is sock:
+            try:
+                data, addr = sock.recvfrom(4096)
+            except socket.error as e:
+                if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    # the timeout will try the next nameserver
+                    logging.warn('dns receive from %s failed: %s',
+                                 query.server, e)
+                return
+            if addr[1] != self._port or not _same_ip(addr[0], query.server):
+                logging.warn('dns response from unexpected %s', addr[0])
+                continue
+            try:
+                qid, rcode, questions, answers = parse_response(data)
+            except (struct.error, TypeError, ValueError, IndexError):
+                logging.warn('invalid dns response from %s', addr[0])
+                continue
+            qtype = query.ids.get(qid)
+            if qtype is None or questions != [(qname, qtype)]:
+                logging.warn('dns response from %s not matching the query',
+                             addr[0])
+                continue
+            del query.ids[qid]
+            query.waiting.discard(qtype)
+            if rcode != 0:
+                query.errors.append(rcode)
+            query.answers.extend(answers)
+            if not query.waiting:
+                self._finish(query)
+
+    def _finish(self, query, error=None):
+        self._close_socket(query)
+        if query.timeout_handler is not None:
+            self._loop.remove_handler(query.timeout_handler)
+            query.timeout_handler = None
+        host, port, family, type, proto = query.key
+        addrs = []
+        ttl = None
+        for qtype, record_ttl, ip in query.answers:
+            addrs.append(self._sockaddr(ip, port, family, type, proto))
+            ttl = record_ttl if ttl is None else min(ttl, record_ttl)
+        if addrs:
+            self._done(query.key, None, addrs, ttl)
+        else:
+            self._done(query.key, error or socket.gaierror(
+                socket.EAI_NONAME, 'can not resolve hostname %s' % host),
+                None)
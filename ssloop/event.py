@@ -1,43 +1,105 @@
 #!/usr/bin/python
 
 import logging
-from collections import defaultdict
+
+
+class _Once(object):
+    '''a once() listener, as stored in the listener lists'''
+
+    __slots__ = ('callback',)
+
+    def __init__(self, callback):
+        self.callback = callback
 
 
 class EventEmitter(object):
+    ''' listeners of an event are called in the order they were added,
+    once() ones included '''
+
+    __slots__ = ('_events',)
+
+    # when False, exceptions raised by listeners go up to the caller of
+    # emit(), the loop most of the time, instead of being logged here.
+    # saves a try/except per listener, set it on a subclass
+    catch_errors = True
 
     def __init__(self):
-        self._events = defaultdict(list)
-        self._events_once = defaultdict(list)
+        self._events = None
+        # {event_name: [callback or _Once, ...]}, created by the first on()
+        # lists are replaced instead of modified, so emit() can iterate
+        # them while listeners add or remove listeners
 
     def on(self, event_name, callback):
-        self._events[event_name].append(callback)
+        self._add(event_name, callback)
 
     def once(self, event_name, callback):
-        self._events_once[event_name].append(callback)
+        '''callback is removed right before it is called'''
+        self._add(event_name, _Once(callback))
+
+    def _add(self, event_name, entry):
+        events = self._events
+        if events is None:
+            events = self._events = {}
+        listeners = events.get(event_name)
+        events[event_name] = listeners + [entry] if listeners else [entry]
+
+    def _remove_entry(self, event_name, entry):
+        events = self._events
+        if events is None:
+            return
+        listeners = events.get(event_name)
+        if listeners is None:
+            return
+        listeners = [e for e in listeners if e is not entry]
+        if listeners:
+            events[event_name] = listeners
+        else:
+            del events[event_name]
 
     def remove_listener(self, event_name, callback):
-        try:
-            self._events[event_name].remove(callback)
-        except ValueError:
-            pass
-        try:
-            self._events_once[event_name].remove(callback)
-        except ValueError:
-            pass
+        if self._events is None:
+            return
+        for entry in self._events.get(event_name, ()):
+            if entry == callback or \
+                    (entry.__class__ is _Once and entry.callback == callback):
+                self._remove_entry(event_name, entry)
+                return
 
     def remove_all_listeners(self, event_name=None):
-        self._events[event_name] = []
-        self._events_once[event_name] = []
-
-    def emit(self, event_name, *args, **kwargs):
-        for cb in self._events[event_name]:
-            try:
-                cb(*args, **kwargs)
-            except:
-                logging.exception('error when calling callback')
-        for cb in self._events_once[event_name]:
-            try:
-                cb(*args, **kwargs)
-            except:
-                logging.exception('error when calling callback')
+        '''of every event if event_name is None'''
+        if self._events is None:
+            return
+        if event_name is None:
+            self._events = None
+        else:
+            self._events.pop(event_name, None)
+
+    def listener_count(self, event_name):
+        if self._events is None:
+            return 0
+        return len(self._events.get(event_name, ()))
+
+    def emit(self, event_name, *args):
+        '''returns False if nobody listens to event_name'''
+        events = self._events
+        if events is None:
+            return False
+        listeners = events.get(event_name)
+        if listeners is None:
+            return False
+        if self.catch_errors:
+            for callback in listeners:
+                if callback.__class__ is _Once:
+                    self._remove_entry(event_name, callback)
+                    callback = callback.callback
+                try:
+                    callback(*args)
+                except:
+                    logging.exception('error when calling callback')
+        else:
+            for callback in listeners:
+                if callback.__class__ is _Once:
+                    self._remove_entry(event_name, callback)
+                    callback = callback.callback
+                callback(*args)
+        return True
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+
+''' thread pool behind SSLoop.run_in_executor '''
+
+import os
+import logging
+import threading
+import Queue
+
+MAX_WORKERS = 4
+
+
+class ThreadPool(object):
+    ''' runs calls in at most max_workers daemon threads, started as work
+    comes in, and calls back with the results from the loop '''
+
+    def __init__(self, loop, max_workers=MAX_WORKERS):
+        self._loop = loop
+        self.max_workers = max_workers
+        self._queue = None
+        self._workers = 0
+        self._idle = 0
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def submit(self, fn, args, callback):
+        ''' callback(error, result) is called from the loop, error being the
+        exception raised by fn if any '''
+        if self._pid != os.getpid():
+            # first use, or forked, the threads belong to the parent
+            self._pid = os.getpid()
+            self._queue = Queue.Queue()
+            self._lock = threading.Lock()
+            self._workers = 0
+            self._idle = 0
+        self._queue.put((fn, args, callback))
+        with self._lock:
+            if self._idle >= self._queue.qsize() or \
+                    self._workers >= self.max_workers:
+                return
+            self._workers += 1
+        thread = threading.Thread(target=self._work, args=(self._queue,))
+        thread.daemon = True
+        thread.start()
+
+    def _work(self, queue):
+        # keep references, as module globals may be gone at exit
+        lock, call_soon_threadsafe = self._lock, \
+            self._loop.call_soon_threadsafe
+        while True:
+            with lock:
+                self._idle += 1
+            fn, args, callback = queue.get()
+            with lock:
+                self._idle -= 1
+            try:
+                error, result = None, fn(*args)
+            except Exception as e:
+                logging.debug('executor call failed: %s', e)
+                error, result = e, None
+            if callback is not None:
+                call_soon_threadsafe(
+                    lambda callback=callback, error=error, result=result:
+                    callback(error, result))
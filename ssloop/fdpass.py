@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+''' passing fds over AF_UNIX sockets with SCM_RIGHTS, see Socket.send_fds()
+
+the socket module has sendmsg and recvmsg since python 3.3, before that
+they are called through ctypes, on linux only '''
+
+import array
+import ctypes
+import os
+import socket
+import struct
+import sys
+
+_has_sendmsg = hasattr(socket.socket, 'sendmsg')
+
+_INT_SIZE = array.array('i').itemsize
+
+_libc = None
+if not _has_sendmsg and sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc.sendmsg
+        _libc.recvmsg
+    except (OSError, AttributeError):
+        _libc = None
+
+available = _has_sendmsg or _libc is not None
+
+# from linux socket.h
+SCM_RIGHTS = getattr(socket, 'SCM_RIGHTS', 1)
+MSG_CTRUNC = getattr(socket, 'MSG_CTRUNC', 8)
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _cmsghdr(ctypes.Structure):
+    _fields_ = [('cmsg_len', ctypes.c_size_t),
+                ('cmsg_level', ctypes.c_int),
+                ('cmsg_type', ctypes.c_int)]
+
+
+def _cmsg_align(size):
+    align = ctypes.sizeof(ctypes.c_size_t)
+    return (size + align - 1) & ~(align - 1)
+
+
+def _cmsg_len(size):
+    return _cmsg_align(ctypes.sizeof(_cmsghdr)) + size
+
+
+def _cmsg_space(size):
+    return _cmsg_align(ctypes.sizeof(_cmsghdr)) + _cmsg_align(size)
+
+
+def _call(fn, fd, msg):
+    r = fn(fd, ctypes.byref(msg), 0)
+    if r < 0:
+        e = ctypes.get_errno()
+        raise socket.error(e, os.strerror(e))
+    return r
+
+
+def _fds_of(data):
+    n = len(data) // _INT_SIZE
+    return list(struct.unpack('%di' % n, data[:n * _INT_SIZE]))
+
+
+def send_fds(sock, data, fds):
+    '''sends data, with fds along with its first byte if fds isn't empty.
+    returns the bytes sent, raises socket.error like socket.send'''
+    if _has_sendmsg:
+        ancdata = []
+        if fds:
+            ancdata.append((socket.SOL_SOCKET, SCM_RIGHTS, array.array('i', fds)))
+        return sock.sendmsg([data], ancdata)
+    data = memoryview(data).tobytes()
+    buf = ctypes.create_string_buffer(data, len(data))
+    iov = _iovec(ctypes.cast(buf, ctypes.c_void_p), len(data))
+    msg = _msghdr(None, 0, ctypes.pointer(iov), 1, None, 0, 0)
+    if fds:
+        size = len(fds) * _INT_SIZE
+        control = ctypes.create_string_buffer(_cmsg_space(size))
+        header = _cmsghdr(_cmsg_len(size), socket.SOL_SOCKET, SCM_RIGHTS)
+        ctypes.memmove(control, ctypes.byref(header), ctypes.sizeof(header))
+        ctypes.memmove(ctypes.addressof(control) + _cmsg_len(0),
+                       struct.pack('%di' % len(fds), *fds), size)
+        msg.msg_control = ctypes.cast(control, ctypes.c_void_p)
+        msg.msg_controllen = len(control)
+    return _call(_libc.sendmsg, sock.fileno(), msg)
+
+
+def recv_fds_into(sock, view, max_fds):
+    '''receives into view, returns (bytes received, fds received, whether
+    fds beyond max_fds were dropped). raises socket.error like
+    socket.recv_into'''
+    if _has_sendmsg:
+        r, ancdata, flags, address = sock.recvmsg_into(
+            [view], socket.CMSG_SPACE(max_fds * _INT_SIZE))
+        fds = []
+        for level, type, data in ancdata:
+            if level == socket.SOL_SOCKET and type == SCM_RIGHTS:
+                fds.extend(_fds_of(data))
+        return r, fds, bool(flags & MSG_CTRUNC)
+    # ctypes can't write into a memoryview on python 2, receive into a
+    # buffer of its own and copy
+    size = len(view)
+    buf = ctypes.create_string_buffer(size)
+    iov = _iovec(ctypes.cast(buf, ctypes.c_void_p), size)
+    control = ctypes.create_string_buffer(_cmsg_space(max_fds * _INT_SIZE))
+    msg = _msghdr(None, 0, ctypes.pointer(iov), 1,
+                  ctypes.cast(control, ctypes.c_void_p), len(control), 0)
+    r = _call(_libc.recvmsg, sock.fileno(), msg)
+    view[:r] = buf.raw[:r]
+    fds = []
+    raw = control.raw[:msg.msg_controllen]
+    offset = 0
+    while offset + ctypes.sizeof(_cmsghdr) <= len(raw):
+        header = _cmsghdr.from_buffer_copy(raw[offset:offset + ctypes.sizeof(_cmsghdr)])
+        if header.cmsg_len < _cmsg_len(0):
+            break
+        if header.cmsg_level == socket.SOL_SOCKET and header.cmsg_type == SCM_RIGHTS:
+            fds.extend(_fds_of(raw[offset + _cmsg_len(0):offset + header.cmsg_len]))
+        offset += _cmsg_align(header.cmsg_len)
+    return r, fds, bool(msg.msg_flags & MSG_CTRUNC)
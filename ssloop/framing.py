@@ -0,0 +1,182 @@
+#!/usr/bin/python
+
+''' incremental decoders splitting a byte stream into frames, see
+Socket.set_framing()
+
+data is appended to one growable buffer, read from an offset, and a frame
+is copied out of it once complete. the consumed head is dropped only when
+more than half of the buffer, so the cost stays linear in the bytes
+received whatever the chunking '''
+
+import struct
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+_PREFIX_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+
+class FrameError(Exception):
+    '''a frame above max_frame_size, or a malformed length prefix'''
+
+
+class Decoder(object):
+    ''' base of the decoders. feed() buffers data, next_frame() returns
+    the next complete frame as a string, or None until there is one '''
+
+    __slots__ = ('max_frame_size', '_buf', '_start')
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buf = bytearray()
+        self._start = 0  # offset of the first byte not decoded yet
+
+    @property
+    def buffered(self):
+        '''bytes fed but not returned in a frame yet'''
+        return len(self._buf) - self._start
+
+    def feed(self, data):
+        self._buf += data
+
+    def next_frame(self):
+        buf = self._buf
+        start = self._start
+        if start == len(buf):
+            return None
+        r = self._parse(buf, start)
+        if r is None:
+            if start and start * 2 >= len(buf):
+                del buf[:start]
+                self._start = 0
+            return None
+        frame_start, frame_end, next_start = r
+        if frame_end - frame_start > self.max_frame_size:
+            raise FrameError('frame of %d bytes, above %d' %
+                             (frame_end - frame_start, self.max_frame_size))
+        frame = memoryview(buf)[frame_start:frame_end].tobytes()
+        if next_start == len(buf):
+            del buf[:]
+            self._start = 0
+        else:
+            self._start = next_start
+        return frame
+
+    def _parse(self, buf, start):
+        '''returns (frame start, frame end, start of the next frame) for the
+        frame at start in buf, or None if it's not complete'''
+        raise NotImplementedError()
+
+    def _check_incomplete(self, size):
+        # fail before buffering a frame too large
+        if size > self.max_frame_size:
+            raise FrameError('frame of %d bytes, above %d' %
+                             (size, self.max_frame_size))
+
+
+class DelimiterDecoder(Decoder):
+    ''' frames ended by delimiter, b'\\n' for lines. the delimiter is cut
+    off the frames unless keep_delimiter '''
+
+    __slots__ = ('delimiter', 'keep_delimiter', '_scanned')
+
+    def __init__(self, delimiter=b'\n', keep_delimiter=False,
+                 max_frame_size=MAX_FRAME_SIZE):
+        assert delimiter
+        super(DelimiterDecoder, self).__init__(max_frame_size)
+        self.delimiter = delimiter
+        self.keep_delimiter = keep_delimiter
+        # bytes after _start already searched, so each byte is searched once
+        self._scanned = 0
+
+    def _parse(self, buf, start):
+        delimiter = self.delimiter
+        i = buf.find(delimiter, start + self._scanned)
+        if i < 0:
+            self._scanned = max(len(buf) - start - len(delimiter) + 1, 0)
+            self._check_incomplete(len(buf) - start)
+            return None
+        self._scanned = 0
+        end = i + len(delimiter)
+        return start, end if self.keep_delimiter else i, end
+
+
+class LengthPrefixDecoder(Decoder):
+    ''' frames preceded by their length as an unsigned integer of
+    prefix_size bytes, 1, 2, 4 or 8, big endian unless little_endian. the
+    prefix is cut off the frames '''
+
+    __slots__ = ('_prefix',)
+
+    def __init__(self, prefix_size=4, little_endian=False,
+                 max_frame_size=MAX_FRAME_SIZE):
+        super(LengthPrefixDecoder, self).__init__(max_frame_size)
+        self._prefix = struct.Struct(('<' if little_endian else '>') +
+                                     _PREFIX_FORMATS[prefix_size])
+
+    def _parse(self, buf, start):
+        prefix = self._prefix
+        if len(buf) - start < prefix.size:
+            return None
+        size, = prefix.unpack_from(buf, start)
+        start += prefix.size
+        if len(buf) - start < size:
+            self._check_incomplete(size)
+            return None
+        return start, start + size, start + size
+
+
+class VarintDecoder(Decoder):
+    ''' frames preceded by their length as a base 128 varint, like
+    delimited protocol buffers. the prefix is cut off the frames '''
+
+    __slots__ = ()
+
+    # 10 bytes hold 64 bits
+    MAX_PREFIX_SIZE = 10
+
+    def _parse(self, buf, start):
+        size = 0
+        shift = 0
+        end = len(buf)
+        i = start
+        while True:
+            if i == end:
+                return None
+            byte = buf[i]
+            i += 1
+            size |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+            if i - start >= self.MAX_PREFIX_SIZE:
+                raise FrameError('varint prefix longer than %d bytes' %
+                                 self.MAX_PREFIX_SIZE)
+        if end - i < size:
+            self._check_incomplete(size)
+            return None
+        return i, i + size, i + size
+
+
+class FixedSizeDecoder(Decoder):
+    ''' frames of size bytes each '''
+
+    __slots__ = ('size',)
+
+    def __init__(self, size):
+        super(FixedSizeDecoder, self).__init__(size)
+        self.size = size
+
+    def _parse(self, buf, start):
+        if len(buf) - start < self.size:
+            return None
+        return start, start + self.size, start + self.size
+
+
+def encode_varint(n):
+    '''the varint prefix VarintDecoder reads'''
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
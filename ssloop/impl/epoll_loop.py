@@ -1,17 +1,35 @@
 #!/usr/bin/python
 
+import math
 import select
+import sys
 
 from ssloop.loop import SSLoop
 
+# python 2 truncates the timeout to milliseconds, waking up before the
+# deadline and then polling with a zero timeout until it's reached
+_truncates_timeout = sys.version_info[0] == 2
+
 
 class EpollLoop(SSLoop):
 
-    def __init__(self):
+    def __init__(self, edge_triggered=False):
+        '''when edge_triggered is True, Sockets register MODE_ET handlers for
+        both directions once, and drain them until EAGAIN'''
         super(EpollLoop, self).__init__()
         self._epoll = select.epoll()
+        self.edge_triggered = edge_triggered
+
+    def _reset_poller(self):
+        self._epoll.close()
+        self._epoll = select.epoll()
+
+    def _close_poller(self):
+        self._epoll.close()
 
     def _poll(self, timeout):
+        if timeout > 0 and _truncates_timeout:
+            timeout = (math.ceil(timeout * 1000) + 0.01) / 1000
         return self._epoll.poll(timeout)
 
     def _add_fd(self, fd, mode):
@@ -15,6 +15,14 @@ class KqueueLoop(SSLoop):
         self._kqueue = select.kqueue()
         self._fds = {}
 
+    def _reset_poller(self):
+        # kqueues are not inherited by children
+        self._kqueue = select.kqueue()
+        self._fds = {}
+
+    def _close_poller(self):
+        self._kqueue.close()
+
     def _control(self, fd, mode, flags):
         events = []
         if mode & loop.MODE_IN:
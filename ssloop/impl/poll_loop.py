@@ -0,0 +1,40 @@
+#!/usr/bin/python
+
+import math
+import select
+
+from ssloop.loop import SSLoop
+import ssloop.loop as loop
+
+# poll events are shorts, MODE_ET doesn't fit and POLLRDHUP is Linux only
+_MODE_MASK = 0xffff
+if not hasattr(select, 'POLLRDHUP'):
+    _MODE_MASK &= ~loop.MODE_RDHUP
+
+
+class PollLoop(SSLoop):
+    '''level triggered only, like SelectLoop, but without the FD_SETSIZE
+    limit and with one syscall per change'''
+
+    def __init__(self):
+        super(PollLoop, self).__init__()
+        self._poller = select.poll()
+
+    def _reset_poller(self):
+        self._poller = select.poll()
+
+    def _poll(self, timeout):
+        if timeout < 0:
+            return self._poller.poll()
+        # in milliseconds, rounded up so we don't wake up before the
+        # deadline and poll again with a zero timeout
+        return self._poller.poll(int(math.ceil(timeout * 1000)))
+
+    def _add_fd(self, fd, mode):
+        self._poller.register(fd, mode & _MODE_MASK)
+
+    def _remove_fd(self, fd):
+        self._poller.unregister(fd)
+
+    def _modify_fd(self, fd, mode):
+        self._poller.modify(fd, mode & _MODE_MASK)
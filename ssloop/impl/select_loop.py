@@ -6,6 +6,10 @@ from collections import defaultdict
 from ssloop.loop import SSLoop
 import ssloop.loop as loop
 
+# select() fails for every fd when one of them is above this, so they are
+# refused up front. 1024 on most systems, python doesn't tell
+FD_SETSIZE = 1024
+
 
 class SelectLoop(SSLoop):
 
@@ -15,8 +19,16 @@ class SelectLoop(SSLoop):
         self._w_list = set()
         self._x_list = set()
 
+    def _reset_poller(self):
+        self._r_list.clear()
+        self._w_list.clear()
+        self._x_list.clear()
+
     def _poll(self, timeout):
-        r, w, x = select.select(self._r_list, self._w_list, self._x_list)
+        if timeout < 0:
+            timeout = None  # select behaviour
+        r, w, x = select.select(self._r_list, self._w_list, self._x_list,
+                                timeout)
         results = defaultdict(lambda: loop.MODE_NULL)
         for p in [(r, loop.MODE_IN), (w, loop.MODE_OUT), (x, loop.MODE_ERR)]:
             for fd in p[0]:
@@ -24,6 +36,9 @@ class SelectLoop(SSLoop):
         return results.items()
 
     def _add_fd(self, fd, mode):
+        if fd >= FD_SETSIZE:
+            raise ValueError('fd %d is above FD_SETSIZE, use another '
+                             'backend' % fd)
         if mode & loop.MODE_IN:
             self._r_list.add(fd)
         if mode & loop.MODE_OUT:
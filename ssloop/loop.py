@@ -1,45 +1,81 @@
 #!/usr/bin/python
 
+import os
+import fcntl
 import select
 import time
+import errno
+import collections
 import heapq
+import itertools
 import logging
-from collections import defaultdict
 import sys
+import threading
 import traceback
+import timer
+import buffer
+import metrics
 
 
-''' You can only use instance(). Don't create a Loop() '''
+''' instance() is the loop of the current thread, sockets and servers use it
+unless given another one. SSLoop.new() makes a loop that isn't the instance
+of any thread, for a thread of its own for example '''
 
 _ssloop_cls = None
-_ssloop = None
+_local = threading.local()
+
+
+# in order of preference, named after their function in select
+BACKENDS = ('epoll', 'kqueue', 'poll', 'select')
 
 
 def instance():
-    global _ssloop
-    if _ssloop is not None:
-        return _ssloop
-    else:
-        init()
-        _ssloop = _ssloop_cls()
-        return _ssloop
+    '''the loop of the current thread, created on first use'''
+    loop = getattr(_local, 'loop', None)
+    if loop is None:
+        loop = _local.loop = SSLoop.new()
+    return loop
 
 
-def init():
-    global _ssloop_cls
+def set_instance(loop):
+    '''makes loop the instance() of the current thread, None forgets it'''
+    _local.loop = loop
+
 
-    if 'epoll' in select.__dict__:
+def available_backends():
+    return [name for name in BACKENDS if hasattr(select, name)]
+
+
+def backend_class(name):
+    '''the SSLoop subclass of a backend of BACKENDS'''
+    if name not in BACKENDS:
+        raise ValueError('unknown backend %s' % name)
+    if not hasattr(select, name):
+        raise ValueError('backend %s is not available here' % name)
+    if name == 'epoll':
         import impl.epoll_loop
-        logging.debug('using epoll')
-        _ssloop_cls = impl.epoll_loop.EpollLoop
-    elif 'kqueue' in select.__dict__:
+        return impl.epoll_loop.EpollLoop
+    elif name == 'kqueue':
         import impl.kqueue_loop
-        logging.debug('using kqueue')
-        _ssloop_cls = impl.kqueue_loop.KqueueLoop
+        return impl.kqueue_loop.KqueueLoop
+    elif name == 'poll':
+        import impl.poll_loop
+        return impl.poll_loop.PollLoop
     else:
         import impl.select_loop
-        logging.debug('using select')
-        _ssloop_cls = impl.select_loop.SelectLoop
+        return impl.select_loop.SelectLoop
+
+
+def init(backend=None):
+    '''chooses the backend of instance() and SSLoop.new(), call it before
+    they make a loop. backend defaults
+    to the SSLOOP_BACKEND environment variable, then to the first one
+    available'''
+    global _ssloop_cls
+    if backend is None:
+        backend = os.environ.get('SSLOOP_BACKEND') or available_backends()[0]
+    _ssloop_cls = backend_class(backend)
+    logging.debug('using %s', backend)
 
 
 # these values are defined as the same as poll
@@ -49,44 +85,252 @@ MODE_OUT = 0x04
 MODE_ERR = 0x08
 MODE_HUP = 0x10
 MODE_NVAL = 0x20
+MODE_RDHUP = 0x2000
+# only honored by backends that support edge triggered notifications
+MODE_ET = 1 << 31
+
+# rebuild the timeout heap when it has more tombstones than this and than
+# live timeouts
+COMPACT_THRESHOLD = 512
+
+CLOCK_MONOTONIC = 1  # linux
+
+
+def _find_monotonic():
+    '''time.monotonic, clock_gettime(CLOCK_MONOTONIC) through ctypes on
+    python 2, or as a last resort time.time, which jumps with the system
+    clock'''
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if not sys.platform.startswith('linux'):
+        return time.time
+    try:
+        import ctypes
+    except ImportError:
+        return time.time
+    clock_gettime = None
+    # in librt before glibc 2.17
+    for name in (None, 'librt.so.1'):
+        try:
+            clock_gettime = ctypes.CDLL(name, use_errno=True).clock_gettime
+            break
+        except (OSError, AttributeError):
+            pass
+    if clock_gettime is None:
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    def monotonic():
+        # not shared, loops of other threads call this too
+        ts = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+
+_monotonic = _find_monotonic()
+
+_has_eventfd = hasattr(os, 'eventfd')
 
 
 class Handler(object):
-    def __init__(self, callback, fd=None, mode=None, deadline=None, error=None):
+
+    __slots__ = ('callback', 'fd', 'mode', 'deadline', 'error', 'cancelled',
+                 'bucket', 'on_error')
+
+    def __init__(self, callback, fd=None, mode=None, deadline=None, error=None,
+                 on_error=None):
         '''deadline here is absolute timestamp'''
         self.callback = callback
         self.fd = fd
         self.mode = mode
-        self.deadline = 0
-        self.error = None  # a message describing the error
+        self.deadline = deadline
+        self.error = error  # the exception the poller refused the fd with
+        self.on_error = on_error
+        self.cancelled = False
+        self.bucket = None  # the timing wheel bucket holding this handler
+
+
+class FdRecord(object):
+    '''handlers of one fd, with their combined mode and the mode registered
+    in the poller'''
+
+    __slots__ = ('fd', 'handlers', 'mode', 'registered', 'dirty')
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.handlers = []
+        # replaced instead of modified, so it can be iterated while
+        # callbacks add or remove handlers
+        self.mode = MODE_NULL
+        self.registered = None  # None if not registered yet
+        self.dirty = False
+
+    def update_mode(self):
+        mode = MODE_NULL
+        for handler in self.handlers:
+            mode |= handler.mode
+        self.mode = mode
+
 
-    def __cmp__(self, other):
-        r = self.deadline - other.deadline
-        if r != 0:
-            return r
+class Waker(object):
+    '''an eventfd, or a pipe where there is none, for waking up the poller
+    from other threads and signal handlers'''
+    def __init__(self):
+        if _has_eventfd:
+            self._rfd = self._wfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
         else:
-            # We don't want to make lists think 2 handlers are equal
-            return id(self) - id(other)
+            self._rfd, self._wfd = os.pipe()
+            for fd in (self._rfd, self._wfd):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self._rfd
+
+    def wake(self):
+        try:
+            if _has_eventfd:
+                os.eventfd_write(self._wfd, 1)
+            else:
+                os.write(self._wfd, b'\0')
+        except OSError:
+            # pipe full, the loop will be woken up anyway
+            pass
+
+    def consume(self):
+        try:
+            if _has_eventfd:
+                os.eventfd_read(self._rfd)
+            else:
+                while os.read(self._rfd, 4096):
+                    pass
+        except OSError as e:
+            if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                raise
+
+    def close(self):
+        os.close(self._rfd)
+        if self._wfd != self._rfd:
+            os.close(self._wfd)
 
 
 class SSLoop(object):
 
+    # True if handlers registered with MODE_ET are notified only when the
+    # fd becomes ready, see EpollLoop
+    edge_triggered = False
+
+    # how much a socket may read per wakeup before yielding to other fds
+    read_budget = 256 * 1024
+    read_budget_calls = 16
+
     def __init__(self):
         self._handlers_with_no_fd = []
         # [handle1, handle2, ...]
 
         self._handlers_with_timeout = []
-        # [handle1, handle2, ...]
+        # heap of (deadline, seq, handler)
+        self._timeout_seq = itertools.count()
+        self._cancelled_timeouts = 0
+
+        self._wheel = None
+        # timer.TimingWheel for coarse timeouts, created lazily
+
+        self._time = None
+        # cached once per iteration while running
 
         self._stopped = False
 
-        self._fd_to_handler = defaultdict(list)
-        # {'fd1':[handler, handler, ...], 'fd2':[handler, handler, ...]}
+        self._fd_records = {}
+        # {fd1: FdRecord, fd2: FdRecord, ...}
+
+        self._dirty_records = []
+        # records whose mode is synced with the poller right before polling
 
         self._on_error = None
 
+        self.buffer_pool = buffer.BufferPool()
+        # receive buffers shared by the sockets of this loop
+
+        self._resolver = None
+
+        self._executor = None
+        # executor.ThreadPool of run_in_executor, created on first use
+
+        self.metrics = None
+        # metrics.LoopMetrics while enabled
+
+        self._threadsafe_callbacks = collections.deque()
+        self._wake_pending = False
+        self._waker = None
+        self._waker_handler = None
+        self._init_waker()
+
+    @classmethod
+    def new(cls, backend=None):
+        '''a new loop, not the instance() of any thread. SSLoop.new() makes
+        one of backend, or of the backend init() chose, a subclass one of
+        its own backend'''
+        if cls is SSLoop:
+            if backend is not None:
+                cls = backend_class(backend)
+            else:
+                if _ssloop_cls is None:
+                    init()
+                cls = _ssloop_cls
+        return cls()
+
+    def _init_waker(self):
+        # created up front, as other threads can't register it safely
+        self._waker = Waker()
+        self._waker_handler = self.add_fd(self._waker.fileno(), MODE_IN,
+                                          self._wakeup_cb)
+
+    @property
+    def resolver(self):
+        '''the dns.Resolver used by Socket.connect, created on first use'''
+        if self._resolver is None:
+            import dns
+            self._resolver = dns.Resolver(self)
+        return self._resolver
+
+    @resolver.setter
+    def resolver(self, resolver):
+        self._resolver = resolver
+
+    @property
+    def executor(self):
+        '''the executor.ThreadPool used by run_in_executor, created on first
+        use'''
+        if self._executor is None:
+            import executor
+            self._executor = executor.ThreadPool(self)
+        return self._executor
+
+    @executor.setter
+    def executor(self, executor):
+        self._executor = executor
+
+    def enable_metrics(self, slow_callback=metrics.SLOW_CALLBACK):
+        '''starts recording where the time of the loop goes, returns the
+        metrics.LoopMetrics, see its snapshot(). callbacks running for
+        slow_callback seconds or more are logged'''
+        self.metrics = metrics.LoopMetrics(self, slow_callback)
+        return self.metrics
+
+    def disable_metrics(self):
+        self.metrics = None
+
     def time(self):
-        return time.time()
+        '''monotonic time, cached once per loop iteration while running'''
+        if self._time is None:
+            return _monotonic()
+        return self._time
 
     def _poll(self, timeout):
         '''timeout here is timespan, -1 means forever'''
@@ -101,68 +345,192 @@ class SSLoop(object):
     def _modify_fd(self, fd, mode):
         raise NotImplementedError()
 
+    def _handle_error(self):
+        if self._on_error is not None:
+            self._on_error(sys.exc_info())
+        else:
+            traceback.print_exc()
+
     def _call_handler(self, handler):
+        if self.metrics is not None:
+            self.metrics.call(handler.callback, self._handle_error)
+            return
         try:
             handler.callback()
         except:
-            if self._on_error is not None:
-                self._on_error(sys.exc_info())
-            else:
-                traceback.print_exc()
-
-    def _get_fd_mode(self, fd):
-        mode = MODE_NULL
-        handlers = self._fd_to_handler[fd]
-        if handlers is None:
-            return None
-        for handler in handlers:
-            mode |= handler.mode
-        return mode
+            self._handle_error()
+
+    def _mark_dirty(self, record):
+        if not record.dirty:
+            record.dirty = True
+            self._dirty_records.append(record)
+
+    def after_fork(self):
+        '''call in a forked child before using the loop, so it doesn't share
+        the poller of the parent'''
+        self._reset_poller()
+        self._dirty_records = []
+        for record in self._fd_records.values():
+            record.registered = None
+            record.dirty = False
+            self._mark_dirty(record)
+        # the parent would be woken up by our waker
+        self.remove_handler(self._waker_handler)
+        self._waker.close()
+        self._wake_pending = False
+        self._init_waker()
+
+    def _reset_poller(self):
+        raise NotImplementedError()
 
-    def _update_fd(self, fd):
-        mode = self._get_fd_mode(fd)
-        if mode is not None:
-            self._modify_fd(fd, mode)
+    def close(self):
+        '''closes the fds of the loop itself, its waker and poller. call it
+        once stopped, after closing the sockets using it. the loop can't be
+        used after this'''
+        if self._waker is None:
+            return
+        self.remove_handler(self._waker_handler)
+        self._waker_handler = None
+        self._waker.close()
+        self._waker = None
+        # sockets closed later won't unregister from the closed poller
+        self._fd_records = {}
+        self._dirty_records = []
+        self._close_poller()
+
+    def _close_poller(self):
+        # select and poll have no fd
+        pass
+
+    def _flush_records(self):
+        '''sync modes with the poller, skipping records that didn't change'''
+        records = self._dirty_records
+        self._dirty_records = []
+        for record in records:
+            record.dirty = False
+            fd = record.fd
+            if self._fd_records.get(fd) is not record:
+                # removed since
+                continue
+            mode = record.mode
+            if mode == record.registered:
+                continue
+            try:
+                if record.registered is None:
+                    self._add_fd(fd, mode)
+                else:
+                    self._modify_fd(fd, mode)
+            except (IOError, OSError, ValueError) as e:
+                # the fd can't be polled, give up its handlers and let their
+                # owners know
+                del self._fd_records[fd]
+                handled = False
+                for handler in record.handlers:
+                    handler.cancelled = True
+                    handler.error = e
+                    if handler.on_error is not None:
+                        handled = True
+                        self.add_callback(lambda handler=handler: handler.on_error(handler))
+                if handled:
+                    logging.warn('can not poll fd %d: %s', fd, e)
+                else:
+                    self._handle_error()
+                continue
+            record.registered = mode
+
+    def _run_timeouts(self):
+        now = self._time
+        heap = self._handlers_with_timeout
+        expired = []
+        while heap and heap[0][0] <= now:
+            handler = heapq.heappop(heap)[2]
+            if handler.cancelled:
+                self._cancelled_timeouts -= 1
+            else:
+                handler.cancelled = True
+                expired.append(handler)
+        if self._wheel is not None:
+            for handler in self._wheel.advance(now):
+                handler.cancelled = True
+                expired.append(handler)
+        if self.metrics is not None:
+            for handler in expired:
+                self.metrics.timer_fired(now - handler.deadline)
+        # call them after collecting, so timeouts added by these callbacks
+        # will wait for the next iteration
+        for handler in expired:
+            self._call_handler(handler)
+
+    def _next_timeout(self):
+        if self._handlers_with_no_fd:
+            return 0
+        heap = self._handlers_with_timeout
+        # drop cancelled timeouts so they don't wake us up
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self._cancelled_timeouts -= 1
+        deadline = heap[0][0] if heap else None
+        if self._wheel is not None:
+            wheel_deadline = self._wheel.next_deadline()
+            if wheel_deadline is not None and \
+                    (deadline is None or wheel_deadline < deadline):
+                deadline = wheel_deadline
+        if deadline is None:
+            return -1
+        return max(deadline - self._time, 0)
 
     def start(self):
         self._stopped = False
-        while not self._stopped:
-            # TODO make a copy of these handlers before iterating on them
-
-            # call handlers timed out
-            # notice that handlers with timeout are called first than handlers without fd
-            cur_time = self.time()
-            while len(self._handlers_with_timeout) > 0:
-                handler = heapq.heappop(self._handlers_with_no_fd)
-                if handler.deadline <= cur_time:
-                    self._handlers_with_timeout.remove(handler)
-                    self._call_handler(handler)
-                else:
-                    # because the queue is sorted
+        self._time = _monotonic()
+        try:
+            while not self._stopped:
+                # call handlers timed out
+                # notice that handlers with timeout are called first than handlers without fd
+                self._run_timeouts()
+
+                # call handlers without fd
+                handlers = self._handlers_with_no_fd
+                if handlers:
+                    self._handlers_with_no_fd = []
+                    for handler in handlers:
+                        if not handler.cancelled:
+                            self._call_handler(handler)
+                if self._stopped:
                     break
 
-            # call handlers without fd
-            for handler in self._handlers_with_no_fd:
-                self._call_handler(handler)
-            self._handlers_with_no_fd = []
-
-            cur_time = self.time()
-            if len(self._handlers_with_timeout) > 0:
-                next_deadline = self._handlers_with_timeout[0].deadline
-                timeout = next_deadline - cur_time
-                if timeout < 0:
-                    timeout = 0
-            else:
-                timeout = -1
-
-            # poll handlers with fd
-            fds_ready = self._poll(timeout)
-            for fd, mode in fds_ready:
-                handlers = self._fd_to_handler[fd]
-                for handler in handlers:
-                    if handler.mode & mode != 0:
-                        logging.debug('calling %s' % handler)
-                        self._call_handler(handler)
+                # poll handlers with fd
+                if self._dirty_records:
+                    self._flush_records()
+                # the callbacks may have taken a while, timers would fire
+                # late by that much
+                self._time = _monotonic()
+                timeout = self._next_timeout()
+                loop_metrics = self.metrics
+                if loop_metrics is not None:
+                    poll_start = _monotonic()
+                try:
+                    fds_ready = self._poll(timeout)
+                except (select.error, IOError, OSError) as e:
+                    # interrupted by a signal
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    fds_ready = []
+                self._time = _monotonic()
+                if loop_metrics is not None:
+                    loop_metrics.polled(self._time - poll_start, len(fds_ready))
+                records = self._fd_records
+                for fd, mode in fds_ready:
+                    record = records.get(fd)
+                    if record is None:
+                        continue
+                    if mode & (MODE_ERR | MODE_HUP):
+                        # let every handler see the error
+                        mode |= record.mode
+                    for handler in record.handlers:
+                        if handler.mode & mode != 0 and not handler.cancelled:
+                            self._call_handler(handler)
+        finally:
+            self._time = None
 
     def stop(self):
         self._stopped = True
@@ -172,43 +540,110 @@ class SSLoop(object):
         self._handlers_with_no_fd.append(handler)
         return handler
 
-    def add_timeout(self, timeout, callback):
+    def call_soon_threadsafe(self, callback):
+        '''add_callback() for other threads and signal handlers, wakes up
+        the loop if it is polling'''
+        # append before checking the flag, _wakeup_cb clears it after
+        # reading the waker and before running the callbacks, so none of
+        # them can be missed
+        self._threadsafe_callbacks.append(callback)
+        if not self._wake_pending:
+            self._wake_pending = True
+            self._waker.wake()
+
+    def _wakeup_cb(self):
+        self._waker.consume()
+        self._wake_pending = False
+        callbacks = self._threadsafe_callbacks
+        for i in xrange(len(callbacks)):
+            callback = callbacks.popleft()
+            try:
+                callback()
+            except:
+                self._handle_error()
+
+    def run_in_executor(self, fn, *args, **kwargs):
+        '''runs fn(*args) in the thread pool of the loop, then calls
+        callback(error, result) from the loop. keeps blocking or CPU heavy
+        calls from stalling the other sockets'''
+        callback = kwargs.pop('callback', None)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments %s' % kwargs.keys())
+        self.executor.submit(fn, args, callback)
+
+    def add_timeout(self, timeout, callback, coarse=False):
+        '''coarse timeouts go to a timing wheel with DEFAULT_RESOLUTION
+        precision, use them for idle/read timeouts that are mostly removed
+        before they expire'''
         handler = Handler(callback, deadline=self.time() + timeout)
-        # sort timeouts in order
-        heapq.heappush(self._handlers_with_timeout, handler)
+        if coarse:
+            if self._wheel is None:
+                self._wheel = timer.TimingWheel(self.time())
+            self._wheel.add(handler)
+        else:
+            # sort timeouts in order
+            heapq.heappush(self._handlers_with_timeout,
+                           (handler.deadline, next(self._timeout_seq), handler))
         return handler
 
-    def add_fd(self, fd, mode, callback):
+    def _remove_timeout(self, handler):
+        if handler.bucket is not None:
+            self._wheel.remove(handler)
+            return
+        # leave a tombstone in the heap, and rebuild the heap when most of
+        # it is made of tombstones
+        self._cancelled_timeouts += 1
+        heap = self._handlers_with_timeout
+        if self._cancelled_timeouts > COMPACT_THRESHOLD and \
+                self._cancelled_timeouts * 2 > len(heap):
+            heap[:] = [t for t in heap if not t[2].cancelled]
+            heapq.heapify(heap)
+            self._cancelled_timeouts = 0
+
+    def add_fd(self, fd, mode, callback, on_error=None):
+        '''if the poller refuses fd, the handler is removed and
+        on_error(handler) is called from the loop, handler.error being the
+        exception'''
         if not (isinstance(fd, int) or isinstance(fd, long)):
             fd = fd.fileno()
-        handler = Handler(callback, fd=fd, mode=mode)
-        l = self._fd_to_handler[fd]
-        l.append(handler)
-        if len(l) == 1:
-            self._add_fd(fd, mode)
-        else:
-            self._update_fd(fd)
+        handler = Handler(callback, fd=fd, mode=mode, on_error=on_error)
+        record = self._fd_records.get(fd)
+        if record is None:
+            record = self._fd_records[fd] = FdRecord(fd)
+        record.handlers = record.handlers + [handler]
+        record.mode |= mode
+        self._mark_dirty(record)
         return handler
 
     def update_handler_mode(self, handler, mode):
+        if handler.cancelled or handler.mode == mode:
+            return
         handler.mode = mode
-        self._update_fd(handler.fd)
+        record = self._fd_records[handler.fd]
+        record.update_mode()
+        self._mark_dirty(record)
 
     def remove_handler(self, handler):
         # TODO: handle exceptions friendly
-        if handler.deadline:
-            self._handlers_with_timeout.remove(handler)
-        elif handler.fd:
+        if handler.cancelled:
+            # already removed or fired
+            return
+        handler.cancelled = True
+        if handler.deadline is not None:
+            self._remove_timeout(handler)
+        elif handler.fd is not None:
             fd = handler.fd
-            if not (isinstance(fd, int) or isinstance(fd, long)):
-                fd = fd.fileno()
-            l = self._fd_to_handler[fd]
-            # TODO: handle exceptions friendly
-            l.remove(handler)
-            if len(l) == 0:
-                self._remove_fd(fd)
-                del self._fd_to_handler[fd]
+            record = self._fd_records.get(fd)
+            if record is None:
+                return
+            record.handlers = [h for h in record.handlers if h is not handler]
+            if record.handlers:
+                record.update_mode()
+                self._mark_dirty(record)
             else:
-                self._update_fd(fd)
-        else:
-            self._handlers_with_no_fd.remove(handler)
+                # unregister now rather than before the next poll, as the
+                # caller is likely to close the fd right after this
+                del self._fd_records[fd]
+                if record.registered is not None:
+                    self._remove_fd(fd)
+        # handlers without fd are skipped when cancelled
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+''' opt-in instrumentation of SSLoop, see SSLoop.enable_metrics()
+
+counters are cumulative since enabled, so a scraper computes rates from
+two snapshots. histograms have fixed buckets and never grow '''
+
+import bisect
+import logging
+
+# loop imports this module, _monotonic is looked up once both are loaded
+import loop as loop_
+
+# upper bounds of the buckets of latency histograms, in seconds: 10us to
+# about 10s, doubling. values above the last one go in an extra bucket
+LATENCY_BOUNDS = tuple(0.00001 * 2 ** i for i in xrange(21))
+
+# upper bounds of the buckets of ready fds per poll
+COUNT_BOUNDS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+SLOW_CALLBACK = 0.1
+
+
+class Histogram(object):
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        '''upper bound of the bucket holding the q-th percentile, 0 <= q <=
+        1. only as precise as the buckets, and max for the last one'''
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                break
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'buckets': list(self.counts),
+        }
+
+
+_names = {}  # {(code, class of the bound object): name}
+
+
+def callback_name(callback):
+    '''module.Class.method or module.function of a callback, lambdas get
+    their file and line as they are all named <lambda>'''
+    func = getattr(callback, '__func__', callback)
+    code = getattr(func, '__code__', None)
+    if code is None:
+        # partial, or an object with __call__
+        cls = type(callback)
+        return '%s.%s' % (cls.__module__, cls.__name__)
+    owner = getattr(callback, '__self__', None)
+    key = (code, type(owner))
+    name = _names.get(key)
+    if name is None:
+        name = getattr(func, '__qualname__', None)
+        if name is None:
+            name = func.__name__
+            if owner is not None:
+                name = '%s.%s' % (type(owner).__name__, name)
+        if '<lambda>' in name:
+            name = '%s@%s:%d' % (name, code.co_filename, code.co_firstlineno)
+        name = '%s.%s' % (func.__module__, name)
+        _names[key] = name
+    return name
+
+
+class LoopMetrics(object):
+    ''' what the loop did with its time. callbacks taking slow_callback
+    seconds or more are logged, None disables it '''
+
+    def __init__(self, loop, slow_callback=SLOW_CALLBACK):
+        self._loop = loop
+        self.slow_callback = slow_callback
+        self.reset()
+
+    def reset(self):
+        self.iterations = 0
+        self.poll_time = 0
+        self.poll_wait = Histogram()
+        self.ready_fds = Histogram(COUNT_BOUNDS)
+        self.timer_lateness = Histogram()
+        self.callbacks = {}  # {name: Histogram}
+        self.slow_callbacks = 0
+
+    def polled(self, elapsed, ready):
+        self.iterations += 1
+        self.poll_time += elapsed
+        self.poll_wait.add(elapsed)
+        self.ready_fds.add(ready)
+
+    def timer_fired(self, lateness):
+        self.timer_lateness.add(max(lateness, 0))
+
+    def call(self, callback, on_error):
+        start = loop_._monotonic()
+        try:
+            callback()
+        except:
+            on_error()
+        elapsed = loop_._monotonic() - start
+        name = callback_name(callback)
+        histogram = self.callbacks.get(name)
+        if histogram is None:
+            histogram = self.callbacks[name] = Histogram()
+        histogram.add(elapsed)
+        if self.slow_callback is not None and elapsed >= self.slow_callback:
+            self.slow_callbacks += 1
+            logging.warn('slow callback %s took %.3fs', name, elapsed)
+
+    def snapshot(self):
+        '''a dict of plain values, safe to keep or serialize'''
+        loop = self._loop
+        timers = len(loop._handlers_with_timeout) - loop._cancelled_timeouts
+        if loop._wheel is not None:
+            timers += loop._wheel.count
+        return {
+            'iterations': self.iterations,
+            'poll_time': self.poll_time,
+            'poll_wait': self.poll_wait.snapshot(),
+            'ready_fds': self.ready_fds.snapshot(),
+            'timer_lateness': self.timer_lateness.snapshot(),
+            'callbacks': dict((name, histogram.snapshot()) for name, histogram
+                              in self.callbacks.iteritems()),
+            'slow_callbacks': self.slow_callbacks,
+            'fds': len(loop._fd_records),
+            'timers': timers,
+            'pending_callbacks': len(loop._handlers_with_no_fd),
+        }
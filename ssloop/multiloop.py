@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+''' a Server spreading its connections over loops running in threads '''
+
+import logging
+import threading
+
+import loop as loop_
+import net
+
+THREADS = 4
+
+ROUND_ROBIN = 'round_robin'
+LEAST_LOADED = 'least_loaded'
+
+
+class _LoopThread(object):
+    '''a loop of a MultiLoopServer and its thread'''
+
+    def __init__(self, server, index):
+        self.server = server
+        # same backend and settings as the loop accepting
+        self.loop = server._loop.new()
+        self.loop.edge_triggered = server._loop.edge_triggered
+        self.loop.read_budget = server._loop.read_budget
+        self.loop.read_budget_calls = server._loop.read_budget_calls
+        # open sockets handed to this loop, as known by the accepting thread
+        self.load = 0
+        self.thread = threading.Thread(target=self._run,
+                                       name='ssloop-%d' % index)
+        self.thread.daemon = True
+
+    def _run(self):
+        loop_.set_instance(self.loop)
+        self.loop.start()
+        logging.debug('%s stopped', self.thread.name)
+
+    def adopt(self, conn):
+        # in the thread of the loop
+        server = self.server
+        sockobj = net.Socket(loop=self.loop, sock=conn)
+        sockobj._server = self
+        server.emit('connection', server, sockobj)
+
+    def _connection_closed(self, sockobj):
+        # called by Socket.close() in the thread of the loop. the counts are
+        # kept by the accepting thread
+        server = self.server
+        if server is None:
+            # closed
+            return
+        server._loop.call_soon_threadsafe(lambda: server._handed_closed(self))
+
+
+class MultiLoopServer(net.Server):
+    ''' accepts in its loop, of the thread calling listen(), and hands the
+    sockets over to loops running in threads of their own, round robin or
+    to the one with the fewest open sockets
+
+    'connection' is emitted in the thread of the loop of the socket, where
+    instance() is that loop, so sockets made by the listener without a loop
+    go to the same one. threads help as far as the work releases the GIL:
+    system calls, hashing, compression, ssl '''
+
+    __slots__ = ('_threads', '_balance', '_next')
+
+    def __init__(self, address, threads=THREADS, balance=ROUND_ROBIN,
+                 loop=None, max_connections=None):
+        assert balance in (ROUND_ROBIN, LEAST_LOADED)
+        super(MultiLoopServer, self).__init__(address, loop=loop,
+                                              max_connections=max_connections)
+        self._balance = balance
+        self._next = 0
+        self._threads = [_LoopThread(self, i) for i in xrange(threads)]
+
+    @property
+    def loops(self):
+        return [t.loop for t in self._threads]
+
+    def listen(self, backlog=128):
+        for t in self._threads:
+            t.thread.start()
+        super(MultiLoopServer, self).listen(backlog)
+
+    def _accepted(self, conn):
+        threads = self._threads
+        if self._balance == LEAST_LOADED:
+            t = min(threads, key=lambda t: t.load)
+        else:
+            t = threads[self._next]
+            self._next = (self._next + 1) % len(threads)
+        t.load += 1
+        t.loop.call_soon_threadsafe(lambda: t.adopt(conn))
+
+    def _handed_closed(self, t):
+        t.load -= 1
+        self._connection_closed(None)
+
+    def close(self):
+        '''also stops the loop threads and closes their loops, the sockets
+        they still have are left open'''
+        super(MultiLoopServer, self).close()
+        for t in self._threads:
+            if t.thread.is_alive():
+                t.loop.call_soon_threadsafe(t.loop.stop)
+        for t in self._threads:
+            if t.thread is threading.current_thread():
+                continue
+            if t.thread.is_alive():
+                t.thread.join()
+            t.loop.close()
+            # the server and its threads refer to each other
+            t.server = None
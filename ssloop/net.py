@@ -1,12 +1,18 @@
 #!/usr/bin/python
 
+import os
+import stat
 import socket
 import event
+import fdpass
+import framing
+import sendfile
 import loop as loop_
 from loop import instance
 import logging
 import collections
 import errno
+import itertools
 
 STATE_CLOSED = 0
 STATE_INITIALIZED = 1
@@ -15,21 +21,116 @@ STATE_STREAMING = 4
 STATE_LISTENING = 8
 STATE_CLOSING = 16  # half close, write only
 
-RECV_BUFSIZE = 4096
+RECV_BUFSIZE = 4096  # initial size of each recv, adapted per socket
+MIN_RECV_BUFSIZE = 1024
+
+# write() returns False above the high water mark, and 'drain' is emitted
+# once the buffer drops to the low water mark after that
+HIGH_WATER_MARK = 64 * 1024
+LOW_WATER_MARK = 16 * 1024
+
+IOV_MAX = 64  # max buffers gathered by one sendmsg
+
+_has_sendmsg = hasattr(socket.socket, 'sendmsg')
+
+# without sendmsg, python 2, small buffers are copied together up to this
+# size instead, one send of a few KB costs more than the copy
+GATHER_SIZE = 16 * 1024
+
+SENDFILE_CHUNK = 1024 * 1024  # max bytes per sendfile call
+
+_has_sendfile = sendfile.available
+
+ACCEPT_BATCH = 64  # max connections accepted per readiness event
+
+# connect() starts the next attempt if the current one hasn't succeeded
+# after this long, without giving up on it (RFC 8305)
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+_has_unix = hasattr(socket, 'AF_UNIX')
+
+_has_fd_passing = fdpass.available
+
+MAX_FDS = 64  # max fds received per message
+
+
+def _is_unix_address(address):
+    '''paths are AF_UNIX addresses, (host, port) are TCP ones'''
+    return isinstance(address, basestring)
+
+
+class _FileRange(object):
+    '''a send_file() request, queued in Socket._buffers'''
+
+    def __init__(self, fileobj, offset, count):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.remaining = count  # None means until EOF
+        try:
+            self.fd = fileobj.fileno()
+        except (AttributeError, IOError, OSError, ValueError):
+            # not a real file, read it in chunks
+            self.fd = None
+
+
+class _FdMessage(object):
+    '''a send_fds() request, queued in Socket._buffers'''
+
+    def __init__(self, fds, data):
+        self.fds = fds  # dups of the fds to send, None once sent
+        self.data = data
 
 
 class Socket(event.EventEmitter):
-    ''' currently TCP, IPv4 only'''
+    ''' TCP over IPv4 or IPv6, or AF_UNIX stream when connected to a path'''
+
+    # an idle server may hold a lot of these
+    __slots__ = ('_socket', '_loop', '_buffers', '_buffer_offset',
+                 '_buffered_size', '_high_water_mark', '_low_water_mark',
+                 '_need_drain', '_state', '_connector',
+                 '_connect_timeout_handler', '_read_handler', '_write_handler',
+                 '_paused', '_zero_copy', '_read_size', '_small_reads',
+                 '_read_again_handler', '_pipe', '_read_mode',
+                 '_edge_triggered', '_server', '_receive_fds', '_framing',
+                 'allow_half_open', '_end_pending', '_shutdown_pending',
+                 '_eof', '_write_shut')
 
     def __init__(self, loop=None, sock=None):
         super(Socket, self).__init__()
         self._socket = None
         self._loop = loop if loop is not None else instance()
-        self._buffers = collections.deque()
+        self._buffers = None
+        # deque of data waiting to be sent, None when there is none
+        self._buffer_offset = 0  # bytes of _buffers[0] already sent
+        self._buffered_size = 0
+        self._high_water_mark = HIGH_WATER_MARK
+        self._low_water_mark = LOW_WATER_MARK
+        self._need_drain = False
         self._state = STATE_INITIALIZED
-        self._connect_handler = None
+        self._connector = None
+        self._connect_timeout_handler = None
+        self._read_handler = None
         self._write_handler = None
         self._paused = False
+        self._zero_copy = False
+        self._read_size = RECV_BUFSIZE
+        self._small_reads = 0
+        self._read_again_handler = None
+        self._pipe = None
+        self._read_mode = loop_.MODE_IN
+        # edge triggered sockets keep the write handler registered, and
+        # only wait for it when the last write would block
+        self._edge_triggered = False
+        self._server = None  # the Server that accepted this socket
+        self._receive_fds = False
+        self._framing = None
+        # when the peer ends, keep the socket open for writing until end()
+        # is called too, and make end() only shut down the write side
+        self.allow_half_open = False
+        self._end_pending = False  # end() called while connecting
+        self._shutdown_pending = False  # shut down once the data is sent
+        self._eof = False  # the peer ended, with allow_half_open
+        self._write_shut = False
 
         if sock is None:
             # create socket lazily
@@ -41,13 +142,23 @@ class Socket(event.EventEmitter):
             self._init_streaming()
 
     def __del__(self):
-        self.close()
+        if self._state != STATE_CLOSED:
+            self.close()
 
     def resume(self):
         assert self._state in (STATE_INITIALIZED, STATE_CONNECTING, STATE_STREAMING, STATE_CLOSING)
-        if self._paused:
+        if self._paused and not self._eof:
             self._paused = False
-            self._read_handler = self._loop.add_fd(self._socket, loop_.MODE_IN, self._read_cb)
+            self._read_handler = self._loop.add_fd(self._socket, self._read_mode, self._read_cb,
+                                                   self._poll_failed)
+            if self._edge_triggered and self._state == STATE_STREAMING:
+                # an edge triggered fd that was readable before the pause
+                # won't be reported again, the registered mode may not even
+                # change
+                self._read_later()
+            if self._framing is not None and self._framing.buffered:
+                # frames decoded before the pause
+                self._loop.add_callback(self._emit_frames)
 
     def pause(self):
         assert self._state in (STATE_INITIALIZED, STATE_CONNECTING, STATE_STREAMING, STATE_CLOSING)
@@ -55,24 +166,108 @@ class Socket(event.EventEmitter):
             self._paused = True
             self._loop.remove_handler(self._read_handler)
             self._read_handler = None
+            self._cancel_read_again()
+
+    def set_zero_copy(self, enabled=True):
+        '''deliver 'data' as a memoryview of a pooled buffer instead of a
+        string. the view is only valid until the callback returns'''
+        self._zero_copy = enabled
+
+    def set_water_marks(self, high, low):
+        assert 0 <= low <= high
+        self._high_water_mark = high
+        self._low_water_mark = low
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def set_receive_fds(self, enabled=True):
+        '''on AF_UNIX sockets, accept fds passed with SCM_RIGHTS, emitting
+        'fds' (sock, [fd, ...]) before the 'data' they came with. the
+        listener owns the fds and has to close them. needs python 3, or
+        linux'''
+        if enabled and not _has_fd_passing:
+            raise NotImplementedError('fd passing needs recvmsg')
+        self._receive_fds = enabled
+
+    def set_framing(self, decoder):
+        '''splits what is received into frames with a framing.Decoder and
+        emits 'message' (sock, frame) for each, instead of 'data'. a frame
+        the decoder rejects is an error. None goes back to 'data', dropping
+        what the decoder buffered'''
+        self._framing = decoder
+
+    @property
+    def buffered_size(self):
+        '''bytes written but not sent yet'''
+        return self._buffered_size
+
+    def pipe(self, dst):
+        '''forwards everything received to the Socket dst, pausing while dst
+        is above its high water mark, and ends dst when this socket ends.
+        closing dst closes this socket. 'data' isn't emitted while piping.
+        returns dst
+
+        dst is set to allow_half_open, so a.pipe(b); b.pipe(a) relays a
+        half close both ways'''
+        assert self._pipe is None
+        dst.allow_half_open = True
+        self._pipe = _Pipe(self, dst)
+        return dst
 
     def end(self):
+        '''closes the socket once the data written is sent. with
+        allow_half_open, shuts down its write side instead, and keeps
+        reading until the peer ends too'''
         assert self._state in (STATE_INITIALIZED, STATE_CONNECTING, STATE_STREAMING)
-        if self._state in (STATE_INITIALIZED, STATE_CONNECTING):
+        if self._state == STATE_CONNECTING:
+            if self._buffers or self.allow_half_open:
+                # finished by _connect_cb, after sending what was written
+                self._end_pending = True
+            else:
+                self.close()
+        elif self._state == STATE_INITIALIZED:
             self.close()
-        else:
+        elif self.allow_half_open:
+            if self._write_shut:
+                return
             if self._buffers:
-                logging.debug('wait for writing before closing')
-                self._state = STATE_CLOSING
+                self._shutdown_pending = True
             else:
-                self.close()
+                self._shutdown_write()
+        elif self._buffers:
+            logging.debug('wait for writing before closing')
+            self._state = STATE_CLOSING
+        else:
+            self.close()
+
+    def _shutdown_write(self):
+        self._shutdown_pending = False
+        self._write_shut = True
+        if self._eof:
+            # both sides are done
+            self.close()
+            return
+        try:
+            self._socket.shutdown(socket.SHUT_WR)
+        except socket.error as e:
+            self._error(e)
+
+    def _end_if_pending(self):
+        # after the connect, the data written while connecting being sent
+        if self._end_pending and self._state == STATE_STREAMING:
+            self._end_pending = False
+            self.end()
 
     def close(self):
         if self._state in (STATE_INITIALIZED, STATE_CONNECTING, STATE_STREAMING, STATE_CLOSING):
             # TODO remove handlers
             if self._state == STATE_CONNECTING:
-                self._loop.remove_handler(self._connect_handler)
-                self._connect_handler = None
+                if self._connector:
+                    # else still resolving
+                    self._connector.cancel()
+                    self._connector = None
+                self._cancel_connect_timeout()
             elif self._state == STATE_STREAMING or self._state == STATE_CLOSING:
                 if self._read_handler:
                     if not self._paused:
@@ -81,10 +276,20 @@ class Socket(event.EventEmitter):
                 if self._write_handler:
                     self._loop.remove_handler(self._write_handler)
                     self._write_handler = None
+                self._cancel_read_again()
 
             if self._socket is not None:
                 self._socket.close()
             self._state = STATE_CLOSED
+            if self._buffers:
+                for item in self._buffers:
+                    if item.__class__ is _FdMessage and item.fds is not None:
+                        for fd in item.fds:
+                            os.close(fd)
+            self._buffers = None
+            if self._server is not None:
+                self._server._connection_closed(self)
+                self._server = None
             self.emit('close', self)
         else:
             import traceback
@@ -95,140 +300,647 @@ class Socket(event.EventEmitter):
         self.emit('error', self, error)
         self.close()
 
-    def _connect_cb(self):
+    def _connect_cb(self, sock):
         logging.debug('_connect_cb')
         assert self._state == STATE_CONNECTING
-        self._loop.remove_handler(self._connect_handler)
-        self._connect_handler = None
+        self._connector = None
+        self._cancel_connect_timeout()
+        self._socket = sock
         self._init_streaming()
+        if self._buffers:
+            # written while connecting
+            self._write()
         self.emit('connect', self)
+        self._end_if_pending()
+        self._check_drain()
 
     def _init_streaming(self):
         logging.debug('init streaming')
         self._state = STATE_STREAMING
-        self._read_handler = self._loop.add_fd(self._socket, loop_.MODE_IN, self._read_cb)
+        if self._loop.edge_triggered:
+            self._edge_triggered = True
+            self._read_mode = loop_.MODE_IN | loop_.MODE_RDHUP | loop_.MODE_ET
+            self._write_handler = self._loop.add_fd(self._socket, loop_.MODE_OUT | loop_.MODE_ET, self._write_cb,
+                                                    self._poll_failed)
+        self._read_handler = self._loop.add_fd(self._socket, self._read_mode, self._read_cb,
+                                               self._poll_failed)
 
-    def connect(self, address):
+    def connect(self, address, timeout=None, attempt_timeout=None):
+        '''the hostname is resolved by loop.resolver without blocking, then
+        its addresses are raced Happy Eyeballs style: IPv6 and IPv4 ones
+        alternately, a new attempt every CONNECTION_ATTEMPT_DELAY seconds
+        until one connects. timeout limits the whole connect, resolving
+        included, attempt_timeout each attempt
+
+        address can also be the path of an AF_UNIX socket'''
         logging.debug('connect')
         assert self._state == STATE_INITIALIZED
-        try:
-            addrs = socket.getaddrinfo(address[0], address[1], 0, 0, socket.SOL_TCP)
-            # support both IPv4 and IPv6 addresses
-            if addrs:
-                # TODO try every result
-                addr = addrs[0]
-                self._socket = socket.socket(addr[0], addr[1], addr[2])
-                self._socket.setblocking(False)
-                self._socket.connect(addr[4])
-            else:
-                self._error(Exception('can not resolve hostname %s' % address[0]))
-                return
-        except socket.error as e:
-            if e.args[0] not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
-                self._error(e)
-                return
-        self._connect_handler = self._loop.add_fd(self._socket, loop_.MODE_OUT, self._connect_cb)
         self._state = STATE_CONNECTING
+        if timeout is not None:
+            self._connect_timeout_handler = self._loop.add_timeout(timeout, self._connect_timeout_cb)
+        if _is_unix_address(address):
+            addrs = [(socket.AF_UNIX, socket.SOCK_STREAM, 0, '', address)]
+            # call back from the loop, like the resolver does
+            self._loop.add_callback(lambda: self._resolve_cb(address, None, addrs, attempt_timeout))
+            return
+        self._loop.resolver.resolve(address[0], address[1],
+                                    lambda error, addrs: self._resolve_cb(address, error, addrs, attempt_timeout))
+
+    def _resolve_cb(self, address, error, addrs, attempt_timeout):
+        if self._state != STATE_CONNECTING:
+            # closed while resolving
+            return
+        if error is not None:
+            self._error(error)
+            return
+        if not addrs:
+            self._error(Exception('can not resolve hostname %s' % address[0]))
+            return
+        self._connector = _Connector(self, addrs, attempt_timeout)
+        self._connector.start()
+
+    def _poll_failed(self, handler):
+        # the loop can't watch the socket, select above FD_SETSIZE
+        if self._state in (STATE_STREAMING, STATE_CLOSING):
+            self._error(handler.error)
+
+    def _connect_timeout_cb(self):
+        self._connect_timeout_handler = None
+        if self._state == STATE_CONNECTING:
+            self._error(socket.timeout('connect timed out'))
+
+    def _cancel_connect_timeout(self):
+        if self._connect_timeout_handler:
+            self._loop.remove_handler(self._connect_timeout_handler)
+            self._connect_timeout_handler = None
 
     def _read_cb(self):
         logging.debug('_read_cb')
         assert self._state == STATE_STREAMING
         self._read()
 
+    def _emit_data(self, view):
+        if self._pipe is not None:
+            self._pipe.forward(view)
+        elif self._framing is not None:
+            self._framing.feed(view)
+            self._emit_frames()
+        elif self._zero_copy:
+            self.emit('data', self, view)
+        else:
+            self.emit('data', self, view.tobytes())
+
+    def _emit_frames(self):
+        decoder = self._framing
+        while self._state == STATE_STREAMING and not self._paused and \
+                self._framing is decoder:
+            try:
+                frame = decoder.next_frame()
+            except framing.FrameError as e:
+                self._error(e)
+                return
+            if frame is None:
+                return
+            self.emit('message', self, frame)
+
+    def _read_again_cb(self):
+        self._read_again_handler = None
+        if self._state == STATE_STREAMING and not self._paused:
+            self._read()
+
+    def _read_later(self):
+        # level triggered sockets are reported by the next poll anyway
+        if self._edge_triggered and not self._read_again_handler:
+            self._read_again_handler = self._loop.add_callback(self._read_again_cb)
+
+    def _cancel_read_again(self):
+        if self._read_again_handler:
+            self._loop.remove_handler(self._read_again_handler)
+            self._read_again_handler = None
+
+    def _adapt_read_size(self, burst):
+        # shrink only after two small bursts in a row, so one short message
+        # doesn't undo the growth of a bulk transfer
+        if burst < self._read_size // 2:
+            self._small_reads += 1
+            if self._small_reads >= 2:
+                self._small_reads = 0
+                self._read_size = max(self._read_size // 2, MIN_RECV_BUFSIZE)
+        else:
+            self._small_reads = 0
+
+    def _read_ended(self):
+        self.emit('end', self)
+        if self._state == STATE_STREAMING:
+            if self.allow_half_open and not self._write_shut:
+                # closed by end(), the fd would keep reporting the EOF
+                self._eof = True
+                self.pause()
+            else:
+                self.close()
+        elif self._state == STATE_CLOSING:
+            # end() was called with data left to write, the fd would keep
+            # reporting the EOF until it's written
+            self.pause()
+
     def _read(self):
         logging.debug('_read')
-        cache = []
-        ended = False
-        while True:
-            try:
-                data = self._socket.recv(RECV_BUFSIZE)
-                if not data:
-                    # received FIN
-                    ended = True
-                    break
-                cache.append(data)
-            except socket.error as e:
-                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+        loop = self._loop
+        pool = loop.buffer_pool
+        buf = pool.acquire()
+        try:
+            view = memoryview(buf)
+            size = len(buf)
+            n = 0
+            burst = 0
+            calls = loop.read_budget_calls
+            ended = False
+            while True:
+                if burst >= loop.read_budget or calls == 0:
+                    # leave the rest to the next iteration so other sockets
+                    # get their turn
+                    self._read_later()
                     break
-                else:
-                    self._error(e)
-                    return
+                want = min(self._read_size, size - n)
+                try:
+                    if self._receive_fds:
+                        r = self._recv_fds_into(view[n:n + want])
+                    else:
+                        r = self._socket.recv_into(view[n:], want)
+                    if not r:
+                        # received FIN
+                        ended = True
+                        break
+                    n += r
+                    burst += r
+                    calls -= 1
+                except socket.error as e:
+                    if self._read_blocked(e):
+                        break
+                    else:
+                        self._error(e)
+                        return
+                if r == self._read_size:
+                    self._read_size = min(self._read_size * 2, size)
+                if n == size:
+                    self._emit_data(view)
+                    n = 0
+                    if self._state != STATE_STREAMING or self._paused:
+                        return
 
-        if cache:
-            data = ''.join(cache)
-            if data:
-                self.emit('data', self, data)
+            if n:
+                self._emit_data(view[:n])
+            self._adapt_read_size(burst)
+        finally:
+            pool.release(buf)
 
         if ended:
-            self.emit('end', self)
-            if self._state == STATE_STREAMING:
-                self.close()
+            self._read_ended()
+
+    def _read_blocked(self, error):
+        '''whether a recv error only means there is nothing to read yet'''
+        return error.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN)
+
+    def _recv_fds_into(self, view):
+        r, fds, truncated = fdpass.recv_fds_into(self._socket, view, MAX_FDS)
+        if truncated:
+            logging.warn('more than %d fds passed, some were dropped', MAX_FDS)
+        if fds:
+            self.emit('fds', self, fds)
+        return r
 
     def _write_cb(self):
         logging.debug('_write_cb')
         assert self._state in (STATE_STREAMING, STATE_CLOSING)
         # called when writable
-        if len(self._buffers) > 0:
-            result = self._write()
-            if result:
-                self.emit('drain', self)
+        if not self._buffers:
+            # edge triggered sockets are notified even with nothing to write
+            return
+        self._write()
+        self._check_drain()
+
+    def _write_blocked(self, error):
+        '''whether a send error only means the socket is full'''
+        return error.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN)
+
+    def _check_drain(self):
+        if self._need_drain and self._buffered_size <= self._low_water_mark \
+                and self._state == STATE_STREAMING and not self._sending_file():
+            self._need_drain = False
+            self.emit('drain', self)
+
+    def _sending_file(self):
+        # files aren't counted in _buffered_size, their size may be unknown
+        buf = self._buffers
+        return buf is not None and \
+            any(item.__class__ is _FileRange for item in buf)
+
+    def _send(self):
+        '''sends from the head of _buffers with one syscall, gathering the
+        next buffers with sendmsg, or joining them if small without it'''
+        buf = self._buffers
+        data = buf[0]
+        if self._buffer_offset:
+            data = memoryview(data)[self._buffer_offset:]
+        if len(buf) > 1:
+            if _has_sendmsg:
+                iov = [data]
+                for item in itertools.islice(buf, 1, IOV_MAX):
+                    if item.__class__ is _FileRange or item.__class__ is _FdMessage:
+                        break
+                    iov.append(item)
+                return self._socket.sendmsg(iov)
+            if len(data) < GATHER_SIZE:
+                size = len(data)
+                items = [data]
+                for item in itertools.islice(buf, 1, IOV_MAX):
+                    if item.__class__ is _FileRange or item.__class__ is _FdMessage or \
+                            size + len(item) > GATHER_SIZE:
+                        break
+                    items.append(item)
+                    size += len(item)
+                if len(items) > 1:
+                    data = bytearray()
+                    for item in items:
+                        data += item
+        return self._socket.send(data)
+
+    def _send_file(self, f):
+        '''sends a chunk of f, returns False if the socket is full'''
+        size = SENDFILE_CHUNK
+        if f.remaining is not None:
+            size = min(f.remaining, size)
+        if size == 0:
+            return True
+        if f.fd is not None and _has_sendfile:
+            try:
+                r = sendfile.sendfile(self._socket.fileno(), f.fd, f.offset, size)
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                                   errno.EOPNOTSUPP):
+                    # like a failed send, EAGAIN included, which isn't an
+                    # OSError on python 2
+                    raise socket.error(e.errno, e.strerror)
+                # sendfile doesn't support this file or socket
+                f.fd = None
+                return self._send_file(f)
         else:
-            logging.debug('removing write handler %s' % self._write_handler)
-            if self._write_handler:
-                self._loop.remove_handler(self._write_handler)
-                self._write_handler = None
-            if self._state == STATE_CLOSING:
-                self.close()
-            else:
-                print 'drain'
-                self.emit('drain', self)
+            pool = self._loop.buffer_pool
+            buf = pool.acquire()
+            try:
+                view = memoryview(buf)[:size]
+                f.fileobj.seek(f.offset)
+                size = f.fileobj.readinto(view)
+                r = self._socket.send(view[:size]) if size else 0
+            finally:
+                pool.release(buf)
+        if r == 0:
+            # EOF
+            f.remaining = 0
+            return True
+        f.offset += r
+        if f.remaining is not None:
+            f.remaining -= r
+        return r == size
+
+    def _consume(self, sent):
+        buf = self._buffers
+        self._buffered_size -= sent
+        offset = self._buffer_offset + sent
+        while buf:
+            if buf[0].__class__ is _FileRange or buf[0].__class__ is _FdMessage:
+                break
+            size = len(buf[0])
+            if offset < size:
+                break
+            offset -= size
+            buf.popleft()
+        self._buffer_offset = offset
 
     def _write(self):
         logging.debug('_write')
         # called internally
         assert self._state in (STATE_STREAMING, STATE_CLOSING)
         buf = self._buffers
-        while len(buf) > 0:
-            data = buf.popleft()
+        while buf:
+            head = buf[0]
             try:
-                r = self._socket.send(data)
-                if r < len(data):
-                    buf.appendleft(data[r:])
-                    logging.debug('r < data')
-                    return False
+                if head.__class__ is _FileRange:
+                    if not self._send_file(head):
+                        break
+                    if head.remaining == 0:
+                        buf.popleft()
+                        self.emit('sendfile', self, head.fileobj)
+                        if self._state not in (STATE_STREAMING, STATE_CLOSING):
+                            return False
+                    continue
+                if head.__class__ is _FdMessage:
+                    self._send_fds(head)
+                    if not head.data:
+                        buf.popleft()
+                    continue
+                r = self._send()
             except socket.error as e:
-                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
-                    buf.appendleft(data)
-                    self._write_handler = self._loop.add_fd(self._socket, loop_.MODE_OUT, self._write_cb)
-                    logging.debug(e)
-                    return False
+                if self._write_blocked(e):
+                    break
                 else:
                     self._error(e)
                     return False
+            self._consume(r)
+            if self._buffer_offset:
+                logging.debug('r < data')
+                break
+        if buf:
+            # wait until writable
+            if not self._write_handler:
+                self._write_handler = self._loop.add_fd(self._socket, loop_.MODE_OUT, self._write_cb,
+                                                        self._poll_failed)
+            return False
+        # an empty deque is bigger than a lot of idle sockets need
+        self._buffers = None
         # if all written, we don't need to handle OUT event
-        logging.debug('removing write handler %s' % self._write_handler)
-        self._loop.remove_handler(self._write_handler)
-        self._write_handler = None
+        if self._write_handler and not self._edge_triggered:
+            logging.debug('removing write handler %s' % self._write_handler)
+            self._loop.remove_handler(self._write_handler)
+            self._write_handler = None
         if self._state == STATE_CLOSING:
             self.close()
+        elif self._shutdown_pending:
+            self._shutdown_write()
         return True
 
+    def _send_fds(self, m):
+        r = fdpass.send_fds(self._socket, m.data, m.fds)
+        # the fds went with the first byte
+        if m.fds is not None:
+            for fd in m.fds:
+                os.close(fd)
+            m.fds = None
+        m.data = m.data[r:]
+        self._buffered_size -= r
+
+    def send_fds(self, fds, data=b'\0'):
+        '''passes fds to the peer of an AF_UNIX socket with SCM_RIGHTS,
+        along with data, after the data already written. fds can be ints,
+        or have a fileno() like sockets and Sockets. they are duplicated,
+        so they can be closed right after this call. needs python 3, or
+        linux'''
+        if not _has_fd_passing:
+            raise NotImplementedError('fd passing needs sendmsg')
+        assert data, 'fds must be sent along with some data'
+        fds = [os.dup(fd if isinstance(fd, (int, long)) else fd.fileno())
+               for fd in fds]
+        waiting = bool(self._buffers)
+        if self._buffers is None:
+            self._buffers = collections.deque()
+        self._buffers.append(_FdMessage(fds, data))
+        self._buffered_size += len(data)
+        if not waiting and self._state != STATE_CONNECTING:
+            self._write()
+        if self._buffered_size > self._high_water_mark:
+            self._need_drain = True
+            return False
+        return True
+
+    def send_file(self, fileobj, offset=0, count=None):
+        '''sends count bytes of fileobj from offset, or up to EOF if count is
+        None, after the data already written. uses sendfile(2) when possible,
+        otherwise fileobj is read in chunks and its position is changed
+
+        emits 'sendfile' with fileobj once it's sent. like write(), it can be
+        called while connecting, and returns False if the file couldn't be
+        sent at once or the buffer is above the high water mark, then wait
+        for 'drain' before writing more'''
+        waiting = bool(self._buffers)
+        if self._buffers is None:
+            self._buffers = collections.deque()
+        f = _FileRange(fileobj, offset, count)
+        self._buffers.append(f)
+        if not waiting and self._state != STATE_CONNECTING:
+            self._write()
+        if (self._buffers and self._buffers[-1] is f) or \
+                self._buffered_size > self._high_water_mark:
+            self._need_drain = True
+            return False
+        return True
+
+    def _write_borrowed(self, view):
+        '''write() for a view that is only valid during this call'''
+        if not self._buffers and self._state == STATE_STREAMING:
+            try:
+                r = self._socket.send(view)
+            except socket.error as e:
+                if not self._write_blocked(e):
+                    self._error(e)
+                    return False
+                r = 0
+            if r == len(view):
+                return True
+            view = view[r:]
+        return self.write(view.tobytes())
+
     def write(self, data):
-        # TODO make stream writable in STATE_CONNECTING
+        '''data can be a str, bytearray or memoryview. it's queued as is, so
+        don't modify it until it's written
+
+        returns False when the buffer is above the high water mark, wait for
+        'drain' before writing more'''
+        waiting = bool(self._buffers)
+        if self._buffers is None:
+            self._buffers = collections.deque()
         self._buffers.append(data)
-        if not self._write_handler:
-            self._write_handler = self._loop.add_fd(self._socket, loop_.MODE_OUT, self._write_cb)
-        return self._write()
+        self._buffered_size += len(data)
+        if not waiting and self._state != STATE_CONNECTING:
+            self._write()
+        if self._buffered_size > self._high_water_mark:
+            self._need_drain = True
+            return False
+        return True
+
+
+class _Pipe(object):
+    '''forwards what src receives to dst, see Socket.pipe()'''
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        src.on('end', self._on_src_end)
+        src.on('close', self._on_src_close)
+        dst.on('drain', self._on_dst_drain)
+        dst.on('close', self._on_dst_close)
+
+    def forward(self, view):
+        dst = self.dst
+        if dst._state not in (STATE_CONNECTING, STATE_STREAMING):
+            return
+        if not dst._write_borrowed(view) and \
+                self.src._state == STATE_STREAMING:
+            self.src.pause()
+
+    def _on_src_end(self, src):
+        self._cleanup()
+        if self.dst._state in (STATE_CONNECTING, STATE_STREAMING):
+            self.dst.end()
+
+    def _on_src_close(self, src):
+        self._cleanup()
+        if self.dst._eof and self.dst._state == STATE_STREAMING:
+            # only kept open for what src would forward
+            self.dst.end()
+
+    def _on_dst_drain(self, dst):
+        if self.src._state == STATE_STREAMING:
+            self.src.resume()
+
+    def _on_dst_close(self, dst):
+        self._cleanup()
+        if self.src._state != STATE_CLOSED:
+            self.src.close()
+
+    def _cleanup(self):
+        # the listeners hold the pipe, which holds both sockets. Socket has
+        # a __del__, so the cycle would never be collected
+        src = self.src
+        dst = self.dst
+        src.remove_listener('end', self._on_src_end)
+        src.remove_listener('close', self._on_src_close)
+        dst.remove_listener('drain', self._on_dst_drain)
+        dst.remove_listener('close', self._on_dst_close)
+        if src._pipe is self:
+            src._pipe = None
+
+
+def _interleave(addrs):
+    '''orders getaddrinfo results alternating address families, starting
+    with the family preferred by the system'''
+    first = [addr for addr in addrs if addr[0] == addrs[0][0]]
+    others = [addr for addr in addrs if addr[0] != addrs[0][0]]
+    result = []
+    for i in xrange(max(len(first), len(others))):
+        result.extend(first[i:i + 1])
+        result.extend(others[i:i + 1])
+    return result
+
+
+class _Connector(object):
+    '''connection attempts of Socket.connect(), several may be in flight.
+    the first one to connect wins and the others are closed'''
+
+    def __init__(self, sockobj, addrs, attempt_timeout):
+        self._sockobj = sockobj
+        self._loop = sockobj._loop
+        self._addrs = collections.deque(_interleave(addrs))
+        self._attempt_timeout = attempt_timeout
+        self._attempts = {}  # {socket: (handler, timeout handler)}
+        self._delay_handler = None
+        self._last_error = None
+
+    def start(self):
+        self._next_attempt()
+
+    def _next_attempt(self):
+        self._cancel_delay()
+        while self._addrs:
+            addr = self._addrs.popleft()
+            sock = None
+            try:
+                sock = socket.socket(addr[0], addr[1], addr[2])
+                sock.setblocking(False)
+                sock.connect(addr[4])
+            except socket.error as e:
+                if e.args[0] not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    logging.debug('connecting to %s failed: %s', addr[4], e)
+                    if sock is not None:
+                        sock.close()
+                    self._last_error = e
+                    continue
+            # connect() of a non-blocking socket almost never completes at
+            # once, and when it does the socket is reported writable anyway
+            handler = self._loop.add_fd(sock, loop_.MODE_OUT, lambda sock=sock: self._attempt_cb(sock),
+                                        lambda handler, sock=sock: self._attempt_failed(sock, handler.error))
+            timeout_handler = None
+            if self._attempt_timeout is not None:
+                timeout_handler = self._loop.add_timeout(
+                    self._attempt_timeout,
+                    lambda sock=sock: self._attempt_failed(sock, socket.timeout('connect timed out')))
+            self._attempts[sock] = (handler, timeout_handler)
+            if self._addrs:
+                self._delay_handler = self._loop.add_timeout(CONNECTION_ATTEMPT_DELAY, self._next_attempt)
+            return
+        if not self._attempts:
+            self._sockobj._connector = None
+            self._sockobj._error(self._last_error or Exception('can not connect'))
+
+    def _cancel_delay(self):
+        if self._delay_handler:
+            self._loop.remove_handler(self._delay_handler)
+            self._delay_handler = None
+
+    def _remove_attempt(self, sock):
+        handler, timeout_handler = self._attempts.pop(sock)
+        self._loop.remove_handler(handler)
+        if timeout_handler:
+            self._loop.remove_handler(timeout_handler)
+
+    def _attempt_cb(self, sock):
+        if sock not in self._attempts:
+            return
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._attempt_failed(sock, socket.error(err, os.strerror(err)))
+            return
+        self._remove_attempt(sock)
+        self.cancel()
+        self._sockobj._connect_cb(sock)
+
+    def _attempt_failed(self, sock, error):
+        if sock not in self._attempts:
+            return
+        logging.debug('connect attempt failed: %s', error)
+        self._remove_attempt(sock)
+        sock.close()
+        self._last_error = error
+        # don't wait for the delay to try the next address
+        self._next_attempt()
+
+    def cancel(self):
+        self._cancel_delay()
+        for sock in list(self._attempts):
+            self._remove_attempt(sock)
+            sock.close()
+
+
+def _unix_listening(path):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # not blocking on a full backlog, EAGAIN then
+    probe.setblocking(False)
+    try:
+        return probe.connect_ex(path) != errno.ECONNREFUSED
+    finally:
+        probe.close()
 
 
 class Server(event.EventEmitter):
-    ''' currently TCP, IPv4 only'''
-    def __init__(self, address, loop=None):
+    ''' TCP over IPv4 or IPv6, or AF_UNIX stream when address is a path'''
+
+    __slots__ = ('_address', '_loop', '_socket', '_accept_handler', '_state',
+                 'max_connections', '_connections', '_spare_fd')
+
+    def __init__(self, address, loop=None, max_connections=None):
+        '''stops accepting while max_connections accepted sockets are open'''
         super(Server, self).__init__()
         self._address = address
         self._loop = loop if loop is not None else instance()
         self._socket = None
+        self._accept_handler = None
+        self._state = STATE_INITIALIZED
+        self.max_connections = max_connections
+        self._connections = 0
+        self._spare_fd = None
 
+        if _is_unix_address(address):
+            self._bind_unix(address)
+            return
         addrs = socket.getaddrinfo(address[0], address[1], 0, 0, socket.SOL_TCP)
         # support both IPv4 and IPv6 addresses
         if addrs:
@@ -241,24 +953,116 @@ class Server(event.EventEmitter):
             self._error(Exception('can not resolve hostname %s' % address[0]))
             return
 
-        self._state = STATE_INITIALIZED
+    def _bind_unix(self, path):
+        # a socket file left by a previous run would fail the bind. one a
+        # server still listens on is kept, and the bind fails with EADDRINUSE
+        if not path.startswith('\0'):
+            try:
+                if stat.S_ISSOCK(os.stat(path).st_mode) and \
+                        not _unix_listening(path):
+                    os.unlink(path)
+            except OSError:
+                pass
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.setblocking(False)
+        self._socket.bind(path)
 
     def __del__(self):
-        self.close()
+        if self._state != STATE_CLOSED:
+            self.close()
 
-    def listen(self, backlog=128):
+    def listen(self, backlog=128, workers=None):
+        '''with workers, forks that many worker processes which accept on
+        their own SO_REUSEPORT socket and their own loop. this process then
+        supervises them, restarting the ones that die, and exits on SIGTERM
+        or SIGINT after stopping them'''
         assert self._state == STATE_INITIALIZED
-        self._accept_handler = self._loop.add_fd(self._socket, loop_.MODE_IN, self._accept_cb)
+        if workers:
+            import prefork
+            prefork.supervise(self, workers, backlog)
+        self._accept_handler = self._loop.add_fd(self._socket, loop_.MODE_IN, self._accept_cb,
+                                                 self._poll_failed)
         self._socket.listen(backlog)
         self._state = STATE_LISTENING
+        # given up to accept and drop a connection when out of fds
+        self._spare_fd = os.open(os.devnull, os.O_RDONLY)
 
     def _accept_cb(self):
         assert self._state == STATE_LISTENING
         logging.debug('accept_cb')
-        conn, addr = self._socket.accept()
+        for i in xrange(ACCEPT_BATCH):
+            try:
+                conn, addr = self._socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                elif e.args[0] in (errno.EMFILE, errno.ENFILE):
+                    self._shed_connection()
+                    return
+                elif e.args[0] in (errno.ECONNABORTED, errno.EPROTO,
+                                   errno.EINTR):
+                    continue
+                logging.warn('accept failed: %s', e)
+                return
+            self._connections += 1
+            self._accepted(conn)
+            if self._state != STATE_LISTENING:
+                return
+            if self.max_connections is not None and \
+                    self._connections >= self.max_connections:
+                self._pause_accepting()
+                return
+
+    def _accepted(self, conn):
         sockobj = Socket(loop=self._loop, sock=conn)
+        # cheaper than a 'close' listener on every socket
+        sockobj._server = self
         self.emit('connection', self, sockobj)
 
+    def _shed_connection(self):
+        # the listener stays readable until the connection is accepted, so
+        # accept it with the spare fd and close it right away
+        logging.warn('out of file descriptors, dropping a connection')
+        if self._spare_fd is None:
+            return
+        os.close(self._spare_fd)
+        self._spare_fd = None
+        try:
+            conn, addr = self._socket.accept()
+            conn.close()
+        except socket.error:
+            pass
+        try:
+            self._spare_fd = os.open(os.devnull, os.O_RDONLY)
+        except OSError:
+            pass
+
+    def _pause_accepting(self):
+        if self._accept_handler:
+            self._loop.remove_handler(self._accept_handler)
+            self._accept_handler = None
+
+    def _resume_accepting(self):
+        if not self._accept_handler:
+            self._accept_handler = self._loop.add_fd(self._socket, loop_.MODE_IN, self._accept_cb,
+                                                     self._poll_failed)
+
+    def _poll_failed(self, handler):
+        if self._state == STATE_LISTENING:
+            self._error(handler.error)
+
+    def _connection_closed(self, sockobj):
+        self._connections -= 1
+        if self._state == STATE_LISTENING and not self._accept_handler and \
+                (self.max_connections is None or
+                 self._connections < self.max_connections):
+            self._resume_accepting()
+
+    @property
+    def connections(self):
+        '''number of accepted sockets still open'''
+        return self._connections
+
     def _error(self, error):
         self.emit('error', self, error)
         self.close()
@@ -268,6 +1072,10 @@ class Server(event.EventEmitter):
         if self._state in (STATE_INITIALIZED, STATE_LISTENING):
             if self._accept_handler:
                 self._loop.remove_handler(self._accept_handler)
+                self._accept_handler = None
+            if self._spare_fd is not None:
+                os.close(self._spare_fd)
+                self._spare_fd = None
             if self._socket is not None:
                 self._socket.close()
             self._state = STATE_CLOSED
@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+''' keep-alive pool of outbound connections '''
+
+import collections
+import logging
+
+import metrics
+import net
+from loop import instance
+
+MAX_PER_KEY = 8
+MAX_TOTAL = 256
+IDLE_TIMEOUT = 60
+
+
+class ConnectionPool(object):
+    ''' connected Sockets by (host, port), reused instead of connecting
+    again. acquire() calls back with a socket, release() gives it back once
+    the exchange is done, close it instead if it's not reusable
+
+    at most max_per_key sockets per key and max_total in all are open, the
+    idle ones included, acquire() waits above that. the pool reads the idle
+    sockets, so a peer closing one is noticed at once, and data arriving on
+    one closes it. they are closed after idle_timeout seconds. lifo hands
+    out the most recently released socket and lets the others expire when
+    traffic drops, fifo the least recently released one
+
+    hits, misses, waits and wait_time count acquires since created, see
+    snapshot() '''
+
+    def __init__(self, loop=None, max_per_key=MAX_PER_KEY, max_total=MAX_TOTAL,
+                 idle_timeout=IDLE_TIMEOUT, lifo=True, connect_timeout=None,
+                 socket_factory=None):
+        '''socket_factory(loop) makes the unconnected sockets, a TLSSocket
+        for example'''
+        self._loop = loop if loop is not None else instance()
+        self.max_per_key = max_per_key
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        self.lifo = lifo
+        self.connect_timeout = connect_timeout
+        self._socket_factory = socket_factory
+        self._keys = {}  # {sock: key} of the open sockets, connecting included
+        self._open = {}  # {key: open sockets}
+        self._total = 0
+        self._idle = {}  # {key: deque of (sock, released at)}, oldest first
+        self._idle_count = 0
+        self._waiters = collections.OrderedDict()  # {key: deque of (callback, since)}
+        self._sweep_handler = None
+        self._closed = False
+        self.hits = 0  # acquires served with an idle or released socket
+        self.misses = 0  # acquires that connected
+        self.waits = 0  # acquires that waited for the limits
+        self.wait_time = metrics.Histogram()
+        self.evicted = 0  # idle sockets closed by the pool
+        self.closed_idle = 0  # idle sockets closed by the peer
+
+    def acquire(self, address, callback):
+        '''calls callback(error, sock) with a socket connected to address,
+        before returning when an idle one is there'''
+        assert not self._closed
+        key = (address[0], address[1])
+        sock = self._pop_idle(key)
+        if sock is not None:
+            self.hits += 1
+            callback(None, sock)
+            return
+        if key in self._waiters or not self._make_room(key):
+            self.waits += 1
+            waiters = self._waiters.get(key)
+            if waiters is None:
+                waiters = self._waiters[key] = collections.deque()
+            waiters.append((callback, self._loop.time()))
+            return
+        self._connect(key, callback)
+
+    def release(self, sock):
+        '''gives back an acquired socket, removing its listeners. closed or
+        ending sockets are dropped'''
+        key = self._keys.get(sock)
+        if key is None or sock._state != net.STATE_STREAMING:
+            # closed, or closing after end()
+            return
+        if self._closed:
+            sock.close()
+            return
+        sock.remove_all_listeners()
+        sock.on('close', self._on_close)
+        if sock._paused:
+            sock.resume()
+        waiters = self._waiters.get(key)
+        if waiters:
+            callback, since = waiters.popleft()
+            if not waiters:
+                del self._waiters[key]
+            self.wait_time.add(self._loop.time() - since)
+            self.hits += 1
+            callback(None, sock)
+            return
+        sock.on('data', self._on_idle_data)
+        idle = self._idle.get(key)
+        if idle is None:
+            idle = self._idle[key] = collections.deque()
+        idle.append((sock, self._loop.time()))
+        self._idle_count += 1
+        if self._waiters:
+            # waiting for another key at max_total, this socket can go now
+            self._serve_waiters()
+        self._schedule_sweep()
+
+    def close(self):
+        '''closes the idle sockets, and the others once released. waiting
+        acquires are called back with an error'''
+        if self._closed:
+            return
+        self._closed = True
+        if self._sweep_handler:
+            self._loop.remove_handler(self._sweep_handler)
+            self._sweep_handler = None
+        for idle in self._idle.values():
+            for sock, since in idle:
+                self._close_idle(sock)
+        self._idle = {}
+        self._idle_count = 0
+        waiters, self._waiters = self._waiters, collections.OrderedDict()
+        for key, callbacks in waiters.items():
+            for callback, since in callbacks:
+                callback(Exception('connection pool closed'), None)
+
+    def snapshot(self):
+        acquires = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / float(acquires) if acquires else 0,
+            'waits': self.waits,
+            'wait_time': self.wait_time.snapshot(),
+            'evicted': self.evicted,
+            'closed_idle': self.closed_idle,
+            'open': self._total,
+            'idle': self._idle_count,
+            'waiting': sum(len(w) for w in self._waiters.values()),
+        }
+
+    def _connect(self, key, callback):
+        self.misses += 1
+        if self._socket_factory is not None:
+            sock = self._socket_factory(self._loop)
+        else:
+            sock = net.Socket(loop=self._loop)
+        self._keys[sock] = key
+        self._open[key] = self._open.get(key, 0) + 1
+        self._total += 1
+        sock.on('close', self._on_close)
+
+        def on_connect(s):
+            s.remove_listener('error', on_error)
+            callback(None, s)
+
+        def on_error(s, error):
+            s.remove_listener('connect', on_connect)
+            callback(error, None)
+        sock.once('connect', on_connect)
+        sock.once('error', on_error)
+        sock.connect(key, timeout=self.connect_timeout)
+
+    def _make_room(self, key):
+        '''whether a socket to key can be opened, closing an idle socket of
+        another key for it if needed'''
+        if self._open.get(key, 0) >= self.max_per_key:
+            return False
+        if self._total >= self.max_total:
+            return self._evict_oldest()
+        return True
+
+    def _pop_idle(self, key):
+        idle = self._idle.get(key)
+        if not idle:
+            return None
+        sock, since = idle.pop() if self.lifo else idle.popleft()
+        if not idle:
+            del self._idle[key]
+        self._idle_count -= 1
+        sock.remove_listener('data', self._on_idle_data)
+        return sock
+
+    def _evict_oldest(self):
+        if not self._idle_count:
+            return False
+        key = min(self._idle, key=lambda k: self._idle[k][0][1])
+        idle = self._idle[key]
+        sock, since = idle.popleft()
+        if not idle:
+            del self._idle[key]
+        self._idle_count -= 1
+        self._close_idle(sock)
+        return True
+
+    def _close_idle(self, sock):
+        '''closes a socket already removed from _idle'''
+        self._forget(sock)
+        self.evicted += 1
+        sock.close()
+
+    def _forget(self, sock):
+        key = self._keys.pop(sock, None)
+        if key is None:
+            return None
+        n = self._open[key] - 1
+        if n:
+            self._open[key] = n
+        else:
+            del self._open[key]
+        self._total -= 1
+        return key
+
+    def _on_close(self, sock):
+        key = self._forget(sock)
+        if key is None:
+            return
+        idle = self._idle.get(key)
+        if idle:
+            for i, (s, since) in enumerate(idle):
+                if s is sock:
+                    del idle[i]
+                    if not idle:
+                        del self._idle[key]
+                    self._idle_count -= 1
+                    self.closed_idle += 1
+                    break
+        if self._waiters:
+            self._serve_waiters()
+
+    def _on_idle_data(self, sock, data):
+        logging.warn('unexpected data on an idle connection to %s:%s, closing it',
+                     *self._keys[sock])
+        sock.close()
+
+    def _serve_waiters(self):
+        for key in list(self._waiters):
+            waiters = self._waiters.get(key)
+            while waiters and self._make_room(key):
+                callback, since = waiters.popleft()
+                self.wait_time.add(self._loop.time() - since)
+                self._connect(key, callback)
+            if waiters is not None and not waiters:
+                del self._waiters[key]
+
+    def _schedule_sweep(self):
+        if self._sweep_handler or not self._idle_count or \
+                self.idle_timeout is None:
+            return
+        oldest = min(idle[0][1] for idle in self._idle.itervalues())
+        delay = max(oldest + self.idle_timeout - self._loop.time(), 0)
+        self._sweep_handler = self._loop.add_timeout(delay, self._sweep, True)
+
+    def _sweep(self):
+        self._sweep_handler = None
+        deadline = self._loop.time() - self.idle_timeout
+        for key in list(self._idle):
+            idle = self._idle[key]
+            while idle and idle[0][1] <= deadline:
+                sock, since = idle.popleft()
+                self._idle_count -= 1
+                self._close_idle(sock)
+            if not idle:
+                del self._idle[key]
+        if self._waiters:
+            self._serve_waiters()
+        self._schedule_sweep()
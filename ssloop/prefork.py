@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+''' prefork mode of Server.listen(workers=N) '''
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import logging
+
+import net
+
+# a worker dying sooner than this after being forked is restarted only
+# after RESTART_DELAY, so a worker that can't start doesn't fork-bomb us
+MIN_WORKER_LIFETIME = 1
+RESTART_DELAY = 1
+
+# how long a worker keeps serving its connections after SIGTERM
+GRACEFUL_TIMEOUT = 10
+IDLE_CHECK_INTERVAL = 0.5
+
+_has_reuse_port = hasattr(socket, 'SO_REUSEPORT')
+
+
+class Supervisor(object):
+    ''' forks the workers of a Server and restarts them when they die
+
+    with SO_REUSEPORT each worker listens on its own socket and the kernel
+    balances connections between them, otherwise they share the socket
+    of the Server '''
+
+    def __init__(self, server, workers, backlog):
+        self._server = server
+        self._workers = workers
+        self._backlog = backlog
+        self._children = {}  # {pid: fork time}
+        self._stopping = False
+        # AF_UNIX sockets can't share a path, even with SO_REUSEPORT
+        self._reuse_port = _has_reuse_port and \
+            server._socket.family != getattr(socket, 'AF_UNIX', None)
+
+    def run(self):
+        ''' returns in the workers only '''
+        sock = self._server._socket
+        if self._reuse_port:
+            self._family = sock.family
+            self._type = sock.type
+            self._proto = sock.proto
+            self._address = sock.getsockname()
+            sock.close()
+        else:
+            sock.listen(self._backlog)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._on_stop_signal)
+        for i in xrange(self._workers):
+            if self._spawn():
+                return
+        self._supervise()
+        sys.exit(0)
+
+    def _spawn(self):
+        ''' returns True in the forked worker '''
+        pid = os.fork()
+        if pid == 0:
+            self._init_worker()
+            return True
+        self._children[pid] = time.time()
+        logging.info('started worker %d', pid)
+        return False
+
+    def _init_worker(self):
+        server = self._server
+        self._children = {}
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._on_worker_stop_signal)
+        # the poller of the loop is shared with the supervisor
+        server._loop.after_fork()
+        if self._reuse_port:
+            sock = socket.socket(self._family, self._type, self._proto)
+            sock.setblocking(False)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(self._address)
+            server._socket = sock
+
+    def _supervise(self):
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                elif e.errno == errno.ECHILD:
+                    break
+                raise
+            started = self._children.pop(pid, None)
+            if started is None or self._stopping:
+                continue
+            logging.warn('worker %d exited with status %d, restarting', pid,
+                         status)
+            if time.time() - started < MIN_WORKER_LIFETIME:
+                time.sleep(RESTART_DELAY)
+            if self._stopping:
+                continue
+            if self._spawn():
+                # a new worker, get back to Server.listen()
+                raise _WorkerStarted()
+
+    def _on_stop_signal(self, signum, frame):
+        if self._stopping:
+            return
+        logging.info('stopping workers')
+        self._stopping = True
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _on_worker_stop_signal(self, signum, frame):
+        # the loop may be in the middle of a callback, or polling again
+        # after EINTR, so let it stop from the loop
+        self._server._loop.call_soon_threadsafe(self._stop_gracefully)
+
+    def _stop_gracefully(self):
+        # stop accepting, and give the connections some time to finish
+        server = self._server
+        if server._state in (net.STATE_INITIALIZED, net.STATE_LISTENING):
+            server.close()
+            self._deadline = time.time() + GRACEFUL_TIMEOUT
+            self._stop_when_idle()
+
+    def _stop_when_idle(self):
+        loop = self._server._loop
+        # the loop keeps fds of its own, like its waker, so count
+        # connections rather than fds
+        if not self._server.connections or time.time() >= self._deadline:
+            loop.stop()
+        else:
+            loop.add_timeout(IDLE_CHECK_INTERVAL, self._stop_when_idle)
+
+
+class _WorkerStarted(Exception):
+    ''' unwinds _supervise() in a worker forked to replace a dead one '''
+    pass
+
+
+def supervise(server, workers, backlog):
+    ''' returns in the workers only '''
+    supervisor = Supervisor(server, workers, backlog)
+    try:
+        supervisor.run()
+    except _WorkerStarted:
+        pass
@@ -0,0 +1,40 @@
+#!/usr/bin/python
+
+''' sendfile(2), see Socket.send_file()
+
+os.sendfile exists since python 3.3, before that it's called through
+ctypes, on linux only '''
+
+import ctypes
+import os
+import sys
+
+_has_os_sendfile = hasattr(os, 'sendfile')
+
+_sendfile = None
+if not _has_os_sendfile and sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        # with a 64 bit offset on 32 bit systems too
+        _sendfile = _libc.sendfile64
+        _sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        _sendfile.restype = ctypes.c_ssize_t
+    except (OSError, AttributeError):
+        _sendfile = None
+
+available = _has_os_sendfile or _sendfile is not None
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    '''sends count bytes of in_fd from offset to out_fd, without changing
+    the position of in_fd. returns the bytes sent, 0 at EOF. raises OSError
+    like os.sendfile'''
+    if _has_os_sendfile:
+        return os.sendfile(out_fd, in_fd, offset, count)
+    off = ctypes.c_int64(offset)
+    r = _sendfile(out_fd, in_fd, ctypes.byref(off), count)
+    if r < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return r
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+''' hierarchical timing wheel, used by SSLoop for coarse timeouts '''
+
+WHEEL_BITS = 8
+WHEEL_SIZE = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SIZE - 1
+WHEEL_LEVELS = 4
+MAX_TICKS = (1 << (WHEEL_BITS * WHEEL_LEVELS)) - 1
+
+DEFAULT_RESOLUTION = 0.1
+
+
+class TimingWheel(object):
+    ''' add, remove and expiring a handler are all O(1) amortized
+
+    handlers are kept in the `bucket` set they belong to, so removing them
+    doesn't need any search. deadlines are rounded up to `resolution`
+    '''
+
+    def __init__(self, now, resolution=DEFAULT_RESOLUTION):
+        self._resolution = resolution
+        # the next tick to be processed
+        self._tick = int(now / resolution)
+        self._wheels = [[None] * WHEEL_SIZE for i in xrange(WHEEL_LEVELS)]
+        self._next_tick = None
+        self.count = 0
+
+    def add(self, handler):
+        expires = -int(-handler.deadline // self._resolution)  # ceil
+        self._insert(handler, expires)
+        self.count += 1
+
+    def remove(self, handler):
+        handler.bucket.discard(handler)
+        handler.bucket = None
+        self.count -= 1
+
+    def _insert(self, handler, expires):
+        delta = expires - self._tick
+        if delta < 0:
+            expires = self._tick
+            delta = 0
+        elif delta > MAX_TICKS:
+            expires = self._tick + MAX_TICKS
+            delta = MAX_TICKS
+        level = 0
+        while delta >= WHEEL_SIZE << (WHEEL_BITS * level) and \
+                level < WHEEL_LEVELS - 1:
+            level += 1
+        wheel = self._wheels[level]
+        index = (expires >> (WHEEL_BITS * level)) & WHEEL_MASK
+        bucket = wheel[index]
+        if bucket is None:
+            bucket = wheel[index] = set()
+        bucket.add(handler)
+        handler.bucket = bucket
+        if level == 0 and self._next_tick is not None and \
+                expires < self._next_tick:
+            self._next_tick = expires
+
+    def _cascade(self, level, index):
+        wheel = self._wheels[level]
+        bucket = wheel[index]
+        if bucket:
+            wheel[index] = None
+            for handler in bucket:
+                self._insert(handler, int(-(-handler.deadline //
+                                            self._resolution)))
+
+    def advance(self, now):
+        ''' returns the handlers that expired up to `now` '''
+        expired = []
+        # tolerate the rounding error of next_deadline()
+        target = int(now / self._resolution + 1e-6)
+        if self.count == 0:
+            self._tick = target + 1
+            return expired
+        wheel = self._wheels[0]
+        while self._tick <= target:
+            tick = self._tick
+            index = tick & WHEEL_MASK
+            if index == 0:
+                for level in xrange(1, WHEEL_LEVELS):
+                    upper = (tick >> (WHEEL_BITS * level)) & WHEEL_MASK
+                    self._cascade(level, upper)
+                    if upper != 0:
+                        break
+            bucket = wheel[index]
+            if bucket:
+                wheel[index] = None
+                for handler in bucket:
+                    handler.bucket = None
+                expired.extend(bucket)
+                self.count -= len(bucket)
+            self._tick = tick + 1
+            self._next_tick = None
+            if self.count == 0:
+                self._tick = target + 1
+                break
+        return expired
+
+    def next_deadline(self):
+        ''' the earliest time advance() may return something, or None '''
+        if self.count == 0:
+            return None
+        if self._next_tick is None:
+            # scan the rest of the first wheel, stopping at the next cascade
+            wheel = self._wheels[0]
+            tick = self._tick
+            end = ((tick - 1) | WHEEL_MASK) + 1
+            while tick < end and not wheel[tick & WHEEL_MASK]:
+                tick += 1
+            self._next_tick = tick
+        return self._next_tick * self._resolution
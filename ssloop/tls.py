@@ -0,0 +1,278 @@
+#!/usr/bin/python
+
+''' TLS for SSLoop sockets, on top of the ssl module '''
+
+import itertools
+import logging
+import socket
+import ssl
+
+import loop as loop_
+import net
+from net import STATE_CLOSED, STATE_STREAMING, STATE_CLOSING
+
+# max plaintext bytes of a TLS record. small buffers are joined up to this
+# before being sent, since each send makes a record of its own
+RECORD_SIZE = 16 * 1024
+
+# accepted sockets not done with the handshake after this long are closed
+HANDSHAKE_TIMEOUT = 10
+
+_OP_NO_TICKET = getattr(ssl, 'OP_NO_TICKET', 0x4000)
+
+
+def server_context(certfile, keyfile=None, session_tickets=True):
+    '''an ssl.SSLContext for TLSServer. with session_tickets, returning
+    clients able to resume skip the full handshake with a ticket encrypted
+    by a key of the context, so make it before listen(workers=...) for the
+    workers to share the key. TLSSocket doesn't resume, the ssl module of
+    python 2 can't'''
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER',
+                                     ssl.PROTOCOL_SSLv23))
+    context.load_cert_chain(certfile, keyfile)
+    if session_tickets:
+        context.options &= ~_OP_NO_TICKET
+    else:
+        context.options |= _OP_NO_TICKET
+    return context
+
+
+class TLSSocket(net.Socket):
+    ''' a Socket speaking TLS with an ssl.SSLContext. the handshake runs in
+    the read and write callbacks of the loop, then 'connect' is emitted, or
+    'connection' on the TLSServer that accepted the socket. data written
+    before that is sent after the handshake '''
+
+    __slots__ = ('_context', '_server_side', '_server_hostname',
+                 '_handshaking', '_read_wants_write', '_write_wants_read')
+
+    def __init__(self, context, loop=None, sock=None, server_side=False,
+                 server_hostname=None):
+        self._context = context
+        self._server_side = server_side
+        # checked against the certificate, the host connected to by default
+        self._server_hostname = server_hostname
+        self._handshaking = False
+        # renegotiations and key updates may make a read wait until the
+        # socket is writable, or a write until it is readable
+        self._read_wants_write = False
+        self._write_wants_read = False
+        super(TLSSocket, self).__init__(loop=loop, sock=sock)
+
+    def getpeercert(self, binary_form=False):
+        return self._socket.getpeercert(binary_form)
+
+    def connect(self, address, timeout=None, attempt_timeout=None):
+        '''like Socket.connect(), timeout includes the handshake'''
+        if self._server_hostname is None and \
+                not net._is_unix_address(address):
+            self._server_hostname = address[0]
+        super(TLSSocket, self).connect(address, timeout, attempt_timeout)
+
+    def close(self):
+        if self._state in (STATE_STREAMING, STATE_CLOSING):
+            if self._handshaking:
+                self._handshaking = False
+            else:
+                try:
+                    # sends close_notify, without waiting for the peer's
+                    self._socket.unwrap()
+                except socket.error:
+                    pass
+        self._cancel_connect_timeout()
+        super(TLSSocket, self).close()
+
+    def send_fds(self, fds, data=b'\0'):
+        raise NotImplementedError('fds can not be passed over TLS')
+
+    def _connect_cb(self, sock):
+        # 'connect' waits for the handshake, and so does the connect timeout
+        assert self._state == net.STATE_CONNECTING
+        self._connector = None
+        self._socket = sock
+        self._init_streaming()
+
+    def _connect_timeout_cb(self):
+        # also the handshake timeout of accepted sockets
+        if self._handshaking:
+            self._connect_timeout_handler = None
+            self._error(socket.timeout('handshake timed out' if self._server_side
+                                       else 'connect timed out'))
+        else:
+            super(TLSSocket, self)._connect_timeout_cb()
+
+    def _init_streaming(self):
+        self._socket = self._context.wrap_socket(
+            self._socket, server_side=self._server_side,
+            do_handshake_on_connect=False,
+            server_hostname=self._server_hostname)
+        self._handshaking = True
+        super(TLSSocket, self)._init_streaming()
+        # servers wait for the client hello
+        if not self._server_side:
+            self._handshake()
+
+    def _handshake(self):
+        try:
+            self._socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self._wait_writable(False)
+            return
+        except ssl.SSLWantWriteError:
+            self._wait_writable(True)
+            return
+        except (socket.error, ssl.CertificateError) as e:
+            logging.debug('handshake failed: %s', e)
+            self._error(e)
+            return
+        self._handshaking = False
+        self._cancel_connect_timeout()
+        if self._buffers:
+            # written while handshaking
+            self._write()
+        else:
+            self._wait_writable(False)
+        if self._state != STATE_STREAMING:
+            return
+        if self._server is not None:
+            self._server.emit('connection', self._server, self)
+        else:
+            self.emit('connect', self)
+        self._end_if_pending()
+        self._check_drain()
+        if self._state == STATE_STREAMING:
+            # data may have come with the end of the handshake
+            self._read_later()
+
+    def _shutdown_write(self):
+        # the ssl module can't send close_notify and keep reading, so a
+        # half close is a close
+        self._shutdown_pending = False
+        self.close()
+
+    def _wait_writable(self, enabled):
+        if enabled:
+            if not self._write_handler:
+                self._write_handler = self._loop.add_fd(self._socket, loop_.MODE_OUT, self._write_cb,
+                                                        self._poll_failed)
+        elif self._write_handler and not self._edge_triggered and \
+                not self._read_wants_write:
+            self._loop.remove_handler(self._write_handler)
+            self._write_handler = None
+
+    def resume(self):
+        super(TLSSocket, self).resume()
+        # what was decrypted before the pause doesn't make the fd readable
+        if self._state == STATE_STREAMING and not self._handshaking:
+            self._read_later()
+
+    def _read_later(self):
+        # unlike for plain sockets, data left in the ssl buffer isn't
+        # reported by the next poll
+        if not self._read_again_handler:
+            self._read_again_handler = self._loop.add_callback(self._read_again_cb)
+
+    def _read(self):
+        if self._handshaking:
+            self._handshake()
+            return
+        if self._write_wants_read:
+            self._write_wants_read = False
+            self._write()
+            self._check_drain()
+            if self._state != STATE_STREAMING:
+                return
+        super(TLSSocket, self)._read()
+
+    def _read_blocked(self, error):
+        if isinstance(error, ssl.SSLWantReadError):
+            return True
+        if isinstance(error, ssl.SSLWantWriteError):
+            self._read_wants_write = True
+            self._wait_writable(True)
+            return True
+        return False
+
+    def _write_cb(self):
+        if self._handshaking:
+            self._handshake()
+            return
+        if self._read_wants_write:
+            self._read_wants_write = False
+            if not self._buffers:
+                self._wait_writable(False)
+            self._read()
+            if self._state not in (STATE_STREAMING, STATE_CLOSING):
+                return
+        super(TLSSocket, self)._write_cb()
+
+    def _write(self):
+        if self._handshaking or self._write_wants_read:
+            # _handshake() or _read() will write
+            return False
+        done = super(TLSSocket, self)._write()
+        if self._state == STATE_CLOSED:
+            return done
+        if self._write_wants_read:
+            # wait for readable instead of spinning on writable
+            self._wait_writable(False)
+        elif self._read_wants_write:
+            self._wait_writable(True)
+        return done
+
+    def _write_blocked(self, error):
+        if isinstance(error, ssl.SSLWantWriteError):
+            return True
+        if isinstance(error, ssl.SSLWantReadError):
+            self._write_wants_read = True
+            return True
+        return False
+
+    def _send(self):
+        # a send blocked with SSL_ERROR_WANT_WRITE must be retried with the
+        # same data, or more of it. buffers are only appended to until
+        # sent, so joining them again gives at least the same data
+        buf = self._buffers
+        data = buf[0]
+        if self._buffer_offset:
+            data = memoryview(data)[self._buffer_offset:]
+        if len(data) < RECORD_SIZE and len(buf) > 1:
+            record = bytearray(data)
+            for item in itertools.islice(buf, 1, None):
+                if item.__class__ is net._FileRange or \
+                        len(record) + len(item) > RECORD_SIZE:
+                    break
+                record += item
+            data = record
+        return self._socket.send(data)
+
+    def _send_file(self, f):
+        # sendfile would bypass the encryption
+        f.fd = None
+        return super(TLSSocket, self)._send_file(f)
+
+
+class TLSServer(net.Server):
+    ''' a Server of TLSSockets. 'connection' is emitted once the handshake
+    with the client is done, failed handshakes just close the socket, and
+    so do handshakes taking more than handshake_timeout seconds '''
+
+    __slots__ = ('_context', 'handshake_timeout')
+
+    def __init__(self, address, context, loop=None, max_connections=None,
+                 handshake_timeout=HANDSHAKE_TIMEOUT):
+        '''context is an ssl.SSLContext with a certificate, see
+        server_context()'''
+        self._context = context
+        self.handshake_timeout = handshake_timeout
+        super(TLSServer, self).__init__(address, loop=loop,
+                                        max_connections=max_connections)
+
+    def _accepted(self, conn):
+        sockobj = TLSSocket(self._context, loop=self._loop, sock=conn,
+                            server_side=True)
+        sockobj._server = self
+        if self.handshake_timeout is not None:
+            # cancelled by the end of the handshake, like a connect timeout
+            sockobj._connect_timeout_handler = self._loop.add_timeout(
+                self.handshake_timeout, sockobj._connect_timeout_cb, True)
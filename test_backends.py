@@ -0,0 +1,1332 @@
+#!/usr/bin/python
+
+''' the same scenarios against every backend available here
+
+    python test_backends.py
+    python -m unittest test_backends.PollLoopTest '''
+
+import errno
+import gc
+import logging
+import os
+import socket
+import ssl
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+import ssloop
+from ssloop import loop as loop_
+
+
+class BackendTest(object):
+
+    backend = None
+
+    def setUp(self):
+        self.loop = loop_.backend_class(self.backend)()
+        self.pairs = []
+        # in case a test doesn't stop the loop itself
+        self.loop.add_timeout(5, self.loop.stop)
+
+    def tearDown(self):
+        for a, b in self.pairs:
+            a.close()
+            b.close()
+        self.loop.close()
+
+    def socketpair(self):
+        a, b = socket.socketpair()
+        a.setblocking(False)
+        b.setblocking(False)
+        self.pairs.append((a, b))
+        return a, b
+
+    def udp_socket(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(('127.0.0.1', 0))
+        s.setblocking(False)
+        self.pairs.append((s, s))
+        return s
+
+    def test_timeout_without_fds(self):
+        metrics = self.loop.enable_metrics()
+        self.loop.add_timeout(0.1, self.loop.stop)
+        start = time.time()
+        self.loop.start()
+        self.assertTrue(0.09 <= time.time() - start < 0.5)
+        # no spinning until the deadline
+        self.assertTrue(metrics.iterations < 5, metrics.iterations)
+
+    def test_metrics(self):
+        metrics = self.loop.enable_metrics(slow_callback=0.05)
+        a, b = self.socketpair()
+        self.loop.add_fd(a, loop_.MODE_IN, lambda: a.recv(100))
+        b.send(b'x')
+
+        def slow():
+            time.sleep(0.06)
+        self.loop.add_callback(slow)
+        self.loop.add_timeout(0.01, lambda: None)
+        self.loop.add_timeout(0.1, self.loop.stop)
+        self.loop.start()
+        snapshot = metrics.snapshot()
+        self.assertTrue(snapshot['iterations'] > 0)
+        self.assertEqual(snapshot['poll_wait']['count'], snapshot['iterations'])
+        self.assertTrue(snapshot['ready_fds']['max'] >= 1)
+        self.assertEqual(snapshot['timer_lateness']['count'], 2)
+        self.assertEqual(snapshot['slow_callbacks'], 1)
+        names = [name for name in snapshot['callbacks'] if name.endswith('.slow')]
+        self.assertEqual(len(names), 1)
+        self.assertTrue(snapshot['callbacks'][names[0]]['max'] >= 0.05)
+        # a, and the waker
+        self.assertEqual(snapshot['fds'], 2)
+        # the one of setUp
+        self.assertEqual(snapshot['timers'], 1)
+        self.assertEqual(snapshot['pending_callbacks'], 0)
+        self.loop.disable_metrics()
+        self.loop.add_timeout(0.01, self.loop.stop)
+        self.loop.start()
+        self.assertEqual(metrics.snapshot()['iterations'], snapshot['iterations'])
+        # timed with the monotonic clock of the loop
+        clock = iter([100.0, 100.5])
+        monotonic, loop_._monotonic = loop_._monotonic, lambda: next(clock)
+        try:
+            metrics.call(lambda: None, None)
+        finally:
+            loop_._monotonic = monotonic
+        self.assertEqual(metrics.slow_callbacks, 2)
+
+    def test_close(self):
+        if not os.path.isdir('/proc/self/fd'):
+            self.skipTest('no /proc/self/fd here')
+        gc.collect()
+        fds = len(os.listdir('/proc/self/fd'))
+        for i in range(20):
+            loop = self.loop.new()
+            loop.add_timeout(0, loop.stop)
+            loop.start()
+            loop.close()
+        self.assertEqual(len(os.listdir('/proc/self/fd')), fds)
+
+    def test_timeouts_in_order(self):
+        fired = []
+        for delay in (0.03, 0.01, 0.02):
+            self.loop.add_timeout(delay, lambda delay=delay: fired.append(delay))
+        cancelled = self.loop.add_timeout(0.015, lambda: fired.append('x'))
+        self.loop.remove_handler(cancelled)
+        self.loop.add_timeout(0.05, self.loop.stop)
+        self.loop.start()
+        self.assertEqual(fired, [0.01, 0.02, 0.03])
+
+    def test_timeout_after_slow_callback(self):
+        fired = []
+        start = time.time()
+        self.loop.add_timeout(0.05, lambda: (fired.append(time.time() - start), self.loop.stop()))
+        self.loop.add_callback(lambda: time.sleep(0.1))
+        self.loop.start()
+        # due while the callback ran, so fired right after it
+        self.assertTrue(fired[0] < 0.13, fired)
+
+    def test_coarse_timeouts_in_order(self):
+        fired = []
+        for delay in (0.3, 0.1, 0.2):
+            self.loop.add_timeout(delay, lambda delay=delay: fired.append(delay), coarse=True)
+        cancelled = self.loop.add_timeout(0.15, lambda: fired.append('x'), coarse=True)
+        self.loop.remove_handler(cancelled)
+        # rounded up to the resolution of the wheel, 0.1
+        self.loop.add_timeout(0.45, self.loop.stop)
+        self.loop.start()
+        self.assertEqual(fired, [0.1, 0.2, 0.3])
+
+    def test_callbacks_before_polling(self):
+        fired = []
+        self.loop.add_callback(lambda: fired.append(1))
+        self.loop.add_callback(self.loop.stop)
+        self.loop.start()
+        self.assertEqual(fired, [1])
+
+    def test_readable(self):
+        a, b = self.socketpair()
+        received = []
+
+        def on_readable():
+            received.append(a.recv(100))
+            self.loop.stop()
+        self.loop.add_fd(a, loop_.MODE_IN, on_readable)
+        b.send(b'hello')
+        self.loop.start()
+        self.assertEqual(received, [b'hello'])
+
+    def test_writable(self):
+        a, b = self.socketpair()
+        fired = []
+        self.loop.add_fd(a, loop_.MODE_OUT, lambda: (fired.append(1), self.loop.stop()))
+        self.loop.start()
+        self.assertEqual(fired, [1])
+
+    def test_handlers_of_one_fd(self):
+        a, b = self.socketpair()
+        fired = []
+        reader = self.loop.add_fd(a, loop_.MODE_IN, lambda: fired.append('in'))
+        writer = self.loop.add_fd(a, loop_.MODE_OUT, lambda: fired.append('out'))
+        self.loop.add_timeout(0.05, self.loop.stop)
+        self.loop.start()
+        # nothing to read yet
+        self.assertTrue('out' in fired and 'in' not in fired)
+        self.loop.remove_handler(writer)
+        del fired[:]
+        b.send(b'x')
+        self.loop.add_timeout(0.05, self.loop.stop)
+        self.loop.start()
+        self.assertTrue('in' in fired and 'out' not in fired)
+        self.loop.update_handler_mode(reader, loop_.MODE_OUT)
+        a.recv(100)
+        del fired[:]
+        self.loop.add_timeout(0.05, self.loop.stop)
+        self.loop.start()
+        self.assertTrue(fired and set(fired) == set(['in']))
+
+    def test_removed_handler_not_called(self):
+        a, b = self.socketpair()
+        fired = []
+        handlers = []
+
+        def first():
+            fired.append('first')
+            self.loop.remove_handler(handlers[1])
+            self.loop.stop()
+        handlers.append(self.loop.add_fd(a, loop_.MODE_IN, first))
+        handlers.append(self.loop.add_fd(a, loop_.MODE_IN, lambda: fired.append('second')))
+        b.send(b'x')
+        self.loop.start()
+        self.assertEqual(fired, ['first'])
+
+    def test_poller_updates_batched(self):
+        a, b = self.socketpair()
+        calls = []
+        loop = self.loop
+        nested = []
+
+        def wrap(name, method):
+            # select modifies by removing and adding, count the outer call
+            def wrapper(fd, *args):
+                if fd == a.fileno() and not nested:
+                    calls.append(name)
+                nested.append(name)
+                try:
+                    return method(fd, *args)
+                finally:
+                    nested.pop()
+            return wrapper
+        for name in ('_add_fd', '_modify_fd', '_remove_fd'):
+            setattr(loop, name, wrap(name, getattr(loop, name)))
+        # added and removed before polling, the poller never sees it
+        handler = loop.add_fd(a, loop_.MODE_IN, lambda: None)
+        loop.remove_handler(handler)
+        loop.add_timeout(0.01, loop.stop)
+        loop.start()
+        self.assertEqual(calls, [])
+        # two handlers, and a mode set back before polling, one registration
+        reader = loop.add_fd(a, loop_.MODE_IN, lambda: None)
+        writer = loop.add_fd(a, loop_.MODE_OUT, lambda: None)
+        loop.update_handler_mode(writer, loop_.MODE_IN)
+        loop.update_handler_mode(writer, loop_.MODE_OUT)
+        loop.add_timeout(0.01, loop.stop)
+        loop.start()
+        self.assertEqual(calls, ['_add_fd'])
+        loop.update_handler_mode(writer, loop_.MODE_IN)
+        loop.add_timeout(0.01, loop.stop)
+        loop.start()
+        self.assertEqual(calls, ['_add_fd', '_modify_fd'])
+        # the last handler removed unregisters at once, before a close
+        loop.remove_handler(reader)
+        self.assertEqual(calls, ['_add_fd', '_modify_fd'])
+        loop.remove_handler(writer)
+        self.assertEqual(calls, ['_add_fd', '_modify_fd', '_remove_fd'])
+
+    def test_peer_closed(self):
+        a, b = self.socketpair()
+        received = []
+
+        def on_readable():
+            received.append(a.recv(100))
+            self.loop.stop()
+        self.loop.add_fd(a, loop_.MODE_IN, on_readable)
+        b.close()
+        self.loop.start()
+        self.assertEqual(received, [b''])
+
+    def test_run_in_executor(self):
+        results = []
+        called_in = set()
+
+        def done(error, result):
+            results.append((error, result))
+            called_in.add(threading.current_thread())
+            if len(results) == 6:
+                self.loop.stop()
+
+        def work(n):
+            time.sleep(0.1)
+            return threading.current_thread(), n * 2
+        start = time.time()
+        for n in range(5):
+            self.loop.run_in_executor(work, n, callback=done)
+        self.loop.run_in_executor(lambda: 1 // 0, callback=done)
+        self.loop.start()
+        # in parallel, but in at most max_workers threads
+        self.assertTrue(time.time() - start < 0.45)
+        errors = [error for error, result in results if error is not None]
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(isinstance(errors[0], ZeroDivisionError))
+        done_in = [result for error, result in results if error is None]
+        self.assertEqual(sorted(n for thread, n in done_in), [0, 2, 4, 6, 8])
+        # called back from the loop
+        self.assertEqual(called_in, set([threading.current_thread()]))
+        threads = set(thread for thread, n in done_in)
+        self.assertFalse(threading.current_thread() in threads)
+        self.assertTrue(len(threads) <= self.loop.executor.max_workers)
+
+    def test_call_soon_threadsafe(self):
+        fired = []
+
+        def from_thread():
+            time.sleep(0.05)
+            self.loop.call_soon_threadsafe(lambda: (fired.append(1), self.loop.stop()))
+        threading.Thread(target=from_thread).start()
+        start = time.time()
+        self.loop.start()
+        self.assertEqual(fired, [1])
+        self.assertTrue(time.time() - start < 1)
+
+    def test_echo(self):
+        data = os.urandom(1024 * 1024)
+        received = []
+        server = ssloop.Server(('127.0.0.1', 0), loop=self.loop)
+        server.on('connection', lambda server, conn: conn.on('data', lambda s, d: s.write(d)))
+        server.listen()
+
+        def on_data(s, d):
+            received.append(d)
+            if sum(map(len, received)) == len(data):
+                s.close()
+                server.close()
+                self.loop.stop()
+        client = ssloop.Socket(loop=self.loop)
+        client.on('connect', lambda s: s.write(data))
+        client.on('data', on_data)
+        client.connect(server._socket.getsockname())
+        self.loop.start()
+        self.assertEqual(b''.join(received), data)
+
+    def test_max_connections(self):
+        server = ssloop.Server(('127.0.0.1', 0), loop=self.loop, max_connections=1)
+        accepted = []
+        server.on('connection', lambda server, conn: accepted.append(conn))
+        server.listen()
+        address = server._socket.getsockname()
+        clients = [socket.create_connection(address) for i in range(2)]
+        self.pairs.append(clients)
+        self.loop.add_timeout(0.1, self.loop.stop)
+        self.loop.start()
+        # the second one waits in the backlog
+        self.assertEqual(len(accepted), 1)
+        self.assertEqual(server.connections, 1)
+        accepted[0].close()
+        self.assertEqual(server.connections, 0)
+        self.loop.add_timeout(0.1, self.loop.stop)
+        self.loop.start()
+        self.assertEqual(len(accepted), 2)
+        self.assertEqual(server.connections, 1)
+        server.close()
+
+    def test_out_of_fds(self):
+        try:
+            import resource
+        except ImportError:
+            self.skipTest('no resource module here')
+        if not os.path.isdir('/proc/self/fd'):
+            self.skipTest('no /proc/self/fd here')
+        server = ssloop.Server(('127.0.0.1', 0), loop=self.loop)
+        accepted = []
+        server.on('connection', lambda server, conn: accepted.append(conn))
+        server.listen()
+        address = server._socket.getsockname()
+        client = socket.create_connection(address)
+        self.pairs.append((client, client))
+        # no fd left for accept()
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(fds) + 1, hard))
+        fillers = []
+        try:
+            while True:
+                try:
+                    fillers.append(os.open(os.devnull, os.O_RDONLY))
+                except OSError:
+                    break
+            self.loop.add_timeout(0.1, self.loop.stop)
+            self.loop.start()
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+            for fd in fillers:
+                os.close(fd)
+        # dropped rather than left in the backlog, spinning the loop
+        self.assertEqual(accepted, [])
+        client.settimeout(1)
+        try:
+            self.assertEqual(client.recv(100), b'')
+        except socket.error:
+            # reset
+            pass
+        self.assertNotEqual(server._spare_fd, None)
+        # and accepting again once there are fds
+        other = socket.create_connection(address)
+        self.pairs.append((other, other))
+        self.loop.add_timeout(0.1, self.loop.stop)
+        self.loop.start()
+        self.assertEqual(len(accepted), 1)
+        server.close()
+
+    def test_water_marks(self):
+        a, b = self.socketpair()
+        sock = ssloop.Socket(sock=a, loop=self.loop)
+        sock.set_water_marks(32 * 1024, 8 * 1024)
+        drained = []
+
+        def on_drain(s):
+            drained.append(s.buffered_size)
+            self.loop.stop()
+        sock.on('drain', on_drain)
+        self.assertTrue(sock.write(b'x' * 16 * 1024))
+        # more than the socket takes, the rest stays buffered
+        self.assertFalse(sock.write(b'x' * 4 * 1024 * 1024))
+        self.assertTrue(sock.buffered_size > 32 * 1024)
+        self.loop.add_timeout(0.05, self.loop.stop)
+        self.loop.start()
+        self.assertEqual(drained, [])
+        received = []
+
+        def on_readable():
+            received.append(len(b.recv(65536)))
+        self.loop.add_fd(b, loop_.MODE_IN, on_readable)
+        self.loop.start()
+        self.assertEqual(len(drained), 1)
+        self.assertTrue(drained[0] <= 8 * 1024, drained)
+        self.assertTrue(sock.write(b'x'))
+
+    def test_idle_socket_memory(self):
+        for obj in (ssloop.Socket(loop=self.loop),
+                    ssloop.Server(('127.0.0.1', 0), loop=self.loop),
+                    loop_.Handler(None), loop_.FdRecord(0)):
+            self.assertFalse(hasattr(obj, '__dict__'), obj)
+        server = ssloop.Server(('127.0.0.1', 0), loop=self.loop)
+        accepted = []
+        server.on('connection', lambda server, conn: (accepted.append(conn), self.loop.stop()))
+        server.listen()
+        client = socket.create_connection(server._socket.getsockname())
+        self.pairs.append((client, client))
+        self.loop.start()
+        conn = accepted[0]
+        # no listener table, nor write queue, until needed
+        self.assertEqual(conn._events, None)
+        self.assertEqual(conn._buffers, None)
+        conn.write(b'hello')
+        self.assertEqual(client.recv(100), b'hello')
+        # dropped once drained
+        self.assertEqual(conn._buffers, None)
+        self.assertEqual(server.connections, 1)
+        conn.close()
+        self.assertEqual(server.connections, 0)
+        server.close()
+        # collecting closed ones doesn't close them again
+        logged = []
+        handler = logging.Handler()
+        handler.emit = logged.append
+        logging.getLogger().addHandler(handler)
+        try:
+            del conn, server, accepted[:]
+            gc.collect()
+        finally:
+            logging.getLogger().removeHandler(handler)
+        self.assertEqual(logged, [])
+
+    def test_zero_copy(self):
+        a, b = self.socketpair()
+        sock = ssloop.Socket(sock=a, loop=self.loop)
+        sock.set_zero_copy()
+        data = os.urandom(32 * 1024)
+        received = []
+
+        def on_data(s, view):
+            self.assertTrue(isinstance(view, memoryview))
+            received.append(view.tobytes())
+            if sum(map(len, received)) == len(data):
+                self.loop.stop()
+        sock.on('data', on_data)
+        for i in range(0, len(data), 1000):
+            b.send(data[i:i + 1000])
+        self.loop.start()
+        self.assertEqual(b''.join(received), data)
+        # one pooled buffer served every read, and is back in the pool
+        self.assertEqual(len(self.loop.buffer_pool._free), 1)
+
+    def test_adaptive_read_size(self):
+        a, b = self.socketpair()
+        sock = ssloop.Socket(sock=a, loop=self.loop)
+        received = []
+
+        def on_data(s, d):
+            received.append(d)
+            self.loop.stop()
+        sock.on('data', on_data)
+
+        def receive(data):
+            del received[:]
+            b.send(data)
+            while sum(map(len, received)) < len(data):
+                self.loop.start()
+        receive(os.urandom(64 * 1024))
+        grown = sock._read_size
+        self.assertTrue(grown > ssloop.net.RECV_BUFSIZE, grown)
+        # one short message doesn't shrink it, two in a row do
+        receive(b'x')
+        self.assertEqual(sock._read_size, grown)
+        receive(b'x')
+        self.assertEqual(sock._read_size, grown // 2)
+
+    def test_read_budget(self):
+        self.loop.read_budget = 4096
+        received = []
+        data = os.urandom(64 * 1024)
+        for name in ('a', 'b'):
+            a, b = self.socketpair()
+            sock = ssloop.Socket(sock=a, loop=self.loop)
+            sock.on('data', lambda s, d, name=name: received.append((name, d)))
+            b.send(data)
+
+        def check():
+            if sum(len(d) for name, d in received) < 2 * len(data):
+                self.loop.add_callback(check)
+            else:
+                self.loop.stop()
+        self.loop.add_callback(check)
+        self.loop.start()
+        names = [name for name, d in received]
+        # the sockets took turns rather than one draining its fd first
+        turns = sum(1 for x, y in zip(names, names[1:]) if x != y)
+        self.assertTrue(turns > 1, names)
+        for name in ('a', 'b'):
+            self.assertEqual(b''.join(d for n, d in received if n == name), data)
+
+    def test_half_close(self):
+        a, b = self.socketpair()
+        sock = ssloop.Socket(sock=a, loop=self.loop)
+        reply = os.urandom(1024 * 1024)
+        errors = []
+        self.loop._on_error = errors.append
+        # the peer is done writing, but still reading
+        sock.on('end', lambda s: (s.write(reply), s.end()))
+        received = []
+
+        def on_readable():
+            d = b.recv(65536)
+            received.append(d)
+            if not d:
+                self.loop.stop()
+        self.loop.add_fd(b, loop_.MODE_IN, on_readable)
+        b.shutdown(socket.SHUT_WR)
+        self.loop.start()
+        self.assertEqual(errors, [])
+        self.assertEqual(b''.join(received), reply)
+        self.assertEqual(sock._state, ssloop.net.STATE_CLOSED)
+
+    def test_gather_writes(self):
+        a, b = self.socketpair()
+        filler = 0
+        try:
+            while True:
+                filler += a.send(b'f' * 65536)
+        except socket.error:
+            pass
+        sock = ssloop.Socket(sock=a, loop=self.loop)
+        sends = []
+
+        class CountingSocket(object):
+            def send(self, data):
+                sends.append(len(data))
+                return a.send(data)
+
+            def sendmsg(self, iov):
+                sends.append(sum(map(len, iov)))
+                return a.sendmsg(iov)
+
+            def __getattr__(self, name):
+                return getattr(a, name)
+        sock._socket = CountingSocket()
+        chunks = [os.urandom(100) for i in range(100)]
+        for chunk in chunks:
+            sock.write(chunk)
+        received = []
+
+        def on_readable():
+            received.append(b.recv(65536))
+            if sum(map(len, received)) == filler + 10000:
+                self.loop.stop()
+        self.loop.add_fd(b, loop_.MODE_IN, on_readable)
+        self.loop.start()
+        sock._socket = a
+        self.assertEqual(b''.join(received)[filler:], b''.join(chunks))
+        # the first write found the socket full, the others were queued
+        # and sent together
+        self.assertTrue(len(sends) <= 3, sends)
+
+    def test_send_file(self):
+        import io
+        data = os.urandom(8 * 1024 * 1024)
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        f.flush()
+        # a real file goes through sendfile where there is one, a file
+        # object without fileno() is always read in chunks
+        files = [(f, 0, None), (io.BytesIO(data), 1000, 100000)]
+        received = []
+        server = ssloop.Server(('127.0.0.1', 0), loop=self.loop)
+
+        def on_connection(server, conn):
+            conn.on('data', lambda s, d: received.append(d))
+            conn.on('end', lambda s: self.loop.stop())
+            # so the files can't be sent at once
+            conn.pause()
+            self.loop.add_timeout(0.1, conn.resume)
+        server.on('connection', on_connection)
+        server._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024)
+        server.listen()
+        sent = []
+        events = []
+        client = ssloop.Socket(loop=self.loop)
+        client.on('sendfile', lambda s, fileobj: (sent.append(fileobj), events.append('sendfile')))
+        client.on('drain', lambda s: (events.append('drain'), s.end()))
+        client.connect(server._socket.getsockname())
+        calls = []
+        sendfile = ssloop.net.sendfile.sendfile
+
+        def counting_sendfile(*args):
+            calls.append(args)
+            return sendfile(*args)
+        ssloop.net.sendfile.sendfile = counting_sendfile
+        try:
+            # queued until connected
+            results = [client.send_file(*args) for args in files]
+            self.loop.start()
+        finally:
+            ssloop.net.sendfile.sendfile = sendfile
+        server.close()
+        fd = f.fileno()
+        f.close()
+        self.assertEqual(results, [False, False])
+        self.assertEqual(sent, [fileobj for fileobj, offset, count in files])
+        self.assertEqual(b''.join(received), data + data[1000:101000])
+        # no 'drain' while a file is queued
+        self.assertEqual(events, ['sendfile', 'sendfile', 'drain'])
+        if ssloop.net.sendfile.available:
+            self.assertTrue(calls)
+            self.assertTrue(all(args[1] == fd for args in calls))
+
+    def test_unix_echo(self):
+        path = os.path.join(tempfile.mkdtemp(), 'echo.sock')
+        received = []
+        server = ssloop.Server(path, loop=self.loop)
+        server.on('connection', lambda server, conn: conn.on('data', lambda s, d: s.write(d)))
+        server.listen()
+
+        def on_data(s, d):
+            received.append(d)
+            s.close()
+            server.close()
+            self.loop.stop()
+        client = ssloop.Socket(loop=self.loop)
+        client.on('connect', lambda s: s.write(b'hello'))
+        client.on('data', on_data)
+        client.connect(path)
+        self.loop.start()
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+        self.assertEqual(received, [b'hello'])
+
+    def test_unix_path_in_use(self):
+        path = os.path.join(tempfile.mkdtemp(), 'server.sock')
+        # left by a server gone, taken over
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        server = ssloop.Server(path, loop=self.loop)
+        server.listen()
+        # a server listening on it keeps it
+        try:
+            ssloop.Server(path, loop=self.loop)
+            self.fail('bound to the path of a live server')
+        except socket.error as e:
+            self.assertEqual(e.errno, errno.EADDRINUSE)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        client.close()
+        server.close()
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+
+    def test_pipe(self):
+        a1, b1 = self.socketpair()
+        a2, b2 = self.socketpair()
+        producer = ssloop.Socket(sock=a1, loop=self.loop)
+        src = ssloop.Socket(sock=b1, loop=self.loop)
+        dst = ssloop.Socket(sock=a2, loop=self.loop)
+        consumer = ssloop.Socket(sock=b2, loop=self.loop)
+        src.pipe(dst)
+        data = os.urandom(4 * 1024 * 1024)
+        received = []
+        ended = []
+        consumer.on('data', lambda s, d: received.append(d))
+        consumer.on('end', lambda s: ended.append(1))
+        dst.on('close', lambda s: self.loop.stop())
+        producer.write(data)
+        producer.end()
+        # nothing is read from dst, so src must stop reading
+        consumer.pause()
+        self.loop.add_timeout(0.2, self.loop.stop)
+        self.loop.start()
+        self.assertTrue(src._paused)
+        self.assertTrue(dst.buffered_size < 1024 * 1024, dst.buffered_size)
+        consumer.resume()
+        self.loop.start()
+        self.assertEqual(ended, [1])
+        self.assertEqual(b''.join(received), data)
+        # the end of src ended dst, closed once its peer ended too
+        self.assertEqual((src._state, dst._state), (ssloop.net.STATE_CLOSED, ssloop.net.STATE_CLOSED))
+        self.assertTrue(src._pipe is None)
+        gc.collect()
+        garbage = len(gc.garbage)
+        del producer, src, dst, consumer
+        gc.collect()
+        self.assertEqual(len(gc.garbage), garbage)
+
+    def test_pipe_dst_closed(self):
+        a1, b1 = self.socketpair()
+        a2, b2 = self.socketpair()
+        src = ssloop.Socket(sock=b1, loop=self.loop)
+        dst = ssloop.Socket(sock=a2, loop=self.loop)
+        src.pipe(dst)
+        src.on('close', lambda s: self.loop.stop())
+        # the peer of dst goes away, dst closes once writing to it fails
+        b2.close()
+        a1.send(b'x')
+        self.loop.start()
+        self.assertEqual((src._state, dst._state), (ssloop.net.STATE_CLOSED, ssloop.net.STATE_CLOSED))
+        self.assertEqual(src.listener_count('close'), 1)
+        self.assertEqual(dst.listener_count('close'), 0)
+
+    def test_pipe_half_close(self):
+        upstream = ssloop.Server(('127.0.0.1', 0), loop=self.loop)
+
+        def on_upstream(server, conn):
+            request = []
+            conn.on('data', lambda s, d: request.append(d))
+            # replies once the request is done
+            conn.on('end', lambda s: (s.write(b'reply to ' + b''.join(request)), s.end()))
+        upstream.on('connection', on_upstream)
+        upstream.listen()
+        relay = ssloop.Server(('127.0.0.1', 0), loop=self.loop)
+
+        def on_relay(server, conn):
+            out = ssloop.Socket(loop=self.loop)
+            out.connect(upstream._socket.getsockname())
+            conn.pipe(out)
+            out.pipe(conn)
+        relay.on('connection', on_relay)
+        relay.listen()
+        client = socket.create_connection(relay._socket.getsockname())
+        self.pairs.append((client, client))
+        client.setblocking(False)
+        client.send(b'req')
+        client.shutdown(socket.SHUT_WR)
+        received = []
+
+        def on_readable():
+            d = client.recv(100)
+            received.append(d)
+            if not d:
+                self.loop.stop()
+        self.loop.add_fd(client, loop_.MODE_IN, on_readable)
+        self.loop.start()
+        self.assertEqual(b''.join(received), b'reply to req')
+        self.assertEqual(received[-1], b'')
+        relay.close()
+        upstream.close()
+
+    def test_end_while_connecting(self):
+        server = ssloop.Server(('127.0.0.1', 0), loop=self.loop)
+        received = []
+
+        def on_connection(server, conn):
+            conn.on('data', lambda s, d: received.append(d))
+            conn.on('end', lambda s: self.loop.stop())
+        server.on('connection', on_connection)
+        server.listen()
+        client = ssloop.Socket(loop=self.loop)
+        client.connect(server._socket.getsockname())
+        client.write(b'request')
+        client.end()
+        self.loop.start()
+        self.assertEqual(received, [b'request'])
+        self.assertEqual(client._state, ssloop.net.STATE_CLOSED)
+        server.close()
+
+    def test_send_fds(self):
+        a, b = self.socketpair()
+        sender = ssloop.Socket(sock=a, loop=self.loop)
+        receiver = ssloop.Socket(sock=b, loop=self.loop)
+        try:
+            receiver.set_receive_fds()
+        except NotImplementedError:
+            self.skipTest('no SCM_RIGHTS here')
+        passed = [self.socketpair() for i in range(2)]
+        received = []
+        passed_fds = []
+
+        def on_fds(s, fds):
+            passed_fds.append(len(fds))
+            for i, fd in enumerate(fds):
+                os.write(fd, b'through fd %d' % i)
+                os.close(fd)
+        receiver.on('fds', on_fds)
+
+        def on_data(s, d):
+            received.append(d)
+            if b''.join(received) == b'axb':
+                self.loop.stop()
+        receiver.on('data', on_data)
+        sender.write(b'a')
+        sender.send_fds([p[0] for p in passed], b'x')
+        sender.write(b'b')
+        for p in passed:
+            p[0].close()
+        self.loop.start()
+        sender.close()
+        receiver.close()
+        self.assertEqual(b''.join(received), b'axb')
+        self.assertEqual(passed_fds, [2])
+        for i, p in enumerate(passed):
+            self.assertEqual(p[1].recv(100), b'through fd %d' % i)
+
+    def tls_echo_server(self, **kwargs):
+        from ssloop import tls
+        server = ssloop.TLSServer(('127.0.0.1', 0), tls.server_context(self.pem), loop=self.loop, **kwargs)
+        server.on('connection', lambda server, conn: conn.on('data', lambda s, d: s.write(d)))
+        server.listen()
+        return server
+
+    @property
+    def pem(self):
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_tls.pem')
+
+    def tls_echo(self, server, context):
+        data = os.urandom(256 * 1024)
+        received = []
+        client = ssloop.TLSSocket(context, loop=self.loop, server_hostname='localhost')
+
+        def on_data(s, d):
+            received.append(d)
+            if sum(map(len, received)) == len(data):
+                s.close()
+                self.loop.stop()
+        client.on('data', on_data)
+        client.connect(server._socket.getsockname())
+        # sent once the handshake is done
+        client.write(data)
+        self.loop.start()
+        self.assertEqual(b''.join(received), data)
+
+    def test_tls_echo(self):
+        server = self.tls_echo_server()
+        self.tls_echo(server, ssl.create_default_context(cafile=self.pem))
+        server.close()
+
+    def test_tls_handshake_timeout(self):
+        server = self.tls_echo_server(handshake_timeout=0.2)
+        # connects and says nothing
+        client = socket.create_connection(server._socket.getsockname())
+        client.setblocking(False)
+        received = []
+        self.loop.add_fd(client, loop_.MODE_IN, lambda: (received.append(client.recv(100)), self.loop.stop()))
+        start = time.time()
+        self.loop.start()
+        client.close()
+        server.close()
+        self.assertEqual(received, [b''])
+        self.assertTrue(0.15 < time.time() - start < 1)
+        self.assertEqual(server.connections, 0)
+
+    def test_connection_pool(self):
+        accepted = []
+        server = ssloop.Server(('127.0.0.1', 0), loop=self.loop)
+        server.on('connection', lambda server, conn: (accepted.append(conn),
+                                                      conn.on('data', lambda s, d: s.write(d))))
+        server.listen()
+        address = server._socket.getsockname()
+        pool = ssloop.ConnectionPool(loop=self.loop, max_per_key=2)
+        replies = []
+
+        def request(i):
+            def on_sock(error, sock):
+                def on_data(s, d):
+                    replies.append(d)
+                    pool.release(s)
+                    if len(replies) == 5:
+                        self.loop.stop()
+                sock.on('data', on_data)
+                sock.write(b'%d' % i)
+            pool.acquire(address, on_sock)
+        for i in range(5):
+            request(i)
+        self.loop.start()
+        self.assertEqual(sorted(replies), [b'0', b'1', b'2', b'3', b'4'])
+        self.assertEqual((pool.misses, pool.hits, pool.waits), (2, 3, 3))
+        self.assertEqual(pool.snapshot()['idle'], 2)
+        # the peer closing an idle socket is noticed
+        accepted[0].close()
+        self.loop.add_timeout(0.05, self.loop.stop)
+        self.loop.start()
+        self.assertEqual(pool.snapshot()['idle'], 1)
+        self.assertEqual(pool.closed_idle, 1)
+        pool.close()
+        server.close()
+        self.assertEqual(pool.snapshot()['open'], 0)
+
+    def test_connection_pool_max_total(self):
+        servers = []
+        for i in range(2):
+            server = ssloop.Server(('127.0.0.1', 0), loop=self.loop)
+            server.listen()
+            servers.append(server)
+        first, second = [server._socket.getsockname() for server in servers]
+        pool = ssloop.ConnectionPool(loop=self.loop, max_total=1, idle_timeout=10)
+        acquired = []
+
+        def on_second(error, sock):
+            acquired.append(sock)
+            self.loop.stop()
+
+        def on_first(error, sock):
+            acquired.append(sock)
+            pool.acquire(second, on_second)
+            # parked, then closed to make room for the other address
+            self.loop.add_callback(lambda: pool.release(sock))
+        pool.acquire(first, on_first)
+        start = time.time()
+        self.loop.start()
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(len(acquired), 2)
+        self.assertEqual(acquired[0]._state, ssloop.net.STATE_CLOSED)
+        self.assertEqual((pool.waits, pool.evicted), (1, 1))
+        pool.close()
+        acquired[1].close()
+        for server in servers:
+            server.close()
+
+    def test_framing(self):
+        from ssloop import framing
+        a, b = self.socketpair()
+        sock = ssloop.Socket(sock=a, loop=self.loop)
+        sock.set_framing(ssloop.VarintDecoder(max_frame_size=1000))
+        frames = [b'x' * n for n in (0, 1, 127, 128, 999)]
+        messages = []
+        errors = []
+
+        def on_message(s, frame):
+            messages.append(frame)
+            if len(messages) == 2:
+                # the frames already received wait for resume()
+                s.pause()
+                self.loop.add_timeout(0.01, s.resume)
+        sock.on('message', on_message)
+        sock.on('error', lambda s, e: errors.append(e))
+        sock.on('close', lambda s: self.loop.stop())
+        data = b''.join(framing.encode_varint(len(f)) + f for f in frames)
+        for i in range(0, len(data), 100):
+            b.send(data[i:i + 100])
+        b.send(framing.encode_varint(1001))
+        self.loop.start()
+        self.assertEqual(messages, frames)
+        self.assertTrue(isinstance(errors[0], framing.FrameError))
+
+    def test_instance_per_thread(self):
+        loops = []
+        thread = threading.Thread(target=lambda: loops.append(ssloop.instance()))
+        thread.start()
+        thread.join()
+        self.assertTrue(loops[0] is not ssloop.instance())
+        self.assertTrue(type(self.loop.new()) is type(self.loop))
+
+    def test_multiloop_server(self):
+        server = ssloop.MultiLoopServer(('127.0.0.1', 0), threads=2, loop=self.loop)
+        loops = []
+
+        def on_connection(server, conn):
+            # in the thread of the loop of conn
+            loops.append(ssloop.instance() is conn._loop and conn._loop)
+            conn.on('data', lambda s, d: s.write(d))
+        server.on('connection', on_connection)
+        server.listen()
+        address = server._socket.getsockname()
+        replies = []
+
+        def clients():
+            for i in range(4):
+                c = socket.create_connection(address)
+                c.sendall(b'x')
+                replies.append(c.recv(10))
+                c.close()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        threading.Thread(target=clients).start()
+        self.loop.start()
+        server.close()
+        self.assertEqual(replies, [b'x'] * 4)
+        self.assertEqual(sorted(map(id, loops)), sorted(map(id, server.loops * 2)))
+
+    def test_multiloop_server_close(self):
+        if not os.path.isdir('/proc/self/fd'):
+            self.skipTest('no /proc/self/fd here')
+        self.loop.read_budget = 1234
+        gc.collect()
+        fds = len(os.listdir('/proc/self/fd'))
+        for i in range(3):
+            server = ssloop.MultiLoopServer(('127.0.0.1', 0), threads=2, loop=self.loop)
+            self.assertEqual([l.read_budget for l in server.loops], [1234] * 2)
+            server.listen()
+            server.close()
+            self.assertTrue(all(t.server is None for t in server._threads))
+        self.assertEqual(len(os.listdir('/proc/self/fd')), fds)
+
+    def test_datagram_echo(self):
+        received = []
+        server = ssloop.DatagramSocket(loop=self.loop)
+        server.bind(('127.0.0.1', 0))
+        address = server.getsockname()
+        server.on('message', lambda s, data, address: s.send(data[::-1], address))
+        client = ssloop.DatagramSocket(loop=self.loop)
+
+        def on_message(s, data, address):
+            received.append((data, address))
+            if len(received) == 3:
+                self.loop.stop()
+        client.on('message', on_message)
+        for data in (b'abc', b'', b'x' * 60000):
+            client.send(data, address)
+        self.loop.start()
+        client.close()
+        server.close()
+        self.assertEqual(sorted(data for data, address in received), [b'', b'cba', b'x' * 60000])
+        self.assertEqual(received[0][1], address)
+
+    def test_udp_lookup(self):
+        from ssloop import dns
+        nameserver, other = self.udp_socket(), self.udp_socket()
+        ports = []
+
+        def answer(query, ip, qid=None, question=None):
+            if qid is None:
+                qid, = struct.unpack('!H', query[:2])
+            header = struct.pack('!HHHHHH', qid, 0x8180, 1, 1, 0, 0)
+            record = struct.pack('!HHHIH', 0xc00c, dns.QTYPE_A, dns.QCLASS_IN, 60, 4)
+            return header + (question or query[12:]) + record + socket.inet_aton(ip)
+
+        def on_query():
+            query, addr = nameserver.recvfrom(512)
+            ports.append(addr[1])
+            qid, = struct.unpack('!H', query[:2])
+            # spoofed: another source, another question, another id
+            other.sendto(answer(query, '6.6.6.1'), addr)
+            nameserver.sendto(answer(query, '6.6.6.2', question=dns.build_query(0, 'other.test', 1)[12:]), addr)
+            nameserver.sendto(answer(query, '6.6.6.3', qid=qid ^ 1), addr)
+            nameserver.sendto(answer(query, '1.2.3.4'), addr)
+        self.loop.add_fd(nameserver, loop_.MODE_IN, on_query)
+        results = []
+
+        def done(key, error, addrs, ttl=None):
+            results.append((key[0], error, [addr[4] for addr in addrs]))
+            if len(results) == 2:
+                self.loop.stop()
+        lookup = dns.UDPLookup(self.loop, done, ['127.0.0.1'], nameserver.getsockname()[1])
+        for host in ('a.test', 'b.test'):
+            lookup.lookup((host, 80, socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP))
+        self.loop.start()
+        self.assertEqual(sorted(results), [('a.test', None, [('1.2.3.4', 80)]),
+                                           ('b.test', None, [('1.2.3.4', 80)])])
+        # a port per query
+        self.assertEqual(len(set(ports)), 2)
+
+    def test_connect_refused(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        address = s.getsockname()
+        s.close()
+        errors = []
+        client = ssloop.Socket(loop=self.loop)
+        client.on('error', lambda s, e: errors.append(e))
+        client.on('close', lambda s: self.loop.stop())
+        client.connect(address)
+        self.loop.start()
+        self.assertEqual(len(errors), 1)
+
+    def unreachable(self):
+        '''an address connects to hang on, a listener with a full backlog'''
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        s.listen(0)
+        filler = socket.create_connection(s.getsockname())
+        self.pairs.append((s, filler))
+        return s.getsockname()
+
+    def resolve_to(self, *addresses):
+        '''makes connect() resolve any hostname to addresses, in order'''
+        loop = self.loop
+        addrs = [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', a)
+                 for a in addresses]
+
+        class Resolver(object):
+            def resolve(self, host, port, callback):
+                loop.add_callback(lambda: callback(None, addrs))
+        loop.resolver = Resolver()
+
+    def test_connect_timeout(self):
+        errors = []
+        client = ssloop.Socket(loop=self.loop)
+        client.on('error', lambda s, e: errors.append(e))
+        client.on('close', lambda s: self.loop.stop())
+        start = time.time()
+        client.connect(self.unreachable(), timeout=0.2)
+        self.loop.start()
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(isinstance(errors[0], socket.timeout))
+
+    def test_connect_timeout_while_resolving(self):
+        class Resolver(object):
+            def resolve(self, host, port, callback):
+                pass
+        self.loop.resolver = Resolver()
+        errors = []
+        client = ssloop.Socket(loop=self.loop)
+        client.on('error', lambda s, e: errors.append(e))
+        client.on('close', lambda s: self.loop.stop())
+        client.connect(('example.com', 80), timeout=0.1)
+        self.loop.start()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(isinstance(errors[0], socket.timeout))
+
+    def connect_server(self):
+        server = ssloop.Server(('127.0.0.1', 0), loop=self.loop)
+        server.on('connection', lambda server, conn: conn.write(b'hello'))
+        server.listen()
+        received = []
+        client = ssloop.Socket(loop=self.loop)
+        client.on('data', lambda s, d: (received.append(d), self.loop.stop()))
+        return server, client, received
+
+    def test_happy_eyeballs(self):
+        server, client, received = self.connect_server()
+        self.resolve_to(self.unreachable(), server._socket.getsockname())
+        start = time.time()
+        client.connect(('example.com', 80))
+        self.loop.start()
+        elapsed = time.time() - start
+        self.assertEqual(received, [b'hello'])
+        # the second address was tried without giving up on the first
+        self.assertTrue(ssloop.net.CONNECTION_ATTEMPT_DELAY - 0.05 <= elapsed < 1, elapsed)
+        # which was closed once the second connected
+        self.assertEqual(client._connector, None)
+        client.close()
+        server.close()
+
+    def test_connect_next_address_after_refused(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        refused = s.getsockname()
+        s.close()
+        server, client, received = self.connect_server()
+        self.resolve_to(refused, server._socket.getsockname())
+        start = time.time()
+        client.connect(('example.com', 80))
+        self.loop.start()
+        self.assertEqual(received, [b'hello'])
+        # without waiting for the attempt delay
+        self.assertTrue(time.time() - start < ssloop.net.CONNECTION_ATTEMPT_DELAY)
+        client.close()
+        server.close()
+
+
+for _name in loop_.available_backends():
+    _cls = loop_.backend_class(_name)
+    globals()[_cls.__name__ + 'Test'] = type(_cls.__name__ + 'Test', (BackendTest, unittest.TestCase),
+                                             {'backend': _name})
+
+
+class SelectLimitTest(unittest.TestCase):
+
+    def test_fd_above_fd_setsize(self):
+        from ssloop.impl import select_loop
+        loop = select_loop.SelectLoop()
+        a, b = socket.socketpair()
+        fd = select_loop.FD_SETSIZE + 10
+        try:
+            os.dup2(a.fileno(), fd)
+        except OSError:
+            self.skipTest('too few fds allowed')
+        try:
+            loop._on_error = lambda exc_info: None
+            handler = loop.add_fd(fd, loop_.MODE_IN, lambda: None)
+            loop.add_timeout(0.01, loop.stop)
+            loop.start()
+            self.assertTrue(handler.cancelled and handler.error)
+        finally:
+            os.close(fd)
+            a.close()
+            b.close()
+
+    def test_socket_refused(self):
+        from ssloop.impl import select_loop
+        loop = select_loop.SelectLoop()
+        # register the waker before anything is refused
+        loop.add_timeout(0.01, loop.stop)
+        loop.start()
+        a, b = socket.socketpair()
+        b.close()
+        sock = ssloop.Socket(sock=a, loop=loop)
+        errors = []
+        sock.on('error', lambda s, e: errors.append(e))
+        sock.on('close', lambda s: loop.stop())
+        loop.add_timeout(5, loop.stop)
+        fd_setsize = select_loop.FD_SETSIZE
+        select_loop.FD_SETSIZE = 0
+        try:
+            loop.start()
+        finally:
+            select_loop.FD_SETSIZE = fd_setsize
+            loop.close()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(isinstance(errors[0], ValueError))
+        self.assertEqual(sock._state, ssloop.net.STATE_CLOSED)
+
+
+@unittest.skipUnless('epoll' in loop_.available_backends(), 'no epoll here')
+class EdgeTriggeredTest(unittest.TestCase):
+
+    def setUp(self):
+        from ssloop.impl import epoll_loop
+        self.loop = epoll_loop.EpollLoop(edge_triggered=True)
+        self.loop.add_timeout(5, self.loop.stop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_echo(self):
+        data = os.urandom(1024 * 1024)
+        received = []
+        server = ssloop.Server(('127.0.0.1', 0), loop=self.loop)
+        server.on('connection', lambda server, conn: conn.on('data', lambda s, d: s.write(d)))
+        server.listen()
+
+        def on_data(s, d):
+            received.append(d)
+            if sum(map(len, received)) == len(data):
+                s.close()
+                server.close()
+                self.loop.stop()
+        client = ssloop.Socket(loop=self.loop)
+        client.on('connect', lambda s: s.write(data))
+        client.on('data', on_data)
+        client.connect(server._socket.getsockname())
+        self.loop.start()
+        self.assertEqual(b''.join(received), data)
+
+    def test_multiloop_server(self):
+        server = ssloop.MultiLoopServer(('127.0.0.1', 0), threads=2, loop=self.loop)
+        self.assertEqual([l.edge_triggered for l in server.loops], [True] * 2)
+        server.close()
+
+    def test_pause_resume(self):
+        a, b = socket.socketpair()
+        sock = ssloop.Socket(sock=a, loop=self.loop)
+        peer = ssloop.Socket(sock=b, loop=self.loop)
+        data = os.urandom(200 * 1024)
+        received = []
+
+        def on_data(s, d):
+            received.append(d)
+            # nothing new arrives while paused, the fd won't be reported
+            # again after resume()
+            s.pause()
+            self.loop.add_callback(s.resume)
+        sock.on('data', on_data)
+        sock.on('end', lambda s: self.loop.stop())
+        peer.write(data)
+        peer.end()
+        self.loop.start()
+        self.assertEqual(b''.join(received), data)
+
+    def test_read_budget(self):
+        self.loop.read_budget = 4096
+        a, b = socket.socketpair()
+        sock = ssloop.Socket(sock=a, loop=self.loop)
+        data = os.urandom(64 * 1024)
+        received = []
+
+        def on_data(s, d):
+            received.append(d)
+            if sum(map(len, received)) == len(data):
+                self.loop.stop()
+        sock.on('data', on_data)
+        # reported once, the rest is read by callbacks the socket schedules
+        b.send(data)
+        self.loop.start()
+        b.close()
+        self.assertEqual(b''.join(received), data)
+
+    def test_half_close(self):
+        a, b = socket.socketpair()
+        b.setblocking(False)
+        sock = ssloop.Socket(sock=a, loop=self.loop)
+        reply = os.urandom(1024 * 1024)
+        requests = []
+
+        def on_end(s):
+            # the peer is done writing, but still reading
+            s.write(reply)
+            s.end()
+        sock.on('data', lambda s, d: requests.append(d))
+        sock.on('end', on_end)
+        received = []
+
+        def on_readable():
+            d = b.recv(65536)
+            received.append(d)
+            if not d:
+                self.loop.stop()
+        self.loop.add_fd(b, loop_.MODE_IN, on_readable)
+        errors = []
+        self.loop._on_error = errors.append
+        b.send(b'request')
+        b.shutdown(socket.SHUT_WR)
+        self.loop.start()
+        b.close()
+        self.assertEqual(errors, [])
+        self.assertEqual(requests, [b'request'])
+        self.assertEqual(b''.join(received), reply)
+        self.assertEqual(sock._state, ssloop.net.STATE_CLOSED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/python
+
+''' benchmarks/suite.py run small, every benchmark must report
+
+    python test_benchmarks.py '''
+
+import os
+import sys
+import tempfile
+import unittest
+
+from ssloop import loop as loop_
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_suite(self):
+        import json
+        import subprocess
+        suite = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmarks', 'suite.py')
+        if not os.path.exists(suite):
+            self.skipTest('no benchmarks here')
+        fd, output = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call([sys.executable, suite, '--scale', '0.01',
+                                       '--repeat', '1', '-o', output],
+                                      stderr=devnull)
+            with open(output) as f:
+                report = json.load(f)
+        finally:
+            os.unlink(output)
+        results = report['results']
+        self.assertEqual(set(r['benchmark'] for r in results),
+                         set(['echo', 'rps', 'cps', 'udp', 'timers', 'emitter']))
+        backends = set(loop_.available_backends())
+        for r in results:
+            self.assertTrue(r['backend'] in backends or r['backend'] is None, r)
+            for key, value in r.items():
+                if isinstance(value, float):
+                    self.assertTrue(value > 0, (r['benchmark'], key, value))
+
+
+if __name__ == '__main__':
+    unittest.main()
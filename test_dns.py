@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+''' the cache of dns.Resolver, against a lookup that only counts queries
+
+    python test_dns.py '''
+
+import logging
+import socket
+import unittest
+
+from ssloop import dns
+from ssloop import loop as loop_
+
+
+class StubLookup(object):
+    '''answers nothing by itself, the tests call Resolver._done'''
+
+    def __init__(self):
+        self.keys = []
+
+    def lookup(self, key):
+        self.keys.append(key)
+
+
+class ResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = loop_.backend_class('select')()
+        self.resolver = dns.Resolver(self.loop)
+        self.lookup = self.resolver._lookup = StubLookup()
+        self.results = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    def resolve(self, host, now):
+        # the loop caches its time, the cache expires by it
+        self.loop._time = now
+        self.resolver.resolve(host, 80, lambda error, addrs: self.results.append((host, error, addrs)))
+
+    def answer(self, host, error, addrs, ttl=None, now=0):
+        self.loop._time = now
+        key = self.lookup.keys[-1]
+        self.assertEqual(key[0], host)
+        self.resolver._done(key, error, addrs, ttl)
+
+    def run_callbacks(self):
+        self.loop.add_callback(self.loop.stop)
+        self.loop.start()
+
+    def test_cache_and_expiry(self):
+        addrs = [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', ('1.2.3.4', 80))]
+        self.resolve('a.test', 0)
+        self.answer('a.test', None, addrs, ttl=30)
+        self.assertEqual(self.results, [('a.test', None, addrs)])
+        self.resolve('a.test', 29.9)
+        self.run_callbacks()
+        # from the cache
+        self.assertEqual(len(self.lookup.keys), 1)
+        self.assertEqual(self.results[1], ('a.test', None, addrs))
+        self.resolve('a.test', 30)
+        self.assertEqual(len(self.lookup.keys), 2)
+        self.assertEqual(len(self.results), 2)
+        # without a TTL of its own
+        self.answer('a.test', None, addrs, now=30)
+        self.resolve('a.test', 30 + dns.DEFAULT_TTL - 0.1)
+        self.assertEqual(len(self.lookup.keys), 2)
+        self.resolve('a.test', 30 + dns.DEFAULT_TTL)
+        self.assertEqual(len(self.lookup.keys), 3)
+
+    def test_ttl_limits(self):
+        self.resolve('a.test', 0)
+        self.answer('a.test', None, [], ttl=0)
+        # not cached at all
+        self.resolve('a.test', 0)
+        self.assertEqual(len(self.lookup.keys), 2)
+        self.answer('a.test', None, [], ttl=10 * dns.MAX_TTL)
+        self.resolve('a.test', dns.MAX_TTL)
+        self.assertEqual(len(self.lookup.keys), 3)
+
+    def test_negative_cache(self):
+        error = socket.gaierror(socket.EAI_NONAME, 'not known')
+        self.resolve('missing.test', 0)
+        self.answer('missing.test', error, None)
+        self.resolve('missing.test', dns.NEGATIVE_TTL - 0.1)
+        self.run_callbacks()
+        self.assertEqual(len(self.lookup.keys), 1)
+        self.assertEqual(self.results, [('missing.test', error, None)] * 2)
+        self.resolve('missing.test', dns.NEGATIVE_TTL)
+        self.assertEqual(len(self.lookup.keys), 2)
+
+    def test_concurrent_lookups_coalesced(self):
+        for host in ('a.test', 'a.test', 'b.test', 'a.test'):
+            self.resolve(host, 0)
+        self.assertEqual([key[0] for key in self.lookup.keys], ['a.test', 'b.test'])
+        self.assertEqual(len(self.resolver._pending[self.lookup.keys[0]]), 3)
+        self.resolver._done(self.lookup.keys[0], None, ['addr'])
+        self.assertEqual(self.results, [('a.test', None, ['addr'])] * 3)
+        self.assertEqual(list(self.resolver._pending), [self.lookup.keys[1]])
+
+    def test_failed_callback(self):
+        # one raising callback doesn't keep the others from their result
+        self.resolver.resolve('a.test', 80, lambda error, addrs: 1 // 0)
+        self.resolve('a.test', 0)
+        logger = logging.getLogger()
+        disabled, logger.disabled = logger.disabled, True
+        try:
+            self.answer('a.test', None, ['addr'])
+        finally:
+            logger.disabled = disabled
+        self.assertEqual(self.results, [('a.test', None, ['addr'])])
+
+    def test_ip_literals(self):
+        for host in ('127.0.0.1', '::1'):
+            self.resolve(host, 0)
+        self.assertEqual(self.lookup.keys, [])
+        # called back from the loop all the same
+        self.assertEqual(self.results, [])
+        self.run_callbacks()
+        self.assertEqual([(host, error, addrs[0][4][0]) for host, error, addrs in self.results],
+                         [('127.0.0.1', None, '127.0.0.1'), ('::1', None, '::1')])
+        self.assertEqual(len(self.resolver._cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+''' EventEmitter
+
+    python test_event.py '''
+
+import logging
+import unittest
+
+import ssloop
+
+
+class EventEmitterTest(unittest.TestCase):
+
+    def test_once(self):
+        emitter = ssloop.EventEmitter()
+        fired = []
+        emitter.on('e', lambda x: fired.append(('on', x)))
+        emitter.once('e', lambda x: fired.append(('once', x)))
+        emitter.on('e', lambda x: fired.append(('last', x)))
+        self.assertTrue(emitter.emit('e', 1))
+        self.assertTrue(emitter.emit('e', 2))
+        # in the order added
+        self.assertEqual(fired, [('on', 1), ('once', 1), ('last', 1),
+                                 ('on', 2), ('last', 2)])
+        self.assertEqual(emitter.listener_count('e'), 2)
+        self.assertFalse(emitter.emit('other'))
+
+    def test_once_emitting_again(self):
+        emitter = ssloop.EventEmitter()
+        fired = []
+
+        def listener():
+            fired.append(1)
+            emitter.emit('e')
+        emitter.once('e', listener)
+        emitter.emit('e')
+        self.assertEqual(fired, [1])
+
+    def test_remove_listener(self):
+        emitter = ssloop.EventEmitter()
+        fired = []
+        callback = lambda: fired.append('once')
+        emitter.once('e', callback)
+        emitter.remove_listener('e', callback)
+        self.assertEqual(emitter.listener_count('e'), 0)
+        self.assertFalse(emitter.emit('e'))
+        self.assertEqual(fired, [])
+
+    def test_changes_during_emit(self):
+        emitter = ssloop.EventEmitter()
+        fired = []
+        second = lambda: fired.append('second')
+        added = lambda: fired.append('added')
+
+        def first():
+            fired.append('first')
+            emitter.remove_listener('e', second)
+            emitter.on('e', added)
+        emitter.on('e', first)
+        emitter.on('e', second)
+        # the listeners as they were when emit() was called
+        emitter.emit('e')
+        self.assertEqual(fired, ['first', 'second'])
+        del fired[:]
+        emitter.remove_listener('e', first)
+        emitter.emit('e')
+        self.assertEqual(fired, ['added'])
+
+    def test_errors(self):
+        emitter = ssloop.EventEmitter()
+        fired = []
+        emitter.on('e', lambda: 1 // 0)
+        emitter.on('e', lambda: fired.append(1))
+        logger = logging.getLogger()
+        disabled, logger.disabled = logger.disabled, True
+        try:
+            emitter.emit('e')
+        finally:
+            logger.disabled = disabled
+        # logged, and the next listener still called
+        self.assertEqual(fired, [1])
+
+        class Raising(ssloop.EventEmitter):
+            __slots__ = ()
+            catch_errors = False
+        emitter = Raising()
+        emitter.on('e', lambda: 1 // 0)
+        self.assertRaises(ZeroDivisionError, emitter.emit, 'e')
+
+
+if __name__ == '__main__':
+    unittest.main()
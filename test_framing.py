@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+''' the decoders of ssloop.framing, fed in every chunking
+
+    python test_framing.py '''
+
+import struct
+import unittest
+
+from ssloop import framing
+
+
+def decode(decoder, chunks):
+    frames = []
+    for chunk in chunks:
+        decoder.feed(chunk)
+        while True:
+            frame = decoder.next_frame()
+            if frame is None:
+                break
+            frames.append(frame)
+    return frames
+
+
+def splits(data):
+    '''data in two chunks cut at every offset, then byte by byte'''
+    for i in range(len(data) + 1):
+        yield [data[:i], data[i:]]
+    yield [data[i:i + 1] for i in range(len(data))]
+
+
+class DelimiterDecoderTest(unittest.TestCase):
+
+    def test_delimiter_split_across_chunks(self):
+        data = b'ab\r\n\r\nc\rd\r\n\r'
+        for chunks in splits(data):
+            decoder = framing.DelimiterDecoder(b'\r\n')
+            self.assertEqual(decode(decoder, chunks), [b'ab', b'', b'c\rd'])
+            self.assertEqual(decoder.buffered, 1)
+
+    def test_scanned_resume(self):
+        decoder = framing.DelimiterDecoder(b'\r\n')
+        decoder.feed(b'abc\r')
+        self.assertEqual(decoder.next_frame(), None)
+        # the search resumes at the last byte, which may start the delimiter
+        self.assertEqual(decoder._scanned, 3)
+        decoder.feed(b'\nd')
+        self.assertEqual(decoder.next_frame(), b'abc')
+        self.assertEqual(decoder._scanned, 0)
+        self.assertEqual(decoder.next_frame(), None)
+        decoder.feed(b'\r\n')
+        self.assertEqual(decoder.next_frame(), b'd')
+
+    def test_keep_delimiter(self):
+        decoder = framing.DelimiterDecoder(b'\r\n', keep_delimiter=True)
+        self.assertEqual(decode(decoder, [b'a\r', b'\nb\r\n']), [b'a\r\n', b'b\r\n'])
+
+    def test_max_frame_size(self):
+        decoder = framing.DelimiterDecoder(max_frame_size=4)
+        self.assertEqual(decode(decoder, [b'abcd\n', b'abcd']), [b'abcd'])
+        # an incomplete frame fails as soon as it's too large
+        decoder.feed(b'e')
+        self.assertRaises(framing.FrameError, decoder.next_frame)
+        decoder = framing.DelimiterDecoder(max_frame_size=4)
+        decoder.feed(b'abcde\n')
+        self.assertRaises(framing.FrameError, decoder.next_frame)
+
+
+class LengthPrefixDecoderTest(unittest.TestCase):
+
+    def test_prefix_sizes(self):
+        frames = [b'', b'a', b'x' * 255]
+        for prefix_size, format in ((1, 'B'), (2, 'H'), (4, 'I'), (8, 'Q')):
+            for little_endian in (False, True):
+                prefix = struct.Struct(('<' if little_endian else '>') + format)
+                data = b''.join(prefix.pack(len(f)) + f for f in frames)
+                for chunks in splits(data):
+                    decoder = framing.LengthPrefixDecoder(prefix_size, little_endian)
+                    self.assertEqual(decode(decoder, chunks), frames)
+                    self.assertEqual(decoder.buffered, 0)
+
+    def test_max_frame_size(self):
+        decoder = framing.LengthPrefixDecoder(2, max_frame_size=100)
+        self.assertEqual(decode(decoder, [struct.pack('>H', 100) + b'x' * 100]), [b'x' * 100])
+        # from the prefix alone
+        decoder.feed(struct.pack('>H', 101))
+        self.assertRaises(framing.FrameError, decoder.next_frame)
+
+
+class VarintDecoderTest(unittest.TestCase):
+
+    def test_frames(self):
+        frames = [b'', b'a', b'x' * 127, b'y' * 128, b'z' * 300]
+        data = b''.join(framing.encode_varint(len(f)) + f for f in frames)
+        for chunks in splits(data):
+            self.assertEqual(decode(framing.VarintDecoder(), chunks), frames)
+
+    def test_malformed_prefix(self):
+        decoder = framing.VarintDecoder()
+        decoder.feed(b'\xff' * framing.VarintDecoder.MAX_PREFIX_SIZE)
+        self.assertRaises(framing.FrameError, decoder.next_frame)
+        decoder = framing.VarintDecoder(max_frame_size=1000)
+        decoder.feed(framing.encode_varint(1001))
+        self.assertRaises(framing.FrameError, decoder.next_frame)
+
+
+class FixedSizeDecoderTest(unittest.TestCase):
+
+    def test_frames(self):
+        for chunks in splits(b'abcdefg'):
+            decoder = framing.FixedSizeDecoder(3)
+            self.assertEqual(decode(decoder, chunks), [b'abc', b'def'])
+            self.assertEqual(decoder.buffered, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
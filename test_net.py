@@ -0,0 +1,25 @@
+#!/usr/bin/python
+
+''' the parts of ssloop.net not needing a loop
+
+    python test_net.py '''
+
+import socket
+import unittest
+
+import ssloop
+
+
+class InterleaveTest(unittest.TestCase):
+
+    def test_interleave(self):
+        v6, v4 = socket.AF_INET6, socket.AF_INET
+        addrs = [(v6, 'a'), (v6, 'b'), (v4, 'c'), (v4, 'd'), (v4, 'e')]
+        self.assertEqual(ssloop.net._interleave(addrs),
+                         [(v6, 'a'), (v4, 'c'), (v6, 'b'), (v4, 'd'), (v4, 'e')])
+        addrs = [(v4, 'c'), (v6, 'a')]
+        self.assertEqual(ssloop.net._interleave(addrs), addrs)
+
+
+if __name__ == '__main__':
+    unittest.main()
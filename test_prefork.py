@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+''' Server.listen(workers=...) in a supervisor process of its own
+
+    python test_prefork.py '''
+
+import os
+import signal
+import socket
+import sys
+import time
+import unittest
+
+
+PREFORK_SERVER = '''
+import os, sys
+sys.path.insert(0, sys.argv[1])
+import ssloop
+server = ssloop.Server(('127.0.0.1', 0))
+server.on('connection', lambda server, conn: (
+    conn.write(str(os.getpid()).encode()), conn.end()))
+sys.stdout.write('%d\\n' % server._socket.getsockname()[1])
+sys.stdout.flush()
+server.listen(workers=2)
+ssloop.instance().start()
+'''
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'no fork here')
+class PreforkTest(unittest.TestCase):
+
+    def setUp(self):
+        import subprocess
+        here = os.path.dirname(os.path.abspath(__file__))
+        self.supervisor = subprocess.Popen(
+            [sys.executable, '-c', PREFORK_SERVER, here],
+            stdout=subprocess.PIPE)
+        self.port = int(self.supervisor.stdout.readline())
+
+    def tearDown(self):
+        # not SIGKILL, that would leave the workers running
+        if self.supervisor.poll() is None:
+            self.supervisor.send_signal(signal.SIGTERM)
+            self.supervisor.wait()
+        self.supervisor.stdout.close()
+
+    def worker_pids(self, connections=20):
+        pids = set()
+        for i in range(connections):
+            # the workers may not be listening yet
+            for attempt in range(50):
+                try:
+                    s = socket.create_connection(('127.0.0.1', self.port), 2)
+                    break
+                except socket.error:
+                    time.sleep(0.1)
+            s.settimeout(2)
+            reply = b''
+            while True:
+                d = s.recv(100)
+                if not d:
+                    break
+                reply += d
+            s.close()
+            if reply:
+                pids.add(int(reply))
+        return pids
+
+    def test_workers(self):
+        pids = self.worker_pids()
+        self.assertTrue(1 <= len(pids) <= 2, pids)
+        self.assertFalse(self.supervisor.pid in pids)
+        # a dead worker is replaced
+        os.kill(pids.pop(), signal.SIGKILL)
+        time.sleep(1.5)
+        self.assertTrue(self.worker_pids())
+        self.assertEqual(self.supervisor.poll(), None)
+
+    def test_stop(self):
+        self.worker_pids()
+        self.supervisor.send_signal(signal.SIGTERM)
+        deadline = time.time() + 5
+        while self.supervisor.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.supervisor.poll(), 0)
+        # the workers are gone along with their sockets
+        self.assertRaises(socket.error, socket.create_connection,
+                          ('127.0.0.1', self.port), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
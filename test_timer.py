@@ -0,0 +1,51 @@
+#!/usr/bin/python
+
+''' the monotonic clock, and the timing wheel of coarse timeouts
+
+    python test_timer.py '''
+
+import random
+import sys
+import time
+import unittest
+
+from ssloop import loop as loop_
+
+
+class TimerTest(unittest.TestCase):
+
+    def test_monotonic(self):
+        if sys.platform.startswith('linux'):
+            self.assertTrue(loop_._monotonic is not time.time)
+        t = loop_._monotonic()
+        time.sleep(0.01)
+        self.assertTrue(0.005 < loop_._monotonic() - t < 1)
+
+    def test_wheel_order_and_cancellation(self):
+        from ssloop import timer
+        wheel = timer.TimingWheel(0, resolution=1)
+        rnd = random.Random(1)
+        # deadlines on every level of the wheel
+        handlers = [loop_.Handler(None, deadline=rnd.randint(1, 1 << 20)) for i in range(5000)]
+        for handler in handlers:
+            wheel.add(handler)
+        cancelled = set(handlers[::3])
+        for handler in cancelled:
+            wheel.remove(handler)
+        fired = []
+        now = 0
+        while wheel.count:
+            deadline = wheel.next_deadline()
+            self.assertTrue(deadline >= now)
+            now = deadline
+            for handler in wheel.advance(now):
+                # neither early nor late
+                self.assertEqual(handler.deadline, now)
+                fired.append(handler)
+        self.assertEqual(set(fired), set(handlers) - cancelled)
+        self.assertEqual(len(fired), len(set(fired)))
+        self.assertEqual([h.deadline for h in fired], sorted(h.deadline for h in fired))
+
+
+if __name__ == '__main__':
+    unittest.main()